@@ -1,25 +1,118 @@
 """FastAPI application that retrieves queries from a CSV file using Insightly."""
 
+import json
+import math
 import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional
 
 ROOT_PATH: str = str(Path(__file__).resolve()).split("app/", maxsplit=1)[0]
 
 from loguru import logger
 from dotenv import load_dotenv
-import plotly.graph_objects as go
 from supabase import Client, create_client
 
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi import FastAPI, Header, HTTPException, Query, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Receive, Scope, Send
 
-from insightly.workflow import create_and_compile_workflow, ask
+from insightly import setup_logging
+import insightly.admission as admission
+import insightly.history as history
+from insightly.admission import AdmissionRejected, setup_admission
+from insightly.snapshots import (
+    SnapshotNotFoundError,
+    current_version,
+    publish_snapshot,
+)
+from insightly.history import setup_query_history
+from insightly.metrics import metrics
+from insightly.models import setup_model_router
+from insightly.repairs import setup_repair_rules
+from insightly.workflow import (
+    ask,
+    create_and_compile_workflow,
+    RunAccessError,
+    RunDatabaseError,
+    resume,
+    sqlite_checkpointer,
+    stream,
+)
 from insightly.insightly import Insightly
+from insightly.workspaces import WorkspaceManager
+from insightly.results import (
+    ARROW_STREAM_MEDIA_TYPE,
+    ExportFormat,
+    InvalidCursorError,
+    ResultAccessError,
+    ResultExport,
+    accepts_arrow,
+    check_result_table,
+    check_result_token,
+    export_result,
+    result_page,
+    result_exists,
+    result_page_arrow,
+    setup_result_signing,
+    sign_result,
+)
+from insightly.rendering import PlotRenderer
+from insightly.figures import (
+    FigureCache,
+    FigureFormat,
+    compress,
+    negotiate_encoding,
+    serialise_figure,
+)
 from insightly.classes import AgentState
+from insightly.utils import (
+    ADMISSION_MAX_CONCURRENT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_MAX_WAIT_SECONDS,
+    DUCKDB_SLOTS,
+    RESULT_PAGE_SIZE,
+)
+
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
 
 # loading environment variables that store the supabase URL and API key
 load_dotenv()
+setup_logging()
+# executed queries are mined to tune the layout of the data
+setup_query_history(
+    os.getenv("QUERY_HISTORY", os.path.join(ROOT_PATH, "logs", "query_history.jsonl"))
+)
+# small models for the classification nodes, see insightly.models
+MODEL_CONFIG: str = os.getenv("MODEL_CONFIG", os.path.join(ROOT_PATH, "models.toml"))
+if os.path.exists(MODEL_CONFIG):
+    setup_model_router(MODEL_CONFIG)
+# fixes of failed queries are reused for the same errors
+setup_repair_rules(
+    os.getenv("REPAIR_RULES", os.path.join(ROOT_PATH, "logs", "repair_rules.jsonl"))
+)
+# questions and DuckDB queries answered at once, see insightly.admission
+setup_admission(
+    max_concurrent=int(
+        os.getenv("ADMISSION_MAX_CONCURRENT", ADMISSION_MAX_CONCURRENT)
+    ),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", ADMISSION_MAX_QUEUE)),
+    max_wait=float(os.getenv("ADMISSION_MAX_WAIT", ADMISSION_MAX_WAIT_SECONDS)),
+    tokens_per_minute=(
+        int(os.environ["LLM_TOKENS_PER_MINUTE"])
+        if os.getenv("LLM_TOKENS_PER_MINUTE")
+        else None
+    ),
+    duckdb_slots=int(os.getenv("DUCKDB_SLOTS", DUCKDB_SLOTS)),
+)
 
 app = FastAPI()
 
@@ -40,44 +133,827 @@ def create_supabase_client() -> Client:
 
 app = FastAPI()
 
+# "single" serves everything from one process. For multi-process serving one
+# "writer" process loads the data and publishes snapshots of the workspaces
+# to SNAPSHOT_ROOT, and "reader" workers answer questions from them
+SERVING_ROLE: str = os.getenv("INSIGHTLY_ROLE", "single")
+if SERVING_ROLE not in ("single", "writer", "reader"):
+    raise ValueError(f"Unknown INSIGHTLY_ROLE {SERVING_ROLE!r}.")
+SNAPSHOT_ROOT: str = os.getenv("SNAPSHOT_ROOT", os.path.join(ROOT_PATH, "snapshots"))
+# result tables of the reader workers, on a disk they share so that /results,
+# /export and resumed runs work whichever worker stored the result
+RESULTS_ROOT: str = os.getenv("RESULTS_ROOT", os.path.join(ROOT_PATH, "results"))
+
+# hard memory ceiling and spill folder of every DuckDB database of the process
+temp_directory = os.getenv(
+    "DUCKDB_TEMP_DIRECTORY", os.path.join(ROOT_PATH, "tmp", "duckdb")
+)
+if SERVING_ROLE == "reader":
+    # results of each worker spill to its own folder
+    temp_directory = os.path.join(temp_directory, f"worker-{os.getpid()}")
+Insightly.configure(
+    memory_limit=os.getenv("DUCKDB_MEMORY_LIMIT"),
+    threads=int(os.environ["DUCKDB_THREADS"]) if os.getenv("DUCKDB_THREADS") else None,
+    temp_directory=temp_directory,
+    max_temp_directory_size=os.getenv("DUCKDB_MAX_TEMP_SIZE"),
+)
+
 # Initialize supabase client
 supabase = create_supabase_client()
 
+# per-dataset databases, each in its own DuckDB file, read from their
+# snapshots by reader workers
+workspaces = WorkspaceManager(
+    root=os.path.join(ROOT_PATH, "workspaces"),
+    snapshots=SNAPSHOT_ROOT if SERVING_ROLE == "reader" else None,
+    results=RESULTS_ROOT if SERVING_ROLE == "reader" else None,
+)
+
+# result tokens are signed with a random key of the process unless
+# RESULT_SIGNING_KEY is shared by the workers, see insightly.results
+if os.getenv("RESULT_SIGNING_KEY"):
+    setup_result_signing(os.environ["RESULT_SIGNING_KEY"])
+
+# serialised figures, keyed by the query and the version of the data
+figure_cache = FigureCache()
+
+# figures are built in worker processes when PLOT_WORKERS is set above 0
+plot_workers: int = int(os.getenv("PLOT_WORKERS", "0"))
+renderer: Optional[PlotRenderer] = (
+    PlotRenderer(max_workers=plot_workers) if plot_workers > 0 else None
+)
+
+# runs are checkpointed after every node when CHECKPOINT_DB points to a
+# SQLite file, so they can be resumed with /runs/{thread_id}/resume
+checkpoint_db: Optional[str] = os.getenv("CHECKPOINT_DB")
+checkpointer = sqlite_checkpointer(checkpoint_db) if checkpoint_db else None
+
+
+@app.on_event("shutdown")
+def stop_renderer() -> None:
+    """Stop the plot worker processes with the server."""
+    if renderer is not None:
+        renderer.shutdown()
+
+
+@app.on_event("startup")
+def publish_workspaces() -> None:
+    """Publish the workspaces loaded before the writer process started."""
+    if SERVING_ROLE != "writer":
+        return
+    for file in sorted(os.listdir(workspaces.root)):
+        match = re.match(r"^ws_(\w+)\.duckdb$", file)
+        if match is None or current_version(SNAPSHOT_ROOT, f"ws_{match.group(1)}"):
+            continue
+        with workspaces.use(match.group(1)) as insightly:
+            publish_snapshot(insightly, SNAPSHOT_ROOT)
+
+
+def _check_writer() -> None:
+    """Reject data loads in reader workers, the writer process owns the files."""
+    if SERVING_ROLE == "reader":
+        raise HTTPException(
+            status_code=409,
+            detail="This worker serves read-only snapshots, load data through "
+            "the writer process.",
+        )
+
+
+def _publish(insightly: Insightly) -> None:
+    """Point the reader workers at the data the writer process just loaded."""
+    if SERVING_ROLE == "writer":
+        publish_snapshot(insightly, SNAPSHOT_ROOT)
+
+
+@app.exception_handler(SnapshotNotFoundError)
+def snapshot_not_found(request: Request, exc: SnapshotNotFoundError) -> JSONResponse:
+    """Answer questions about workspaces the writer has not published yet."""
+    return JSONResponse(status_code=404, content={"detail": str(exc)})
+
+
+@app.exception_handler(AdmissionRejected)
+def admission_rejected(request: Request, exc: AdmissionRejected) -> JSONResponse:
+    """Turn away questions the service has no room for, with when to retry."""
+    logger.warning(f"Rejected {request.url.path}: {exc}")
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
+
+
+def _tenant(tenant_id: Optional[str], workspace_id: Optional[str]) -> str:
+    """Who a question is queued for, the workspace unless a tenant is given."""
+    return tenant_id or workspace_id or "default"
+
+
+def _check_workspace_id(workspace_id: str) -> None:
+    """Reject workspace ids that cannot be used as file and catalog names."""
+    try:
+        workspaces.path(workspace_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _figure_response(
+    result: AgentState, figure_format: FigureFormat, accept_encoding: Optional[str]
+) -> Response:
+    """Serialise the figure of a plot answer, reusing cached payloads."""
+    # images are already compressed
+    encoding = (
+        negotiate_encoding(accept_encoding)
+        if figure_format != FigureFormat.PNG
+        else None
+    )
+    insightly = Insightly()
+    key = FigureCache.key(
+        result["sql_query_info"]["sql_query"],
+        result["plot_query_info"]["columns"],
+        result["plot_query_info"]["plot_type"],
+        insightly.db_name,
+        insightly.version,
+        figure_format,
+        encoding,
+    )
+    cached = figure_cache.get(key)
+    if cached is None:
+        # if the plot was generated successfully, build it from the result table
+        if renderer is not None:
+            from insightly.plotting import make_plot
+
+            # aggregate in DuckDB, only the plotted rows go to the workers
+            plot_type = result["plot_query_info"]["plot_type"]
+            columns = result["plot_query_info"]["columns"]
+            kind, data = make_plot(plot_type).reduce(
+                None, columns, table_name=result["sql_query_info"]["table_name"]
+            )
+            try:
+                body = renderer.render(plot_type, kind, data, columns, figure_format)
+            except TimeoutError:
+                raise HTTPException(
+                    status_code=504, detail="Rendering the plot took too long."
+                )
+        else:
+            # plotly is only imported once the first plot is made
+            from insightly.plotting import build_figure
+
+            figure: go.Figure = build_figure(
+                result["sql_query_info"], result["plot_query_info"]
+            )
+            body = serialise_figure(figure, figure_format)
+        cached = compress(body, encoding)
+        figure_cache.put(key, cached)
+    else:
+        logger.debug("Serving cached figure")
+
+    body, applied_encoding = cached
+    headers = {"Vary": "Accept-Encoding"}
+    if applied_encoding is not None:
+        headers["Content-Encoding"] = applied_encoding
+    return Response(content=body, media_type=figure_format.media_type, headers=headers)
+
+
+def _query_response(
+    result: AgentState, thread_id: Optional[str], tenant: str
+) -> JSONResponse:
+    """Build the JSON answer of a SQL question with the first page of its result.
+
+    The result token lets the tenant read the rest of the result from
+    /results and /export, in the workspace it was asked in only.
+    """
+    sql_query_info = result["sql_query_info"]
+    content: dict[str, Any] = {
+        "question": result["question"],
+        "thread_id": thread_id,
+        "meant_as_query": result.get("meant_as_query", False),
+        "sql_query": sql_query_info["sql_query"],
+        "success_response": sql_query_info.get("success_response"),
+        "sql_error": sql_query_info.get("sql_error", False),
+        "result": None,
+        "result_token": None,
+        "message": None,
+    }
+    if isinstance(sql_query_info["query_result"], str):
+        # errors and statements without rows only carry a message
+        content["message"] = sql_query_info["query_result"]
+    else:
+        content["result"] = result_page(sql_query_info["table_name"])
+        content["result_token"] = sign_result(
+            sql_query_info["table_name"], Insightly().db_name, tenant
+        )
+        logger.info(
+            "Result: {n} rows in {table}".format(
+                n=content["result"]["row_count"], table=sql_query_info["table_name"]
+            )
+        )
+    return JSONResponse(content=content)
+
+
+def _answer(
+    question: str,
+    tenant: str,
+    figure_format: FigureFormat = FigureFormat.HTML,
+    accept_encoding: Optional[str] = None,
+    thread_id: Optional[str] = None,
+    configurable: Optional[dict[str, Any]] = None,
+) -> Any:
+    """Run the workflow on the active database and build the response."""
+    _, app = create_and_compile_workflow(checkpointer)
+
+    # question = "What is the average age of passengers who survived?"
+    result: AgentState = ask(
+        app,
+        question,
+        {"configurable": configurable or {}},
+        thread_id=thread_id,
+        tenant=tenant,
+    )
+    return _respond(result, figure_format, accept_encoding, thread_id, tenant)
+
+
+def _respond(
+    result: AgentState,
+    figure_format: FigureFormat,
+    accept_encoding: Optional[str],
+    thread_id: Optional[str],
+    tenant: str,
+) -> Any:
+    """Build the response to the final state of a run."""
+    if result.get("relevance") != "relevant":
+        # the funny response is stored as the query result
+        return JSONResponse(
+            content={
+                "question": result["question"],
+                "thread_id": thread_id,
+                "relevance": result.get("relevance"),
+                "message": result["sql_query_info"]["query_result"],
+            }
+        )
+    if result.get("meant_as_query", False) or isinstance(
+        result["sql_query_info"]["query_result"], str
+    ):
+        # if the SQL query was executed successfully, print the result
+        logger.info(result["sql_query_info"].get("success_response"))
+        return _query_response(result, thread_id, tenant)
+    else:
+        response = _figure_response(result, figure_format, accept_encoding)
+        if thread_id is not None:
+            response.headers["X-Thread-Id"] = thread_id
+        return response
+
+
+def _stream_answer(
+    question: str,
+    workspace_id: Optional[str],
+    thread_id: Optional[str],
+    tenant: str,
+    admitted: float,
+    configurable: Optional[dict[str, Any]] = None,
+) -> Iterator[bytes]:
+    """Run the workflow in approximate mode, yielding NDJSON events.
+
+    The workflow runs on its own thread, which keeps the workspace active for
+    the whole run, and hands its events over through a queue. The thread
+    starts right away and frees the admission slot of the question when it
+    ends, even if the client never reads the events.
+    """
+    events: queue.Queue = queue.Queue()
+
+    def run() -> None:
+        try:
+            workspace = (
+                workspaces.use(workspace_id)
+                if workspace_id is not None
+                else nullcontext()
+            )
+            with workspace:
+                if workspace_id is None:
+                    _load_example()
+                _, app = create_and_compile_workflow(checkpointer)
+                config = {"configurable": {**(configurable or {}), "approximate": True}}
+                for kind, payload in stream(app, question, config, thread_id, tenant):
+                    if kind == "preview":
+                        events.put(
+                            {"event": "preview", "thread_id": thread_id, **payload}
+                        )
+                        continue
+                    # plots are sent as figure JSON inside the event
+                    response = _respond(
+                        payload, FigureFormat.JSON, None, thread_id, tenant
+                    )
+                    content = json.loads(response.body)
+                    if not isinstance(response, JSONResponse):
+                        content = {
+                            "question": question,
+                            "thread_id": thread_id,
+                            "figure": content,
+                        }
+                    events.put({"event": "result", **content})
+        except Exception as e:
+            logger.exception(f"Approximate answer failed: {e}")
+            events.put({"event": "error", "detail": str(e)})
+        finally:
+            admission.admission_controller.release(admitted)
+            events.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    def read() -> Iterator[bytes]:
+        while (event := events.get()) is not None:
+            yield (json.dumps(event, default=str) + "\n").encode()
+
+    return read()
+
+
+def _require_tables(insightly: Insightly, workspace_id: str) -> None:
+    """Reject questions about a workspace nothing was uploaded to."""
+    if not insightly.tables:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Workspace {workspace_id} has no tables, upload one first.",
+        )
+
+
+def _load_example() -> None:
+    """Load the Titanic example dataset, used when no workspace is given."""
+    path_to_csv: str = f"{ROOT_PATH}/data/titanic/train.csv"
+    Insightly().read_csv_to_duckdb(path_to_csv, "titanic")
+
 
 @app.get("/query")
-def ask_question(question: str) -> Any:
+def ask_question(
+    question: str,
+    workspace_id: Optional[str] = None,
+    figure_format: FigureFormat = FigureFormat.HTML,
+    approximate: bool = False,
+    memory_limit: Optional[str] = None,
+    threads: Optional[int] = None,
+    accept_encoding: Optional[str] = Header(default=None),
+    x_tenant_id: Optional[str] = Header(default=None),
+) -> Any:
     """Ask a question to the Insightly app and get a response.
 
+    Questions wait for a free slot in a queue per tenant. When the service
+    is saturated the answer is a 429 with a Retry-After header.
+
     Parameters
     ----------
-    req : https_fn.Request
-        The request object containing the question to ask.
+    question : str
+        The question to ask.
+    workspace_id : str, optional
+        The workspace holding the data to ask about. Without one the
+        question is asked about the Titanic example dataset.
+    figure_format : FigureFormat, optional
+        Return plots as an HTML page (default), compact figure JSON or PNG.
+    approximate : bool, optional
+        Stream newline delimited JSON events instead: a "preview" answer
+        computed over samples of the large tables, with 95% error bounds,
+        then the exact "result", with plots as figure JSON.
+    memory_limit, threads : optional
+        Not supported, DuckDB sets them for the whole database, see
+        DUCKDB_MEMORY_LIMIT and DUCKDB_THREADS. A 400 if set, rather than
+        queries silently running without them.
+    accept_encoding : str, optional
+        Accept-Encoding header, plots are compressed with brotli or gzip.
+    x_tenant_id : str, optional
+        X-Tenant-Id header, the tenant the question is queued for. The
+        workspace by default.
 
     Returns
     -------
-    https_fn.Response
-        The response object containing the result of the question.
+    Any
+        JSON with the answer for queries, the figure for plots. When
+        checkpointing is enabled the run is saved under a new thread id,
+        returned as "thread_id" or the X-Thread-Id header, that only the
+        tenant can resume it with.
     """
-    path_to_csv: str = f"{ROOT_PATH}/data/titanic/train.csv"
-    insightly = Insightly()
-    insightly.read_csv_to_duckdb(path_to_csv, "titanic")
+    thread_id = uuid.uuid4().hex if checkpointer is not None else None
 
-    _, app = create_and_compile_workflow()
+    if memory_limit is not None or threads is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="memory_limit and threads cannot be set per question, DuckDB "
+            "applies them to the whole database. They are set when the database "
+            "is opened, see DUCKDB_MEMORY_LIMIT and DUCKDB_THREADS.",
+        )
+    configurable: dict[str, Any] = {}
 
-    # question = "What is the average age of passengers who survived?"
-    result: AgentState = ask(app, question)
-    if result.get("meant_as_query", False):
-        # if the SQL query was executed successfully, print the result
-        logger.info(result["sql_query_info"]["success_response"])
-        logger.info(
-            "Result: {res}".format(res=result["sql_query_info"]["query_result"])
+    tenant = _tenant(x_tenant_id, workspace_id)
+    if approximate:
+        if workspace_id is not None:
+            _check_workspace_id(workspace_id)
+            with workspaces.use(workspace_id) as insightly:
+                _require_tables(insightly, workspace_id)
+        # released by the thread answering the question
+        admitted = admission.admission_controller.acquire(tenant)
+        return StreamingResponse(
+            _stream_answer(
+                question, workspace_id, thread_id, tenant, admitted, configurable
+            ),
+            media_type="application/x-ndjson",
         )
 
-        return JSONResponse(content=result)
+    if workspace_id is None:
+        with admission.admission_controller.admitted(tenant):
+            _load_example()
+            return _answer(
+                question, tenant, figure_format, accept_encoding, thread_id, configurable
+            )
+
+    _check_workspace_id(workspace_id)
+    with admission.admission_controller.admitted(tenant), workspaces.use(
+        workspace_id
+    ) as insightly:
+        _require_tables(insightly, workspace_id)
+        return _answer(
+            question, tenant, figure_format, accept_encoding, thread_id, configurable
+        )
+
+
+@app.post("/runs/{thread_id}/resume")
+def resume_run(
+    thread_id: str,
+    workspace_id: Optional[str] = None,
+    figure_format: FigureFormat = FigureFormat.HTML,
+    accept_encoding: Optional[str] = Header(default=None),
+    x_tenant_id: Optional[str] = Header(default=None),
+) -> Any:
+    """Continue a run that failed midway from its last completed node.
+
+    Parameters
+    ----------
+    thread_id : str
+        The thread id returned when the question was asked.
+    workspace_id : str, optional
+        The workspace the question was asked in.
+    figure_format : FigureFormat, optional
+        Return plots as an HTML page (default), compact figure JSON or PNG.
+    accept_encoding : str, optional
+        Accept-Encoding header, plots are compressed with brotli or gzip.
+    x_tenant_id : str, optional
+        X-Tenant-Id header, the tenant the run is queued for. It must be
+        the tenant who asked the question.
+
+    Returns
+    -------
+    Any
+        The same response as /query.
+    """
+    if checkpointer is None:
+        raise HTTPException(
+            status_code=404, detail="Checkpointing is disabled, set CHECKPOINT_DB."
+        )
+
+    def continue_run() -> Any:
+        _, app = create_and_compile_workflow(checkpointer)
+        try:
+            result = resume(app, thread_id, tenant=tenant)
+        except RunAccessError:
+            # the same answer as a missing run, thread ids are not disclosed
+            raise HTTPException(status_code=404, detail=f"No run {thread_id}.")
+        except RunDatabaseError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        if result is None:
+            raise HTTPException(status_code=404, detail=f"No run {thread_id}.")
+        return _respond(result, figure_format, accept_encoding, thread_id, tenant)
+
+    tenant = _tenant(x_tenant_id, workspace_id)
+    if workspace_id is None:
+        with admission.admission_controller.admitted(tenant):
+            # the example table is in memory, load it again if the process restarted
+            _load_example()
+            return continue_run()
+    _check_workspace_id(workspace_id)
+    with admission.admission_controller.admitted(tenant), workspaces.use(
+        workspace_id
+    ):
+        return continue_run()
+
+
+@app.post("/workspaces/{workspace_id}/tables/{table_name}")
+def upload_table(workspace_id: str, table_name: str, file: UploadFile) -> Any:
+    """Load an uploaded CSV file into a table of a workspace.
+
+    Parameters
+    ----------
+    workspace_id : str
+        The workspace to add the table to, created if it does not exist.
+    table_name : str
+        The name of the table to create.
+    file : UploadFile
+        The CSV file.
+
+    Returns
+    -------
+    Any
+        The tables of the workspace.
+    """
+    _check_writer()
+    _check_workspace_id(workspace_id)
+    if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", table_name):
+        raise HTTPException(status_code=400, detail="Invalid table name.")
+    with workspaces.use(workspace_id) as insightly, tempfile.TemporaryDirectory() as tmp:
+        path_to_csv = os.path.join(tmp, f"{table_name}.csv")
+        with open(path_to_csv, "wb") as f:
+            shutil.copyfileobj(file.file, f)
+        insightly.read_csv_to_duckdb(path_to_csv, table_name)
+        _publish(insightly)
+        return JSONResponse(content={"tables": insightly.tables})
+
+
+@app.post("/workspaces/{workspace_id}/delta/{table_name}")
+def mirror_delta(
+    workspace_id: str,
+    table_name: str,
+    table_uri: str,
+    key_columns: Optional[list[str]] = Query(default=None),
+) -> Any:
+    """Copy a Delta table into a table of a workspace.
+
+    Parameters
+    ----------
+    workspace_id : str
+        The workspace to add the table to, created if it does not exist.
+    table_name : str
+        The name of the table to create.
+    table_uri : str
+        Local path or s3:// URI of the Delta table.
+    key_columns : list[str], optional
+        Columns identifying a row, needed to apply updates and deletes when
+        the table is refreshed, otherwise it is reloaded after them.
+
+    Returns
+    -------
+    Any
+        The loaded Delta version and the tables of the workspace.
+    """
+    _check_writer()
+    _check_workspace_id(workspace_id)
+    if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", table_name):
+        raise HTTPException(status_code=400, detail="Invalid table name.")
+    with workspaces.use(workspace_id) as insightly:
+        version = insightly.read_delta_to_duckdb(table_uri, table_name, key_columns)
+        _publish(insightly)
+        return JSONResponse(content={"version": version, "tables": insightly.tables})
+
+
+@app.post("/workspaces/{workspace_id}/tables/{table_name}/refresh")
+def refresh_delta(workspace_id: str, table_name: str) -> Any:
+    """Apply the Delta commits made since a copied table was last loaded.
+
+    Parameters
+    ----------
+    workspace_id : str
+        The workspace holding the table.
+    table_name : str
+        A table copied from Delta with /workspaces/{workspace_id}/delta.
+
+    Returns
+    -------
+    Any
+        The number of rows changed.
+    """
+    _check_writer()
+    _check_workspace_id(workspace_id)
+    with workspaces.use(workspace_id) as insightly:
+        try:
+            changed = insightly.refresh_delta_table(table_name)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        if changed:
+            _publish(insightly)
+        return JSONResponse(content={"changed_rows": changed})
+
+
+@app.post("/workspaces/{workspace_id}/rollups")
+def build_rollups(workspace_id: str) -> Any:
+    """Pre-aggregate the query shapes that recur in the history of a workspace.
+
+    Rollups are also built on their own as queries recur, this catches up
+    with the history recorded before a restart.
+
+    Parameters
+    ----------
+    workspace_id : str
+        The workspace to build the rollups in.
+
+    Returns
+    -------
+    Any
+        The tables and columns of the rollups that were built.
+    """
+    _check_workspace_id(workspace_id)
+    with workspaces.use(workspace_id) as insightly:
+        shapes = insightly.rollups.mine(
+            history.query_history.records(insightly.db_name)
+        )
+        return JSONResponse(
+            content=[
+                {
+                    "rollup": shape.rollup_name,
+                    "table": shape.base_table,
+                    "dimensions": sorted(shape.dimensions),
+                }
+                for shape in shapes
+            ]
+        )
+
+
+@app.get("/metrics")
+def get_metrics() -> Any:
+    """Counters and timings of this process, i.e. LLM tokens per node.
+
+    Returns
+    -------
+    Any
+        Each metric with its labels and value, see
+        `insightly.metrics.Metrics.snapshot`.
+    """
+    return JSONResponse(content=metrics.snapshot())
+
+
+@app.get("/debug/memory")
+def debug_memory() -> Any:
+    """DuckDB settings, buffer usage, spill files and result tables.
+
+    Returns
+    -------
+    Any
+        The report of the example database and of each open workspace.
+    """
+    return JSONResponse(
+        content={
+            "default": Insightly().memory_report(),
+            "workspaces": workspaces.memory_reports(),
+        }
+    )
+
+
+@app.get("/workspaces/memory")
+def workspaces_memory() -> Any:
+    """Memory used by each open workspace database, in bytes."""
+    return JSONResponse(content=workspaces.memory_usage())
+
+
+@app.get("/results/{table_name}")
+def get_result_page(
+    table_name: str,
+    token: Optional[str] = None,
+    cursor: Optional[str] = None,
+    page_size: int = RESULT_PAGE_SIZE,
+    workspace_id: Optional[str] = None,
+    accept: Optional[str] = Header(default=None),
+    x_tenant_id: Optional[str] = Header(default=None),
+) -> Any:
+    """Get a page of the result of a query as column arrays.
+
+    Parameters
+    ----------
+    table_name : str
+        The result table returned with the answer.
+    token : str, optional
+        The result_token returned with the answer.
+    cursor : str, optional
+        The next_cursor returned with the previous page.
+    page_size : int, optional
+        Maximum number of rows to return.
+    workspace_id : str, optional
+        The workspace the question was asked in.
+    accept : str, optional
+        Accept header, Arrow IPC is returned if it accepts
+        application/vnd.apache.arrow.stream.
+    x_tenant_id : str, optional
+        X-Tenant-Id header, the tenant that asked the question.
+
+    Returns
+    -------
+    Any
+        The page as JSON or as an Arrow IPC stream.
+    """
+    _check_result_request(table_name, workspace_id)
+    tenant = _tenant(x_tenant_id, workspace_id)
+
+    def read_page() -> Any:
+        _check_result_access(table_name, token, tenant)
+        try:
+            if accepts_arrow(accept):
+                return Response(
+                    content=result_page_arrow(table_name, cursor, page_size),
+                    media_type=ARROW_STREAM_MEDIA_TYPE,
+                )
+            return JSONResponse(content=result_page(table_name, cursor, page_size))
+        except InvalidCursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if workspace_id is None:
+        return read_page()
+    with workspaces.use(workspace_id):
+        return read_page()
+
+
+@app.get("/results/{table_name}/export")
+def export_result_table(
+    table_name: str,
+    token: Optional[str] = None,
+    format: ExportFormat = ExportFormat.PARQUET,
+    workspace_id: Optional[str] = None,
+    x_tenant_id: Optional[str] = Header(default=None),
+) -> Any:
+    """Download the full result of a query as Parquet, CSV or Arrow.
+
+    The file is streamed from DuckDB in chunks, it is never held in memory.
+    The workspace stays open until the stream ends.
+
+    Parameters
+    ----------
+    table_name : str
+        The result table returned with the answer.
+    token : str, optional
+        The result_token returned with the answer.
+    format : ExportFormat, optional
+        The file format, Parquet by default.
+    workspace_id : str, optional
+        The workspace the question was asked in.
+    x_tenant_id : str, optional
+        X-Tenant-Id header, the tenant that asked the question.
+
+    Returns
+    -------
+    Any
+        The streamed file.
+    """
+    _check_result_request(table_name, workspace_id)
+    tenant = _tenant(x_tenant_id, workspace_id)
+
+    def start_export() -> ResultExport:
+        _check_result_access(table_name, token, tenant)
+        try:
+            return export_result(table_name, format)
+        except RuntimeError as e:
+            raise HTTPException(status_code=406, detail=str(e))
+
+    def finish_export() -> None:
+        export.close()
+        if workspace_id is not None:
+            workspaces.release(workspace_id)
+
+    if workspace_id is None:
+        export = start_export()
     else:
-        # if the plot was generated successfully, show the plot that was returned
-        figure: go.Figure = result["plot_query_info"]["result"]
-        # turn figure into html and submit it as Jinja template
-        figure_html = figure.to_html(full_html=True, include_plotlyjs="cdn")
+        # released once the response ends, the Arrow stream reads the
+        # database while the client downloads it
+        insightly = workspaces.acquire(workspace_id)
+        try:
+            with insightly.activate():
+                export = start_export()
+        except BaseException:
+            workspaces.release(workspace_id)
+            raise
+    filename = f"{table_name}.{format.value}"
+    return _ExportResponse(
+        export,
+        finish_export,
+        media_type=format.media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+class _ExportResponse(StreamingResponse):
+    """Streams an export and finishes it however the response ends.
+
+    A background task would not run when the client disconnects or the
+    stream fails, leaking the export files and the workspace pin.
+    """
+
+    def __init__(
+        self, export: ResultExport, finish: Callable[[], None], **kwargs: Any
+    ) -> None:
+        super().__init__(export, **kwargs)
+        self.finish = finish
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self.finish)
+
+
+def _check_result_request(table_name: str, workspace_id: Optional[str]) -> None:
+    """Reject names that are not result tables and invalid workspace ids."""
+    try:
+        check_result_table(table_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if workspace_id is not None:
+        _check_workspace_id(workspace_id)
+
+
+def _check_result_access(table_name: str, token: Optional[str], tenant: str) -> None:
+    """Make sure the tenant was given the result in the active database."""
+    try:
+        check_result_token(token, table_name, Insightly().db_name, tenant)
+    except ResultAccessError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    if not result_exists(table_name):
+        raise HTTPException(status_code=404, detail=f"No result {table_name}.")
 
-        return HTMLResponse(content=figure_html)
@@ -2,4 +2,21 @@
 # export PYTHONPATH=$(pwd)/src/
 
 poetry env activate
-uvicorn app.main:app --reload
\ No newline at end of file
+
+if [ -z "$WORKERS" ]; then
+    uvicorn app.main:app --reload
+    exit
+fi
+
+# multi-process serving: the writer loads uploads into the workspace files and
+# publishes snapshots, the workers answer questions from the snapshots, send
+# uploads to WRITER_PORT and questions to PORT. Result tables are written to
+# RESULTS_ROOT, which the workers share, so any worker can serve a result
+export SNAPSHOT_ROOT="${SNAPSHOT_ROOT:-$(pwd)/snapshots}"
+export RESULTS_ROOT="${RESULTS_ROOT:-$(pwd)/results}"
+# result tokens must verify on every worker
+export RESULT_SIGNING_KEY="${RESULT_SIGNING_KEY:-$(head -c 32 /dev/urandom | od -An -tx1 | tr -d ' \n')}"
+INSIGHTLY_ROLE=writer uvicorn app.main:app --port "${WRITER_PORT:-8001}" &
+writer=$!
+trap 'kill $writer' EXIT
+INSIGHTLY_ROLE=reader uvicorn app.main:app --port "${PORT:-8000}" --workers "$WORKERS"
@@ -0,0 +1,73 @@
+"""Check that importing insightly stays within a startup time budget.
+
+Runs each import in a fresh interpreter with `-X importtime` and fails if
+the cumulative import time is over budget or if a heavy dependency that
+should only load on first use got imported.
+
+Usage: python scripts/import_time.py [scale]
+
+`scale` multiplies every budget, i.e. 2 on a slow CI machine.
+"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).resolve().parent.parent
+
+# module -> seconds allowed for a cold import
+BUDGETS: dict[str, float] = {
+    "insightly": 0.5,
+    "insightly.insightly": 1.0,
+    "insightly.workflow": 2.0,
+}
+# only imported on the first LLM call or the first plot
+LAZY_MODULES: list[str] = ["langchain_openai", "openai", "plotly", "langgraph"]
+
+
+def import_time(module: str) -> tuple[float, set[str]]:
+    """Import a module in a new interpreter.
+
+    Returns the cumulative import time in seconds and the imported modules.
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        cwd=ROOT_PATH,
+        env={**os.environ, "PYTHONPATH": str(ROOT_PATH / "src")},
+        check=True,
+    )
+    total_us = 0
+    imported = set()
+    # lines look like "import time:   self [us] | cumulative | imported package"
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        imported.add(name.strip())
+        if name.strip() == module:
+            total_us = int(cumulative)
+    return total_us / 1e6, imported
+
+
+def main() -> int:
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    failed = False
+    for module, budget in BUDGETS.items():
+        seconds, imported = import_time(module)
+        budget *= scale
+        eager = [m for m in LAZY_MODULES if m in imported]
+        status = "ok"
+        if seconds > budget or eager:
+            status = "FAIL"
+            failed = True
+        print(f"{status:4} {module}: {seconds:.3f}s (budget {budget:.3f}s)")
+        if eager:
+            print(f"     imported eagerly: {', '.join(eager)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
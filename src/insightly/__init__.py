@@ -4,30 +4,96 @@
 Insightly AI Python SDK.
 This module provides a Python SDK for interacting with the Insightly AI API.
 
-
+Importing the package has no side effects, call `setup_logging()` to write
+the logs of a run to a file.
 """
 
 from loguru import logger
 import datetime
 import os
+import sys
 from pathlib import Path
+from typing import Optional
+
+from insightly import log
 
 __version__ = "0.1.0"
 __name__ = "Insightly"
 
 ROOT_PATH: str = str(Path(__file__).resolve()).split("src/", maxsplit=1)[0]
 
-date_folder: str = os.path.join(
-    ROOT_PATH, "logs", datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%SZ")
-)
+# id of the file sink added by setup_logging, so it is only added once
+_log_sink_id: Optional[int] = None
+
+
+def setup_logging(
+    log_dir: Optional[str] = None,
+    level: str = "DEBUG",
+    serialize: bool = True,
+    payload_bytes: Optional[int] = None,
+    sampling: Optional[dict[str, float]] = None,
+    stderr_level: Optional[str] = "DEBUG",
+) -> int:
+    """Configure the folder for log files.
+
+    Records are handed to a background thread that writes them, so the
+    caller never waits on the file. The default stderr sink of loguru writes
+    in the caller, it is replaced by one on the same background thread.
+
+    Parameters
+    ----------
+    log_dir : str, optional
+        Folder to write the log file to, a timestamped folder under logs/ by
+        default.
+    level : str, optional
+        Minimum level written to the file.
+    serialize : bool, optional
+        Write one JSON record per line instead of plain text.
+    payload_bytes : int, optional
+        Bytes of a DataFrame, prompt or query kept in a message, see
+        `insightly.log.summarise`.
+    sampling : dict[str, float], optional
+        Fraction of the debug and info records kept per module, see
+        `insightly.log.SamplingFilter`.
+    stderr_level : str, optional
+        Minimum level written to stderr, None to only write the file.
+
+    Returns
+    -------
+    int
+        The id of the loguru sink.
+    """
+    global _log_sink_id
+    if _log_sink_id is not None:
+        return _log_sink_id
+
+    date_folder: str = log_dir or os.path.join(
+        ROOT_PATH, "logs", datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%SZ")
+    )
+
+    if not os.path.exists(date_folder):
+        os.makedirs(date_folder)
+
+    if payload_bytes is not None:
+        log.LOG_PAYLOAD_BYTES = payload_bytes
 
-if not os.path.exists(date_folder):
-    os.makedirs(date_folder)
+    try:
+        logger.remove(0)
+    except ValueError:
+        # the application already replaced the default sink
+        pass
+    else:
+        if stderr_level is not None:
+            logger.add(sys.stderr, level=stderr_level, enqueue=True)
 
-# configure folder for log files
-logger.add(
-    os.path.join(date_folder, f"{__name__}.log"),
-    rotation="500 MB",
-    level="DEBUG",
-    retention="10 days",
-)
+    # configure folder for log files
+    _log_sink_id = logger.add(
+        os.path.join(date_folder, f"{__name__}.log"),
+        rotation="500 MB",
+        level=level,
+        retention="10 days",
+        enqueue=True,
+        serialize=serialize,
+        filter=log.SamplingFilter(sampling) if sampling else None,
+    )
+    return _log_sink_id
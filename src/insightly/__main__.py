@@ -1,20 +1,35 @@
+import argparse
 from loguru import logger
-from typing import Any
+from typing import Any, Optional
 from pathlib import Path
 
 from dotenv import load_dotenv
+from insightly import setup_logging
+from insightly.history import QueryHistory, setup_query_history
+from insightly.repairs import setup_repair_rules
+from insightly.log import summarise
 from insightly.insightly import Insightly
 from insightly.workflow import create_and_compile_workflow, ask
+from insightly.utils import (
+    DELTA_COMPRESSION,
+    DELTA_TARGET_FILE_SIZE,
+    DELTA_VACUUM_RETENTION_HOURS,
+    INGEST_BATCH_ROWS,
+)
 
 load_dotenv()
 
 ROOT_PATH: str = str(Path(__file__).resolve()).split("src")[0]
+QUERY_HISTORY_PATH: str = f"{ROOT_PATH}/logs/query_history.jsonl"
+REPAIR_RULES_PATH: str = f"{ROOT_PATH}/logs/repair_rules.jsonl"
 
 
-def main() -> None:
+def demo() -> None:
     """
-    Main function to demonstrate the usage of the Insightly class.
+    Demonstrates the usage of the Insightly class.
     """
+    setup_query_history(QUERY_HISTORY_PATH)
+    setup_repair_rules(REPAIR_RULES_PATH)
 
     path_to_csv: str = f"{ROOT_PATH}/data/titanic/train.csv"
     # print(insightly is insightly)
@@ -22,7 +37,7 @@ def main() -> None:
     insightly1.read_csv_to_duckdb(path_to_csv, "titanic")
     insightly2 = Insightly()
     logger.debug(insightly1 is insightly2)
-    logger.debug(Insightly().get_schema())
+    logger.debug(summarise(Insightly().get_schema()))
 
     _, app = create_and_compile_workflow()
 
@@ -38,10 +53,143 @@ def main() -> None:
     if result.get("meant_as_query", False):
         # if the SQL query was executed successfully, print the result
         logger.info(result["sql_query_info"]["success_response"])
-        logger.info("Result:", result["sql_query_info"]["query_result"])
+        logger.info(f"Result: {summarise(result['sql_query_info']['query_result'])}")
     else:
-        # if the plot was generated successfully, show the plot that was returned
-        result["plot_query_info"]["result"].show()
+        from insightly.plotting import build_figure
+
+        # if the plot was generated successfully, build it from the result and show it
+        build_figure(result["sql_query_info"], result["plot_query_info"]).show()
+
+
+def ingest(args: argparse.Namespace) -> None:
+    """
+    Loads a CSV file into a Delta table, see `insightly.delta.write_csv_to_delta`.
+    """
+    from insightly.delta import write_csv_to_delta
+
+    write_csv_to_delta(
+        args.csv,
+        args.table_uri,
+        partition_by=args.partition_by,
+        mode=args.mode,
+        target_file_size=args.target_file_size,
+        batch_rows=args.batch_rows,
+        compression=args.compression,
+    )
+
+
+def maintain(args: argparse.Namespace) -> None:
+    """
+    Compacts, z-orders and vacuums a Delta table, see
+    `insightly.delta.maintain_delta_table`.
+    """
+    from insightly.delta import MaintenancePolicy, maintain_delta_table
+
+    policy = MaintenancePolicy(
+        target_file_size=args.target_file_size,
+        z_order_columns=args.z_order,
+        retention_hours=args.retention_hours,
+    )
+    report = maintain_delta_table(
+        args.table_uri,
+        policy,
+        records=QueryHistory(args.history).records(),
+        dry_run=args.dry_run,
+        benchmark=not args.no_benchmark,
+        table_name=args.table_name,
+    )
+    print(report)
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    """
+    Parses the command line, without a command the demo is run.
+    """
+    parser = argparse.ArgumentParser(prog="insightly")
+    commands = parser.add_subparsers(dest="command")
+
+    ingest_parser = commands.add_parser(
+        "ingest", help="Load a CSV file into a Delta table on disk or S3/MinIO."
+    )
+    ingest_parser.add_argument("csv", help="The CSV file to load.")
+    ingest_parser.add_argument(
+        "table_uri", help="Local path or s3://bucket/path of the Delta table."
+    )
+    ingest_parser.add_argument(
+        "--partition-by",
+        nargs="+",
+        default=None,
+        help="Columns to partition the table by.",
+    )
+    ingest_parser.add_argument(
+        "--mode", choices=["overwrite", "append", "error"], default="overwrite"
+    )
+    ingest_parser.add_argument(
+        "--target-file-size",
+        type=int,
+        default=DELTA_TARGET_FILE_SIZE,
+        help="Bytes of data per Parquet file.",
+    )
+    ingest_parser.add_argument(
+        "--batch-rows",
+        type=int,
+        default=INGEST_BATCH_ROWS,
+        help="Rows read from the CSV file at a time.",
+    )
+    ingest_parser.add_argument("--compression", default=DELTA_COMPRESSION)
+
+    maintain_parser = commands.add_parser(
+        "maintain", help="Compact, z-order and vacuum a Delta table."
+    )
+    maintain_parser.add_argument(
+        "table_uri", help="Local path or s3://bucket/path of the Delta table."
+    )
+    maintain_parser.add_argument(
+        "--dry-run", action="store_true", help="Only report what would be done."
+    )
+    maintain_parser.add_argument(
+        "--z-order",
+        nargs="+",
+        default=None,
+        help="Columns to cluster by, the most filtered ones in the history by default.",
+    )
+    maintain_parser.add_argument(
+        "--target-file-size",
+        type=int,
+        default=DELTA_TARGET_FILE_SIZE,
+        help="Bytes of data per Parquet file.",
+    )
+    maintain_parser.add_argument(
+        "--retention-hours", type=int, default=DELTA_VACUUM_RETENTION_HOURS
+    )
+    maintain_parser.add_argument(
+        "--history",
+        default=QUERY_HISTORY_PATH,
+        help="Query history to infer the z-order columns from.",
+    )
+    maintain_parser.add_argument(
+        "--table-name",
+        default=None,
+        help="Name queries read the table under, the last part of the URI by default.",
+    )
+    maintain_parser.add_argument(
+        "--no-benchmark", action="store_true", help="Skip the scan benchmarks."
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """
+    Entry point of `python -m insightly`.
+    """
+    setup_logging()
+    args = parse_args(argv)
+    if args.command == "ingest":
+        ingest(args)
+    elif args.command == "maintain":
+        maintain(args)
+    else:
+        demo()
 
 
 if __name__ == "__main__":
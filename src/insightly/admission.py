@@ -0,0 +1,384 @@
+"""Admission control of the questions answered by the service.
+
+Every question holds one of a bounded number of slots while it is answered,
+and is only let in while the LLM tokens of the last minute stay under the
+rate limit of the provider. Questions waiting for a slot are queued per
+tenant and served in turns, so a burst from one tenant does not starve the
+others. A question that would wait longer than the maximum wait, or finds
+the queue full, is turned away with the seconds to wait before retrying.
+DuckDB queries take one of a bounded number of slots shared by the databases
+of the process.
+"""
+
+from __future__ import annotations
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from loguru import logger
+from typing import Any, Iterator, Optional
+
+from insightly.metrics import metrics
+from insightly.utils import (
+    ADMISSION_MAX_CONCURRENT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_MAX_WAIT_SECONDS,
+    DUCKDB_SLOTS,
+)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a question or query cannot be let in in time."""
+
+    def __init__(self, reason: str, retry_after: float) -> None:
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"{reason} Retry in {math.ceil(retry_after)} seconds.")
+
+
+class TokenBucket:
+    """
+    LLM tokens that can still be sent this minute.
+
+    The bucket refills continuously up to the tokens per minute and is
+    debited with the tokens the provider reported, so it can go below zero
+    after a large answer.
+
+    Attributes
+    ----------
+    per_minute : int
+        The tokens per minute of the provider.
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.per_minute = per_minute
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        """adds the tokens earned since the last update"""
+        now = time.monotonic()
+        self._tokens = min(
+            self.per_minute, self._tokens + (now - self._updated) * self.per_minute / 60
+        )
+        self._updated = now
+
+    def available(self) -> float:
+        """
+        The tokens that can be sent now.
+
+        Returns
+        -------
+        float
+            The tokens, negative while the last minute was over the limit.
+        """
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def seconds_until_available(self) -> float:
+        """
+        Seconds until tokens can be sent again.
+
+        Returns
+        -------
+        float
+            0 if tokens are available now.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens > 0:
+                return 0.0
+            return (1 - self._tokens) * 60 / self.per_minute
+
+    def consume(self, tokens: float) -> None:
+        """
+        Debits the tokens of an LLM call.
+
+        Parameters
+        ----------
+        tokens : float
+            The prompt and completion tokens of the call.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+
+
+class AdmissionController:
+    """
+    Slots of the questions and DuckDB queries of the process.
+
+    Attributes
+    ----------
+    max_concurrent : int
+        Questions answered at once.
+    max_queue : int
+        Questions waiting for a slot, further ones are turned away at once.
+    max_wait : float
+        Seconds a question or query may wait for its slot.
+    tokens : TokenBucket, optional
+        The LLM tokens per minute, None for no limit.
+    duckdb_slots : int
+        DuckDB queries run at once.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = ADMISSION_MAX_CONCURRENT,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        max_wait: float = ADMISSION_MAX_WAIT_SECONDS,
+        tokens_per_minute: Optional[int] = None,
+        duckdb_slots: int = DUCKDB_SLOTS,
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.duckdb_slots = duckdb_slots
+        self._cond = threading.Condition()
+        # waiting questions of each tenant, tenants in the order of their turn
+        self._queues: OrderedDict[str, deque[object]] = OrderedDict()
+        self._queued = 0
+        self._active = 0
+        self._duckdb = threading.BoundedSemaphore(duckdb_slots)
+        self._duckdb_active = 0
+        self._duckdb_lock = threading.Lock()
+
+    def _report(self, tenant: str) -> None:
+        """updates the gauges, under the lock"""
+        metrics.set("admission_queue_depth", self._queued)
+        metrics.set(
+            "admission_queue_depth", len(self._queues.get(tenant, ())), tenant=tenant
+        )
+        metrics.set("admission_active", self._active)
+        if self.tokens is not None:
+            metrics.set("llm_tokens_available", self.tokens.available())
+
+    def _retry_after(self) -> float:
+        """seconds until a slot is likely to be free"""
+        held = metrics.percentile("admission_held_seconds", 50)
+        if held is None:
+            seconds = self.max_wait
+        else:
+            seconds = held * (self._queued + 1) / self.max_concurrent
+        if self.tokens is not None:
+            seconds = max(seconds, self.tokens.seconds_until_available())
+        return max(1.0, seconds)
+
+    def _admissible(self, tenant: str, ticket: object) -> bool:
+        """whether the ticket is next in line and a slot and tokens are free"""
+        if self._active >= self.max_concurrent:
+            return False
+        if self.tokens is not None and self.tokens.available() <= 0:
+            return False
+        turn = next(iter(self._queues))
+        return turn == tenant and self._queues[tenant][0] is ticket
+
+    def _leave(self, tenant: str, ticket: object) -> None:
+        """removes a ticket from the queue of its tenant, under the lock"""
+        queue = self._queues.pop(tenant)
+        queue.remove(ticket)
+        self._queued -= 1
+        if queue:
+            # the tenant had its turn, or gave it up, and goes to the back
+            self._queues[tenant] = queue
+
+    def acquire(self, tenant: str) -> float:
+        """
+        Waits for the turn of a question.
+
+        Parameters
+        ----------
+        tenant : str
+            Who asked the question, i.e. the workspace.
+
+        Returns
+        -------
+        float
+            The time the question was let in, to pass to `release`.
+
+        Raises
+        ------
+        AdmissionRejected
+            If the queue is full or the question waited for `max_wait`.
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            if self._queued >= self.max_queue:
+                metrics.increment("admission_rejected", reason="queue_full")
+                raise AdmissionRejected("Too many questions.", self._retry_after())
+            ticket = object()
+            self._queues.setdefault(tenant, deque()).append(ticket)
+            self._queued += 1
+            self._report(tenant)
+            start = time.monotonic()
+            while not self._admissible(tenant, ticket):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._leave(tenant, ticket)
+                    self._report(tenant)
+                    # the next in line may be admissible now
+                    self._cond.notify_all()
+                    if self.tokens is not None and self.tokens.available() <= 0:
+                        reason = "tokens"
+                        message = "The LLM token rate limit is reached."
+                    else:
+                        reason = "timeout"
+                        message = "Timed out waiting for a slot."
+                    metrics.increment("admission_rejected", reason=reason)
+                    raise AdmissionRejected(message, self._retry_after())
+                if self.tokens is not None and self.tokens.available() <= 0:
+                    # tokens come back with time, nobody signals them
+                    remaining = min(remaining, self.tokens.seconds_until_available())
+                self._cond.wait(remaining)
+            self._leave(tenant, ticket)
+            self._active += 1
+            self._report(tenant)
+            self._cond.notify_all()
+        admitted = time.monotonic()
+        metrics.observe("admission_wait_seconds", admitted - start)
+        return admitted
+
+    def release(self, admitted: float) -> None:
+        """
+        Frees the slot of a question that was answered.
+
+        Parameters
+        ----------
+        admitted : float
+            The time returned by `acquire`.
+
+        Returns
+        -------
+        None
+        """
+        metrics.observe("admission_held_seconds", time.monotonic() - admitted)
+        with self._cond:
+            self._active -= 1
+            metrics.set("admission_active", self._active)
+            self._cond.notify_all()
+
+    @contextmanager
+    def admitted(self, tenant: str) -> Iterator[None]:
+        """
+        Holds a slot while a question is answered.
+
+        Parameters
+        ----------
+        tenant : str
+            Who asked the question.
+
+        Raises
+        ------
+        AdmissionRejected
+            If the question cannot be let in in time.
+        """
+        admitted = self.acquire(tenant)
+        try:
+            yield
+        finally:
+            self.release(admitted)
+
+    @contextmanager
+    def duckdb_slot(self) -> Iterator[None]:
+        """
+        Holds a DuckDB slot while a query runs.
+
+        Raises
+        ------
+        AdmissionRejected
+            If no slot was free within `max_wait`.
+        """
+        if not self._duckdb.acquire(timeout=self.max_wait):
+            metrics.increment("admission_rejected", reason="duckdb")
+            raise AdmissionRejected("The database is busy.", self._retry_after())
+        with self._duckdb_lock:
+            self._duckdb_active += 1
+            metrics.set("duckdb_queries_active", self._duckdb_active)
+        try:
+            yield
+        finally:
+            with self._duckdb_lock:
+                self._duckdb_active -= 1
+                metrics.set("duckdb_queries_active", self._duckdb_active)
+            self._duckdb.release()
+
+    def consume_tokens(self, tokens: float) -> None:
+        """
+        Debits the tokens of an LLM call from the rate limit.
+
+        Parameters
+        ----------
+        tokens : float
+            The prompt and completion tokens of the call.
+
+        Returns
+        -------
+        None
+        """
+        if self.tokens is not None:
+            self.tokens.consume(tokens)
+
+    def describe(self) -> dict[str, Any]:
+        """
+        The limits, for the logs.
+
+        Returns
+        -------
+        dict[str, Any]
+            The limits of the controller.
+        """
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "max_wait": self.max_wait,
+            "tokens_per_minute": self.tokens.per_minute if self.tokens else None,
+            "duckdb_slots": self.duckdb_slots,
+        }
+
+
+# the controller of this process, with the default limits until setup_admission
+admission_controller = AdmissionController()
+
+
+def setup_admission(
+    max_concurrent: int = ADMISSION_MAX_CONCURRENT,
+    max_queue: int = ADMISSION_MAX_QUEUE,
+    max_wait: float = ADMISSION_MAX_WAIT_SECONDS,
+    tokens_per_minute: Optional[int] = None,
+    duckdb_slots: int = DUCKDB_SLOTS,
+) -> AdmissionController:
+    """
+    Sets the limits of the questions and queries of the process.
+
+    Parameters
+    ----------
+    max_concurrent : int, optional
+        Questions answered at once.
+    max_queue : int, optional
+        Questions waiting for a slot.
+    max_wait : float, optional
+        Seconds a question or query may wait for its slot.
+    tokens_per_minute : int, optional
+        LLM tokens per minute of the provider, no limit by default.
+    duckdb_slots : int, optional
+        DuckDB queries run at once.
+
+    Returns
+    -------
+    AdmissionController
+        The controller now in use.
+    """
+    global admission_controller
+    admission_controller = AdmissionController(
+        max_concurrent, max_queue, max_wait, tokens_per_minute, duckdb_slots
+    )
+    logger.info(f"Admission limits: {admission_controller.describe()}")
+    return admission_controller
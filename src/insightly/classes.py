@@ -1,15 +1,20 @@
 """Insightly classes for the Insightly agent."""
 
 from enum import Enum
-from typing import TypedDict, Optional, TypeVar, Any
+from typing import TypedDict, Optional, TypeVar, Any, Union
 from abc import ABC, abstractmethod
 
-import pandas as pd
 from loguru import logger
 from pydantic import BaseModel
 from langchain_core.runnables.config import RunnableConfig
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+
+import insightly.admission as admission
+import insightly.models as models
+from insightly.log import summarise
+from insightly.metrics import metrics
+from insightly.prompts import check_budget, record_usage
+from insightly.resilience import call_llm
+from insightly.utils import PROMPT_TOKEN_BUDGET
 
 T = TypeVar("T", bound=BaseModel)
 
@@ -41,6 +46,63 @@ class PlotType(str, Enum):
     # HEATMAP = "HEATMAP"
 
 
+class ResultColumn(TypedDict):
+    """A column of a query result.
+
+    Attributes
+    ----------
+    name : str
+        The name of the column.
+    type : str
+        The DuckDB type of the column.
+    """
+
+    name: str
+    type: str
+
+
+class ResultHandle(TypedDict):
+    """Reference to the rows of a query result stored in DuckDB.
+
+    The rows stay in the result table, nodes read them from DuckDB when they
+    need more than the preview.
+
+    Attributes
+    ----------
+    table_name : str
+        The table holding the rows.
+    row_count : int
+        The number of rows.
+    columns : list[ResultColumn]
+        The columns and their types.
+    preview : dict[str, list]
+        The first rows as column arrays.
+    """
+
+    table_name: str
+    row_count: int
+    columns: list[ResultColumn]
+    preview: dict[str, list]
+
+
+class RepairAttempt(TypedDict):
+    """A failed SQL query the repair node fixed.
+
+    Attributes
+    ----------
+    sql_query : str
+        The query that failed.
+    error : str
+        The error it failed with.
+    from_rule : bool
+        Whether the fix came from a learned rule rather than the model.
+    """
+
+    sql_query: str
+    error: str
+    from_rule: bool
+
+
 class SqlQueryInfo(TypedDict):
     """Information regarding the SQL query performed on the request.
 
@@ -48,8 +110,9 @@ class SqlQueryInfo(TypedDict):
     ----------
     sql_query : str
         The SQL query that was executed.
-    query_result : pd.DataFrame
-        The result of the SQL query. (dataframe)
+    query_result : ResultHandle | str
+        A handle to the rows of the result, or a message for errors and
+        statements without rows.
     success_response : str
         The success response from the SQL query. (natural languages)
     table_name : str
@@ -58,14 +121,17 @@ class SqlQueryInfo(TypedDict):
         The rows returned from the SQL query.
     sql_error : bool
         Indicates whether there was an error in the SQL query.
+    repair : RepairAttempt, optional
+        The failed query the current query was repaired from.
     """
 
     sql_query: str
-    query_result: pd.DataFrame
+    query_result: Union[ResultHandle, str]
     success_response: str
     table_name: str
     query_rows: list
     sql_error: bool
+    repair: Optional[RepairAttempt]
 
 
 class PlotQueryInfo(TypedDict):
@@ -78,7 +144,8 @@ class PlotQueryInfo(TypedDict):
     columns: list
         The columns that were used in the plot
     result: str
-        The result of the SQL query
+        Unused, figures are built from the result table when they are
+        returned (see `insightly.plotting.build_figure`).
     """
 
     plot_type: str
@@ -100,9 +167,17 @@ class AgentState(TypedDict):
     plot_query_info: PlotQueryInfo
         Information regarding the plot query performed on the request.
     attempts: int
-        The number of attempts made to answer the question.
+        The number of times a failed query was repaired.
     relevance: str
         Indicates whether the question is related to the database schema.
+    fast_path: bool
+        Indicates whether the query and plot came from a template rather
+        than the LLM.
+    database: str
+        The database the question was asked about, a resumed run must
+        continue on the same one.
+    tenant: str, optional
+        Who asked the question, only they may resume the run.
     """
 
     question: str
@@ -111,6 +186,9 @@ class AgentState(TypedDict):
     plot_query_info: Optional[PlotQueryInfo] = None
     attempts: int
     relevance: str
+    fast_path: bool
+    database: str
+    tenant: Optional[str]
 
 
 class Node(ABC):
@@ -149,6 +227,8 @@ class ChatGPTNodeBase(Node, ABC):
     """
 
     OutputClass: BaseModel  # generic type for the class
+    # tokens of a prompt above which the node logs a warning
+    token_budget: int = PROMPT_TOKEN_BUDGET
 
     def __init__(self, OutputClass: BaseModel) -> None:
         """
@@ -157,17 +237,38 @@ class ChatGPTNodeBase(Node, ABC):
         self.OutputClass = OutputClass
 
     def run_chatgpt(self, question: str, system: str) -> BaseModel:
+        from langchain_core.prompts import ChatPromptTemplate
+
+        node = type(self).__name__
+        check_budget(node, system, question, self.token_budget)
+        # the model of the node, see insightly.models
+        config = models.model_router.config_for(node)
         convert_prompt = ChatPromptTemplate.from_messages(
             [
                 ("system", system),
                 ("human", question),
             ]
         )
-        llm = ChatOpenAI(temperature=0)
-        structured_llm = llm.with_structured_output(self.OutputClass)
-        sql_generator = convert_prompt | structured_llm
-        result = sql_generator.invoke({})
-        return result
+
+        def request(timeout: Optional[float]) -> dict:
+            llm = models.model_router.client(config, timeout)
+            # the raw message carries the token usage, cached tokens included
+            structured_llm = llm.with_structured_output(
+                self.OutputClass, include_raw=True
+            )
+            sql_generator = convert_prompt | structured_llm
+            return sql_generator.invoke({})
+
+        # retried, hedged and timed per request, see insightly.resilience
+        output = call_llm(request, node, config)
+        metrics.increment("llm_calls", node=node, model=config.model)
+        usage = getattr(output["raw"], "usage_metadata", None)
+        record_usage(node, config.model, usage)
+        if usage:
+            admission.admission_controller.consume_tokens(usage.get("total_tokens", 0))
+        if output["parsing_error"] is not None:
+            raise output["parsing_error"]
+        return output["parsed"]
 
     @abstractmethod
     def init_query(self, state: AgentState, config: RunnableConfig) -> str:
@@ -184,7 +285,7 @@ class ChatGPTNodeBase(Node, ABC):
     def run(self, state: AgentState, config: RunnableConfig) -> AgentState:
         """Run the node to get an output and an AgentState."""
         system = self.init_query(state, config)
-        logger.debug(f"Running node with question: {system}")
+        logger.debug(f"Running node with question: {summarise(system)}")
         result: T = self.run_chatgpt(
             question=state["question"],
             system=system,
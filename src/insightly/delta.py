@@ -0,0 +1,715 @@
+"""Loading and maintaining Delta tables on local disk or S3-compatible storage.
+
+CSV files are streamed through DuckDB in Arrow record batches and written
+with the deltalake library, so neither a JVM nor the whole file in memory is
+needed. Tables that grew through many appends are compacted and z-ordered
+with `maintain_delta_table`, and DuckDB copies of Delta tables are kept up to
+date by applying only the commits made since they were loaded.
+"""
+
+from __future__ import annotations
+import os
+import time
+from dataclasses import dataclass, field
+from loguru import logger
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+import duckdb
+
+from insightly.history import QueryRecord, filtered_columns
+from insightly.utils import (
+    DELTA_COMPRESSION,
+    DELTA_MIRRORS_TABLE,
+    DELTA_TARGET_FILE_SIZE,
+    DELTA_VACUUM_RETENTION_HOURS,
+    DELTA_ZORDER_COLUMNS,
+    INGEST_BATCH_ROWS,
+    import_pyarrow,
+    quote_identifier,
+)
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from deltalake import DeltaTable
+    from insightly.insightly import Insightly
+
+# operations that rewrite files without changing the rows of a table
+LAYOUT_OPERATIONS: frozenset[str] = frozenset({"OPTIMIZE", "VACUUM START", "VACUUM END"})
+# columns load_cdf adds to the rows of the change data feed
+CDF_COLUMNS: tuple[str, ...] = ("_change_type", "_commit_version", "_commit_timestamp")
+
+
+@dataclass
+class IngestReport:
+    """Outcome of loading a file into a Delta table.
+
+    Attributes
+    ----------
+    table_uri : str
+        The Delta table that was written.
+    version : int
+        The version of the table after the write.
+    rows : int
+        The number of rows written.
+    files : int
+        The number of data files in the table after the write.
+    seconds : float
+        How long the load took.
+    """
+
+    table_uri: str
+    version: int
+    rows: int
+    files: int
+    seconds: float
+
+
+def storage_options(table_uri: str) -> Optional[dict[str, str]]:
+    """
+    Storage options for a Delta table, read from the environment.
+
+    S3 tables use the same variables as the MinIO scripts: S3_ENDPOINT,
+    AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and optionally AWS_REGION.
+
+    Parameters
+    ----------
+    table_uri : str
+        Local path or s3:// URI of the table.
+
+    Returns
+    -------
+    dict[str, str], optional
+        The options, None for local tables.
+    """
+    if not table_uri.startswith(("s3://", "s3a://")):
+        return None
+    options = {
+        "AWS_REGION": os.getenv("AWS_REGION", "us-east-1"),
+        # MinIO has no locking provider, writers must not run concurrently
+        "AWS_S3_ALLOW_UNSAFE_RENAME": "true",
+    }
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        if os.getenv(name):
+            options[name] = os.environ[name]
+    endpoint = os.getenv("S3_ENDPOINT")
+    if endpoint:
+        if "://" not in endpoint:
+            endpoint = f"http://{endpoint}"
+        options["AWS_ENDPOINT_URL"] = endpoint
+        if endpoint.startswith("http://"):
+            options["AWS_ALLOW_HTTP"] = "true"
+    return options
+
+
+def _normalise_uri(table_uri: str) -> str:
+    """deltalake reads S3 tables from s3:// URIs, the Spark scripts use s3a://"""
+    if table_uri.startswith("s3a://"):
+        return "s3://" + table_uri[len("s3a://") :]
+    return table_uri
+
+
+def _csv_batches(
+    path_to_csv: str, batch_rows: int
+) -> tuple["pa.Schema", Iterator["pa.RecordBatch"], duckdb.DuckDBPyConnection]:
+    """Stream a CSV file as Arrow record batches, with types sniffed by DuckDB."""
+    conn = duckdb.connect()
+    reader = conn.execute(
+        "SELECT * FROM read_csv_auto(?)", [path_to_csv]
+    ).fetch_record_batch(batch_rows)
+    return reader.schema, iter(reader), conn
+
+
+def write_csv_to_delta(
+    path_to_csv: str,
+    table_uri: str,
+    partition_by: Optional[list[str]] = None,
+    mode: str = "overwrite",
+    target_file_size: int = DELTA_TARGET_FILE_SIZE,
+    batch_rows: int = INGEST_BATCH_ROWS,
+    compression: str = DELTA_COMPRESSION,
+) -> IngestReport:
+    """
+    Loads a CSV file into a partitioned, compressed Delta table.
+
+    Parameters
+    ----------
+    path_to_csv : str
+        The CSV file to load.
+    table_uri : str
+        Local path or s3:// URI of the Delta table.
+    partition_by : list[str], optional
+        Columns to partition the table by.
+    mode : str, optional
+        "overwrite" (default), "append" or "error" if the table exists.
+    target_file_size : int, optional
+        Bytes of data written per Parquet file.
+    batch_rows : int, optional
+        Rows read from the CSV file at a time, bounds the memory used.
+    compression : str, optional
+        Parquet compression codec, i.e. "ZSTD" or "SNAPPY".
+
+    Returns
+    -------
+    IngestReport
+        The version, number of rows and files of the written table.
+    """
+    if import_pyarrow() is None:
+        raise RuntimeError("pyarrow is required to write Delta tables.")
+    import pyarrow as pa
+    from deltalake import DeltaTable, WriterProperties, write_deltalake
+
+    table_uri = _normalise_uri(table_uri)
+    options = storage_options(table_uri)
+    start = time.perf_counter()
+    schema, batches, conn = _csv_batches(path_to_csv, batch_rows)
+    rows = 0
+
+    def counted() -> Iterator[pa.RecordBatch]:
+        nonlocal rows
+        for batch in batches:
+            rows += batch.num_rows
+            yield batch
+
+    try:
+        write_deltalake(
+            table_uri,
+            pa.RecordBatchReader.from_batches(schema, counted()),
+            partition_by=partition_by or None,
+            mode=mode,
+            storage_options=options,
+            target_file_size=target_file_size,
+            writer_properties=WriterProperties(compression=compression),
+        )
+    finally:
+        conn.close()
+
+    table = DeltaTable(table_uri, storage_options=options)
+    report = IngestReport(
+        table_uri=table_uri,
+        version=table.version(),
+        rows=rows,
+        files=len(table.file_uris()),
+        seconds=time.perf_counter() - start,
+    )
+    logger.info(
+        f"Wrote {report.rows} rows from {path_to_csv} to {table_uri} "
+        f"(version {report.version}, {report.files} files) in {report.seconds:.2f}s"
+    )
+    return report
+
+
+@dataclass
+class MaintenancePolicy:
+    """How a Delta table is maintained.
+
+    Attributes
+    ----------
+    target_file_size : int
+        Bytes of data per Parquet file after compaction.
+    z_order_columns : list[str], optional
+        Columns to cluster the data by, inferred from the query history
+        when None.
+    max_z_order_columns : int
+        Number of columns inferred from the query history.
+    retention_hours : int
+        Removed files younger than this are kept by vacuum.
+    """
+
+    target_file_size: int = DELTA_TARGET_FILE_SIZE
+    z_order_columns: Optional[list[str]] = None
+    max_z_order_columns: int = DELTA_ZORDER_COLUMNS
+    retention_hours: int = DELTA_VACUUM_RETENTION_HOURS
+
+
+@dataclass
+class MaintenanceReport:
+    """What maintenance did, or would do on a dry run, to a Delta table.
+
+    Attributes
+    ----------
+    table_uri : str
+        The maintained table.
+    dry_run : bool
+        True if the table was not changed.
+    files_before : int
+        Number of data files before maintenance.
+    small_files : int
+        Number of files smaller than half the target file size.
+    z_order_columns : list[str]
+        The columns the data was clustered by, empty if it was only compacted.
+    files_after : int, optional
+        Number of data files after maintenance.
+    vacuumed_files : list[str]
+        Files removed by vacuum, or that would be removed.
+    scan_seconds_before : float, optional
+        Time of the benchmark scans before maintenance, see `benchmark_scan`.
+    scan_seconds_after : float, optional
+        Time of the same scans after maintenance.
+    metrics : dict
+        The metrics returned by the optimize operation.
+    """
+
+    table_uri: str
+    dry_run: bool
+    files_before: int
+    small_files: int
+    z_order_columns: list[str]
+    files_after: Optional[int] = None
+    vacuumed_files: list[str] = field(default_factory=list)
+    scan_seconds_before: Optional[float] = None
+    scan_seconds_after: Optional[float] = None
+    metrics: dict[str, Any] = field(default_factory=dict)
+
+
+def infer_z_order_columns(
+    table: "DeltaTable",
+    records: list[QueryRecord],
+    max_columns: int,
+    table_name: Optional[str] = None,
+) -> list[str]:
+    """
+    Picks the columns of a table that queries filter on the most.
+
+    Partition columns are left out, the data is already split by them.
+
+    Parameters
+    ----------
+    table : DeltaTable
+        The table to cluster.
+    records : list[QueryRecord]
+        The executed queries.
+    max_columns : int
+        Maximum number of columns to return.
+    table_name : str, optional
+        The name queries read the table under, only their filters are
+        counted. All queries are counted when None.
+
+    Returns
+    -------
+    list[str]
+        The columns, most filtered first.
+    """
+    partition_columns = set(table.metadata().partition_columns)
+    columns = {f.name for f in table.schema().fields} - partition_columns
+    counts = filtered_columns(records, table_name)
+    return [c for c, _ in counts.most_common() if c in columns][:max_columns]
+
+
+def benchmark_filters(
+    table: "DeltaTable", columns: list[str]
+) -> list[tuple[str, Any, Any]]:
+    """
+    Picks a range filter on each column to benchmark scans with.
+
+    Each range holds about a tenth of the rows around the median, the kind
+    of filter z-ordering lets a scan skip most files for.
+
+    Parameters
+    ----------
+    table : DeltaTable
+        The table to scan.
+    columns : list[str]
+        The columns to filter on.
+
+    Returns
+    -------
+    list[tuple[str, Any, Any]]
+        The column, lower and upper bound of each filter.
+    """
+    if not columns:
+        return []
+    bounds = ", ".join(
+        f"quantile_disc({quote_identifier(c)}, [0.45, 0.55])" for c in columns
+    )
+    with duckdb.connect() as conn:
+        conn.register("delta_table", table.to_pyarrow_dataset())
+        row = conn.execute(f"SELECT {bounds} FROM delta_table").fetchone()
+    return [
+        (column, low, high)
+        for column, (low, high) in zip(columns, row)
+        if low is not None
+    ]
+
+
+def benchmark_scan(
+    table: "DeltaTable", filters: list[tuple[str, Any, Any]]
+) -> float:
+    """
+    Times filtered scans of a Delta table through DuckDB.
+
+    The filters are pushed down to the Arrow dataset, which skips the files
+    whose statistics are outside of the range.
+
+    Parameters
+    ----------
+    table : DeltaTable
+        The table to scan.
+    filters : list[tuple[str, Any, Any]]
+        The ranges to scan, see `benchmark_filters`. The whole table is
+        scanned when empty.
+
+    Returns
+    -------
+    float
+        Seconds the scans took together.
+    """
+    dataset = table.to_pyarrow_dataset()
+    with duckdb.connect() as conn:
+        conn.register("delta_table", dataset)
+        start = time.perf_counter()
+        if not filters:
+            conn.execute("SELECT count(*) FROM delta_table").fetchall()
+        for column, low, high in filters:
+            conn.execute(
+                f"SELECT count(*) FROM delta_table "
+                f"WHERE {quote_identifier(column)} BETWEEN ? AND ?",
+                [low, high],
+            ).fetchall()
+        return time.perf_counter() - start
+
+
+def maintain_delta_table(
+    table_uri: str,
+    policy: Optional[MaintenancePolicy] = None,
+    records: Optional[list[QueryRecord]] = None,
+    dry_run: bool = False,
+    benchmark: bool = True,
+    table_name: Optional[str] = None,
+) -> MaintenanceReport:
+    """
+    Compacts small files, z-orders and vacuums a Delta table.
+
+    The data is z-ordered, which also compacts it, when there are columns
+    to cluster by, otherwise the small files are only compacted.
+
+    Parameters
+    ----------
+    table_uri : str
+        Local path or s3:// URI of the Delta table.
+    policy : MaintenancePolicy, optional
+        File size, z-order columns and retention, the defaults otherwise.
+    records : list[QueryRecord], optional
+        Executed queries to infer the z-order columns from.
+    dry_run : bool, optional
+        Only report what would be done.
+    benchmark : bool, optional
+        Time scans filtering on the z-order columns before and after
+        maintenance.
+    table_name : str, optional
+        The name queries read the table under, only their filters are used
+        to infer the z-order columns. The last part of the URI by default.
+
+    Returns
+    -------
+    MaintenanceReport
+        What was done, or would be done on a dry run.
+    """
+    from deltalake import DeltaTable, WriterProperties
+
+    policy = policy or MaintenancePolicy()
+    table_uri = _normalise_uri(table_uri)
+    table = DeltaTable(table_uri, storage_options=storage_options(table_uri))
+
+    z_order_columns = policy.z_order_columns
+    if z_order_columns is None:
+        z_order_columns = infer_z_order_columns(
+            table,
+            records or [],
+            policy.max_z_order_columns,
+            table_name or os.path.basename(table_uri.rstrip("/")),
+        )
+    sizes = table.get_add_actions(flatten=True).column("size_bytes").to_pylist()
+    report = MaintenanceReport(
+        table_uri=table_uri,
+        dry_run=dry_run,
+        files_before=len(sizes),
+        small_files=sum(size < policy.target_file_size // 2 for size in sizes),
+        z_order_columns=z_order_columns,
+    )
+    if benchmark:
+        # the same ranges before and after, picked on the data as it is now
+        filters = benchmark_filters(table, z_order_columns)
+        report.scan_seconds_before = benchmark_scan(table, filters)
+
+    if dry_run:
+        report.vacuumed_files = table.vacuum(
+            retention_hours=policy.retention_hours, dry_run=True
+        )
+        logger.info(f"Maintenance dry run: {report}")
+        return report
+
+    writer_properties = WriterProperties(compression=DELTA_COMPRESSION)
+    if z_order_columns:
+        report.metrics = table.optimize.z_order(
+            z_order_columns,
+            target_size=policy.target_file_size,
+            writer_properties=writer_properties,
+        )
+    else:
+        report.metrics = table.optimize.compact(
+            target_size=policy.target_file_size,
+            writer_properties=writer_properties,
+        )
+    report.vacuumed_files = table.vacuum(
+        retention_hours=policy.retention_hours, dry_run=False
+    )
+    table.update_incremental()
+    report.files_after = len(table.file_uris())
+    if benchmark:
+        report.scan_seconds_after = benchmark_scan(table, filters)
+    logger.info(
+        f"Maintained {table_uri}: {report.files_before} -> {report.files_after} "
+        f"files, z-ordered by {z_order_columns or 'nothing'}, "
+        f"{len(report.vacuumed_files)} files vacuumed"
+    )
+    return report
+
+
+def _save_mirror(
+    cursor: duckdb.DuckDBPyConnection,
+    table_name: str,
+    table_uri: str,
+    version: int,
+    key_columns: Optional[list[str]],
+) -> None:
+    """Record the Delta table and version a DuckDB table was loaded from."""
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {DELTA_MIRRORS_TABLE} (
+            table_name VARCHAR PRIMARY KEY,
+            table_uri VARCHAR,
+            version BIGINT,
+            key_columns VARCHAR[]
+        )
+        """
+    )
+    cursor.execute(
+        f"INSERT OR REPLACE INTO {DELTA_MIRRORS_TABLE} VALUES (?, ?, ?, ?)",
+        [table_name, table_uri, version, key_columns],
+    )
+
+
+def mirror_delta_table(
+    insightly: "Insightly",
+    table_uri: str,
+    table_name: str,
+    key_columns: Optional[list[str]] = None,
+) -> int:
+    """
+    Copies a Delta table into DuckDB and records the version that was loaded.
+
+    Parameters
+    ----------
+    insightly : Insightly
+        The database to copy the table into.
+    table_uri : str
+        Local path or s3:// URI of the Delta table.
+    table_name : str
+        The DuckDB table to create or replace.
+    key_columns : list[str], optional
+        Columns identifying a row, needed to apply updates and deletes, see
+        `refresh_delta_mirror`.
+
+    Returns
+    -------
+    int
+        The Delta version that was loaded.
+    """
+    from deltalake import DeltaTable
+
+    table_uri = _normalise_uri(table_uri)
+    table = DeltaTable(table_uri, storage_options=storage_options(table_uri))
+    cursor = insightly.conn.cursor()
+    try:
+        cursor.register("delta_source", table.to_pyarrow_dataset())
+        cursor.execute("BEGIN TRANSACTION")
+        cursor.execute(
+            f"CREATE OR REPLACE TABLE {quote_identifier(table_name)} AS "
+            "SELECT * FROM delta_source"
+        )
+        _save_mirror(cursor, table_name, table_uri, table.version(), key_columns)
+        cursor.execute("COMMIT")
+    finally:
+        cursor.close()
+    logger.info(f"Loaded {table_uri} version {table.version()} into {table_name}")
+    return table.version()
+
+
+def _rows_changed(table: "DeltaTable", since_version: int) -> bool:
+    """whether any commit after `since_version` changed rows, compaction,
+    z-ordering and vacuum only move them between files"""
+    return any(
+        commit["version"] > since_version
+        and commit.get("operation") not in LAYOUT_OPERATIONS
+        for commit in table.history()
+    )
+
+
+def _apply_change_feed(
+    cursor: duckdb.DuckDBPyConnection,
+    table: "DeltaTable",
+    table_name: str,
+    since_version: int,
+    key_columns: list[str],
+) -> int:
+    """apply the inserts, updates and deletes of the change data feed commit
+    by commit, rows are matched on the key columns"""
+    changes = table.load_cdf(
+        starting_version=since_version + 1, ending_version=table.version()
+    ).read_all()
+    cursor.register("delta_changes", changes)
+    target = quote_identifier(table_name)
+    data_columns = [c for c in changes.column_names if c not in CDF_COLUMNS]
+    match = " AND ".join(
+        f"{target}.{column} IS NOT DISTINCT FROM changes.{column}"
+        for column in map(quote_identifier, key_columns)
+    )
+    selected = ", ".join(quote_identifier(c) for c in data_columns)
+    changed = 0
+    for version in sorted(set(changes.column("_commit_version").to_pylist())):
+        # rows deleted or replaced by the commit, then the rows it wrote
+        changed += cursor.execute(
+            f"""
+            DELETE FROM {target} WHERE EXISTS (
+                SELECT 1 FROM delta_changes AS changes
+                WHERE changes._commit_version = ?
+                AND changes._change_type IN ('delete', 'update_preimage')
+                AND {match}
+            )
+            """,
+            [version],
+        ).fetchone()[0]
+        changed += cursor.execute(
+            f"""
+            INSERT INTO {target} BY NAME
+            SELECT {selected} FROM delta_changes
+            WHERE _commit_version = ?
+            AND _change_type IN ('insert', 'update_postimage')
+            """,
+            [version],
+        ).fetchone()[0]
+    return changed
+
+
+def _apply_added_files(
+    cursor: duckdb.DuckDBPyConnection,
+    table: "DeltaTable",
+    table_name: str,
+    since_version: int,
+) -> int:
+    """insert the rows of the files added since a version, reloading the whole
+    table if files were removed, as the rows that changed are then unknown"""
+    import pyarrow.dataset as ds
+    from deltalake import DeltaTable
+
+    target = quote_identifier(table_name)
+    loaded = DeltaTable(
+        table.table_uri,
+        version=since_version,
+        storage_options=storage_options(table.table_uri),
+    )
+    loaded_paths = set(loaded.get_add_actions(flatten=True).column("path").to_pylist())
+    paths = set(table.get_add_actions(flatten=True).column("path").to_pylist())
+    dataset = table.to_pyarrow_dataset()
+
+    if loaded_paths - paths:
+        logger.warning(
+            f"Files were removed from {table.table_uri} since version "
+            f"{since_version}, reloading {table_name}"
+        )
+        cursor.register("delta_source", dataset)
+        cursor.execute(f"DELETE FROM {target}")
+        return cursor.execute(
+            f"INSERT INTO {target} BY NAME SELECT * FROM delta_source"
+        ).fetchone()[0]
+
+    added = paths - loaded_paths
+    # add actions hold paths relative to the table root, one folder per
+    # partition column
+    depth = len(table.metadata().partition_columns) + 1
+    fragments = [
+        f
+        for f in dataset.get_fragments()
+        if "/".join(f.path.split("/")[-depth:]) in added
+    ]
+    cursor.register(
+        "delta_added",
+        ds.FileSystemDataset(
+            fragments, dataset.schema, dataset.format, dataset.filesystem
+        ),
+    )
+    return cursor.execute(
+        f"INSERT INTO {target} BY NAME SELECT * FROM delta_added"
+    ).fetchone()[0]
+
+
+def refresh_delta_mirror(insightly: "Insightly", table_name: str) -> int:
+    """
+    Brings a table copied with `mirror_delta_table` up to the latest version.
+
+    Only the commits since the loaded version are read: from the change data
+    feed when the Delta table has it enabled and the copy has key columns,
+    otherwise the files added since then. Updates and deletes need both,
+    without them a table whose files were rewritten is reloaded in full, as
+    a deleted row cannot be told apart from its identical duplicates.
+
+    Parameters
+    ----------
+    insightly : Insightly
+        The database holding the copy.
+    table_name : str
+        The DuckDB table to refresh.
+
+    Returns
+    -------
+    int
+        The number of rows inserted or deleted, updates count twice.
+    """
+    from deltalake import DeltaTable
+
+    cursor = insightly.conn.cursor()
+    try:
+        try:
+            mirror = cursor.execute(
+                f"SELECT table_uri, version, key_columns FROM {DELTA_MIRRORS_TABLE} "
+                "WHERE table_name = ?",
+                [table_name],
+            ).fetchone()
+        except duckdb.CatalogException:
+            mirror = None
+        if mirror is None:
+            raise ValueError(f"{table_name} was not loaded from a Delta table.")
+        table_uri, loaded_version, key_columns = mirror
+
+        start = time.perf_counter()
+        table = DeltaTable(table_uri, storage_options=storage_options(table_uri))
+        version = table.version()
+        if version == loaded_version:
+            return 0
+
+        cursor.execute("BEGIN TRANSACTION")
+        try:
+            if not _rows_changed(table, loaded_version):
+                changed = 0
+            elif (
+                key_columns
+                and table.metadata().configuration.get("delta.enableChangeDataFeed")
+                == "true"
+            ):
+                changed = _apply_change_feed(
+                    cursor, table, table_name, loaded_version, key_columns
+                )
+            else:
+                changed = _apply_added_files(cursor, table, table_name, loaded_version)
+            _save_mirror(cursor, table_name, table_uri, version, key_columns)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        cursor.close()
+    logger.info(
+        f"Refreshed {table_name} from version {loaded_version} to {version} of "
+        f"{table_uri}: {changed} rows changed in {time.perf_counter() - start:.2f}s"
+    )
+    return changed
@@ -0,0 +1,236 @@
+"""Serialisation and caching of plot figures for the API responses."""
+
+from __future__ import annotations
+import gzip
+import threading
+from collections import OrderedDict
+from enum import Enum
+from typing import TYPE_CHECKING, Hashable, Optional
+
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses fall back to gzip
+    brotli = None
+
+# number of serialised figures kept in memory
+FIGURE_CACHE_SIZE: int = 128
+# responses smaller than this are not worth compressing
+MIN_COMPRESS_BYTES: int = 1024
+# trace attributes holding the data points
+DATA_ATTRIBUTES: tuple[str, ...] = ("x", "y", "z")
+# size of static images, as in scripts/generate_business_graph.py
+IMAGE_WIDTH: int = 1600
+IMAGE_HEIGHT: int = 900
+
+
+class FigureFormat(str, Enum):
+    """Format a figure is returned in.
+
+    Attributes
+    ----------
+    HTML : str
+        Full HTML page loading plotly.js from the CDN.
+    JSON : str
+        Compact figure JSON with numeric data as base64 typed arrays.
+    PNG : str
+        Static image, needs kaleido.
+    """
+
+    HTML = "html"
+    JSON = "json"
+    PNG = "png"
+
+    @property
+    def media_type(self) -> str:
+        """The media type of the serialised figure."""
+        return {
+            FigureFormat.HTML: "text/html",
+            FigureFormat.JSON: "application/json",
+            FigureFormat.PNG: "image/png",
+        }[self]
+
+
+def _as_typed_arrays(figure: go.Figure) -> go.Figure:
+    """Turn numeric data stored as lists into numpy arrays.
+
+    Plotly serialises numpy arrays as base64 encoded typed arrays, which are
+    far smaller and faster to encode and parse than lists of numbers.
+
+    Parameters
+    ----------
+    figure : go.Figure
+        The figure to convert, changed in place.
+
+    Returns
+    -------
+    go.Figure
+        The same figure.
+    """
+    import numpy as np
+
+    for trace in figure.data:
+        for attribute in DATA_ATTRIBUTES:
+            values = getattr(trace, attribute, None)
+            if values is None or isinstance(values, np.ndarray):
+                continue
+            array = np.asarray(values)
+            if array.dtype.kind in "biuf":
+                setattr(trace, attribute, array)
+    return figure
+
+
+def serialise_figure(figure: go.Figure, figure_format: FigureFormat) -> bytes:
+    """Serialise a figure for the response.
+
+    Parameters
+    ----------
+    figure : go.Figure
+        The figure to serialise.
+    figure_format : FigureFormat
+        The format to serialise to.
+
+    Returns
+    -------
+    bytes
+        The UTF-8 encoded figure, or the image bytes for PNG.
+    """
+    if figure_format == FigureFormat.PNG:
+        return figure.to_image(format="png", width=IMAGE_WIDTH, height=IMAGE_HEIGHT)
+    if figure_format == FigureFormat.JSON:
+        import plotly.io as pio
+
+        # the "auto" engine uses orjson when it is installed
+        return pio.to_json(
+            _as_typed_arrays(figure), validate=False, pretty=False, engine="auto"
+        ).encode()
+    return figure.to_html(full_html=True, include_plotlyjs="cdn").encode()
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick the content encoding to compress a response with.
+
+    Parameters
+    ----------
+    accept_encoding : str, optional
+        The Accept-Encoding header of the request.
+
+    Returns
+    -------
+    str, optional
+        "br", "gzip" or None if the client accepts neither.
+    """
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        accepted.add(coding.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: Optional[str]) -> tuple[bytes, Optional[str]]:
+    """Compress a response body.
+
+    Parameters
+    ----------
+    body : bytes
+        The body to compress.
+    encoding : str, optional
+        The encoding returned by `negotiate_encoding`.
+
+    Returns
+    -------
+    tuple[bytes, Optional[str]]
+        The body and the encoding that was applied, if any.
+    """
+    if encoding is None or len(body) < MIN_COMPRESS_BYTES:
+        return body, None
+    if encoding == "br":
+        return brotli.compress(body, quality=5), "br"
+    return gzip.compress(body, compresslevel=5), "gzip"
+
+
+class FigureCache:
+    """An LRU of serialised and compressed figures with their content encoding.
+
+    Attributes
+    ----------
+    max_entries : int
+        Maximum number of payloads kept.
+    """
+
+    def __init__(self, max_entries: int = FIGURE_CACHE_SIZE) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[Hashable, tuple[bytes, Optional[str]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(
+        sql_query: str,
+        columns: list[str],
+        plot_type: str,
+        db_name: str,
+        version: int,
+        figure_format: FigureFormat,
+        encoding: Optional[str],
+    ) -> Hashable:
+        """Build the cache key of a figure.
+
+        Parameters
+        ----------
+        sql_query : str
+            The SQL query the plotted data came from.
+        columns : list[str]
+            The plotted columns.
+        plot_type : str
+            The type of plot.
+        db_name : str
+            The database the query ran on.
+        version : int
+            The version of the data in that database.
+        figure_format : FigureFormat
+            The format the figure was serialised to.
+        encoding : str, optional
+            The content encoding of the payload.
+
+        Returns
+        -------
+        Hashable
+            The key.
+        """
+        return (
+            " ".join(sql_query.split()),
+            tuple(columns),
+            plot_type,
+            db_name,
+            version,
+            figure_format.value,
+            encoding,
+        )
+
+    def get(self, key: Hashable) -> Optional[tuple[bytes, Optional[str]]]:
+        """Return the cached payload and its content encoding for a key, if any."""
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+            return payload
+
+    def put(self, key: Hashable, payload: tuple[bytes, Optional[str]]) -> None:
+        """Cache a payload, dropping the least recently used ones over the limit."""
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,346 @@
+"""History of the SQL queries the agent executed, used to tune the data layout."""
+
+from __future__ import annotations
+import atexit
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from loguru import logger
+from typing import Any, Iterator, Optional, TypedDict
+
+import duckdb
+
+from insightly.utils import QUERY_HISTORY_FLUSH_SECONDS, QUERY_HISTORY_SIZE
+
+
+class QueryRecord(TypedDict):
+    """An executed query.
+
+    Attributes
+    ----------
+    query : str
+        The SQL query.
+    db_name : str
+        The database it ran on.
+    seconds : float
+        How long it took.
+    timestamp : float
+        When it finished, in seconds since the epoch.
+    """
+
+    query: str
+    db_name: str
+    seconds: float
+    timestamp: float
+
+
+class QueryHistory:
+    """
+    The most recent executed queries, optionally appended to a JSON lines file.
+
+    Queries are written to the file by a background thread every
+    `flush_seconds`, so recording one never waits on the disk. Once the file
+    holds twice `max_entries` lines it is rewritten with the queries kept in
+    memory.
+
+    Attributes
+    ----------
+    path : str, optional
+        File the queries are appended to and loaded from.
+    max_entries : int
+        Number of queries kept in memory.
+    flush_seconds : float
+        Seconds between writes to the file.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_entries: int = QUERY_HISTORY_SIZE,
+        flush_seconds: float = QUERY_HISTORY_FLUSH_SECONDS,
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_seconds = flush_seconds
+        self._records: deque[QueryRecord] = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+        # recorded but not written yet, and the lines in the file
+        self._pending: list[QueryRecord] = []
+        self._lines = 0
+        self._write_lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        self._records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # a line cut short by a crash
+                        continue
+        if path is not None:
+            threading.Thread(
+                target=self._write_loop, name="query-history", daemon=True
+            ).start()
+            atexit.register(self.flush)
+
+    def record(self, query: str, db_name: str, seconds: float) -> None:
+        """
+        Adds an executed query to the history.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+        db_name : str
+            The database it ran on.
+        seconds : float
+            How long it took.
+
+        Returns
+        -------
+        None
+        """
+        record: QueryRecord = {
+            "query": query,
+            "db_name": db_name,
+            "seconds": seconds,
+            "timestamp": time.time(),
+        }
+        with self._lock:
+            self._records.append(record)
+            if self.path is not None:
+                self._pending.append(record)
+
+    def _write_loop(self) -> None:
+        """writes the recorded queries to the file until the process exits"""
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f"Could not write the query history to {self.path}: {e}")
+
+    def flush(self) -> None:
+        """
+        Writes the queries recorded since the last flush to the file.
+
+        Returns
+        -------
+        None
+        """
+        if self.path is None:
+            return
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                compact = self._lines + len(pending) > 2 * self.max_entries
+                # the kept queries end with the pending ones
+                kept = list(self._records) if compact else []
+            if not pending:
+                return
+            if compact:
+                with open(f"{self.path}.tmp", "w") as f:
+                    f.writelines(json.dumps(record) + "\n" for record in kept)
+                os.replace(f"{self.path}.tmp", self.path)
+                self._lines = len(kept)
+                return
+            with open(self.path, "a") as f:
+                f.writelines(json.dumps(record) + "\n" for record in pending)
+            self._lines += len(pending)
+
+    def records(self, db_name: Optional[str] = None) -> list[QueryRecord]:
+        """
+        The queries in the history, oldest first.
+
+        Parameters
+        ----------
+        db_name : str, optional
+            Only return the queries that ran on this database.
+
+        Returns
+        -------
+        list[QueryRecord]
+            The queries.
+        """
+        with self._lock:
+            return [
+                r for r in self._records if db_name is None or r["db_name"] == db_name
+            ]
+
+
+# the history Insightly records into, in memory until setup_query_history is called
+query_history = QueryHistory()
+
+
+def setup_query_history(path: str) -> QueryHistory:
+    """
+    Keeps the executed queries in a file so they survive restarts.
+
+    Parameters
+    ----------
+    path : str
+        The JSON lines file to append the queries to.
+
+    Returns
+    -------
+    QueryHistory
+        The history executed queries are now recorded into.
+    """
+    global query_history
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    query_history = QueryHistory(path)
+    logger.info(f"Recording executed queries to {path}")
+    return query_history
+
+
+def serialise_sql(query: str) -> Optional[dict[str, Any]]:
+    """
+    Parses a query into the syntax tree returned by DuckDB's json_serialize_sql.
+
+    Parameters
+    ----------
+    query : str
+        The SQL query.
+
+    Returns
+    -------
+    dict, optional
+        The tree, None if the query is not a single SELECT statement or
+        cannot be parsed. It can be turned back into SQL with `deserialise_sql`.
+    """
+    try:
+        # a connection of its own, the parser does not touch any data
+        with duckdb.connect() as conn:
+            serialised = conn.execute(
+                "SELECT json_serialize_sql(?::VARCHAR)", [query]
+            ).fetchone()[0]
+    except duckdb.Error:
+        return None
+    tree = json.loads(serialised)
+    if tree.get("error") or len(tree.get("statements", [])) != 1:
+        return None
+    if tree["statements"][0]["node"].get("type") != "SELECT_NODE":
+        return None
+    return tree
+
+
+def deserialise_sql(tree: dict[str, Any]) -> str:
+    """
+    Turns a syntax tree returned by `serialise_sql` back into SQL.
+
+    Parameters
+    ----------
+    tree : dict
+        The tree.
+
+    Returns
+    -------
+    str
+        The SQL query.
+    """
+    with duckdb.connect() as conn:
+        return conn.execute(
+            "SELECT json_deserialize_sql(?::JSON)", [json.dumps(tree)]
+        ).fetchone()[0]
+
+
+def parse_select(query: str) -> Optional[dict[str, Any]]:
+    """
+    Parses a SELECT query into the syntax tree DuckDB serialises it to.
+
+    Parameters
+    ----------
+    query : str
+        The SQL query.
+
+    Returns
+    -------
+    dict, optional
+        The SELECT node, None if the query is not a single SELECT statement
+        or cannot be parsed.
+    """
+    tree = serialise_sql(query)
+    return tree["statements"][0]["node"] if tree is not None else None
+
+
+def column_references(expression: Any) -> Iterator[str]:
+    """
+    The names of the columns an expression of a syntax tree refers to.
+
+    Parameters
+    ----------
+    expression : Any
+        A node of the tree returned by `parse_select`.
+
+    Returns
+    -------
+    Iterator[str]
+        The column names, without table qualifiers.
+    """
+    if isinstance(expression, dict):
+        if expression.get("class") == "COLUMN_REF":
+            yield expression["column_names"][-1]
+            return
+        for value in expression.values():
+            yield from column_references(value)
+    elif isinstance(expression, list):
+        for value in expression:
+            yield from column_references(value)
+
+
+def table_references(expression: Any) -> Iterator[str]:
+    """
+    The names of the tables a syntax tree reads from.
+
+    Parameters
+    ----------
+    expression : Any
+        A node of the tree returned by `parse_select`.
+
+    Returns
+    -------
+    Iterator[str]
+        The table names, without schema or catalog.
+    """
+    if isinstance(expression, dict):
+        if expression.get("type") == "BASE_TABLE" and "table_name" in expression:
+            yield expression["table_name"]
+            return
+        for value in expression.values():
+            yield from table_references(value)
+    elif isinstance(expression, list):
+        for value in expression:
+            yield from table_references(value)
+
+
+def filtered_columns(
+    records: list[QueryRecord], table_name: Optional[str] = None
+) -> Counter[str]:
+    """
+    Counts how often each column is filtered on in WHERE clauses.
+
+    Parameters
+    ----------
+    records : list[QueryRecord]
+        The executed queries.
+    table_name : str, optional
+        Only count the queries reading from this table.
+
+    Returns
+    -------
+    Counter[str]
+        The number of queries filtering on each column.
+    """
+    counts: Counter[str] = Counter()
+    for record in records:
+        node = parse_select(record["query"])
+        if node is None or not node.get("where_clause"):
+            continue
+        if table_name is not None and table_name.lower() not in {
+            name.lower() for name in table_references(node)
+        }:
+            continue
+        counts.update(set(column_references(node["where_clause"])))
+    return counts
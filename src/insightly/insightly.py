@@ -1,15 +1,63 @@
 from __future__ import annotations
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
 from loguru import logger
-from typing import Any, Dict, Optional
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, Dict, Iterator, Optional
 
-import pandas as pd
 import duckdb
 
+if TYPE_CHECKING:
+    import pandas as pd
+    from insightly.sampling import SampleStore
+    from insightly.templates import CatalogStore
+
+import insightly.history as history
+from insightly.rollups import RollupStore
+from insightly.utils import (
+    INTERNAL_TABLE_PREFIX,
+    QUERY_TIMEOUT_SECONDS,
+    RESULT_TABLE_PREFIX,
+    RESULT_TTL_SECONDS,
+    parse_size,
+    quote_identifier,
+)
+
+
+class QueryTimeoutError(Exception):
+    """Raised when a query is interrupted because it ran past its deadline."""
+
+    def __init__(self, query: str, timeout: float) -> None:
+        self.query = query
+        self.timeout = timeout
+        super().__init__(
+            f"Query exceeded the time limit of {timeout:g} seconds and was cancelled."
+        )
+
+
+class QueryCancelledError(Exception):
+    """Raised when a running query is cancelled through `Insightly.cancel_query`."""
+
+
+class ReadOnlyDatabaseError(Exception):
+    """Raised when data is loaded into a database serving a read-only snapshot."""
+
 
 class Singleton(type):
     _instances = {}
 
-    def __call__(cls):
+    def __call__(cls, *args, **kwargs):
+        if args or kwargs:
+            # explicitly configured instances (i.e. workspaces) are never shared
+            return super(Singleton, cls).__call__(*args, **kwargs)
+        # an instance activated for the current request takes precedence
+        active: Optional[ContextVar] = getattr(cls, "_active", None)
+        if active is not None and active.get() is not None:
+            return active.get()
         if cls not in cls._instances:
             instance = super(Singleton, cls).__call__()
             cls._instances[cls] = instance
@@ -24,18 +72,480 @@ class Insightly(metaclass=Singleton):
     ----------
     conn : duckdb.DuckDBPyConnection
         The DuckDB connection object.
+    db_name : str
+        The name DuckDB uses for the database (i.e. "memory" or the file stem).
+    default_config : dict
+        DuckDB configuration every database is opened with, see `configure`.
+    memory_ceiling : int, optional
+        Bytes of the memory limit the database was opened with. The memory
+        limit and threads of DuckDB are database wide, they are set when the
+        database is opened, not per query.
+    query_timeout : float, optional
+        Seconds a query may run before it is interrupted (None disables it).
+    auto_limit : int, optional
+        Row limit added to SELECT queries that do not already have one.
+    result_ttl : float, optional
+        Seconds a result table is kept after its query ran, None keeps
+        them until the database is closed.
+    use_rollups : bool
+        Answer aggregate queries from pre-aggregated rollups when one
+        matches, see `insightly.rollups.RollupStore`.
+    version : int
+        Bumped whenever the data in the database may have changed, used to
+        invalidate caches of query results and figures.
+    snapshot : str, optional
+        Path of the read-only snapshot the tables are served from, see
+        `insightly.snapshots`.
+    results_directory : str, optional
+        Folder result tables are written to as Parquet files, so that any
+        process serving the database can read them. None keeps them in the
+        database.
     """
 
     conn: duckdb.DuckDBPyConnection = None
     db_name: Optional[str] = None
     tables: list[str] = []
+    default_config: ClassVar[Dict[str, Any]] = {}
+    memory_ceiling: Optional[int] = None
+    query_timeout: Optional[float] = QUERY_TIMEOUT_SECONDS
+    auto_limit: Optional[int] = None
+    result_ttl: Optional[float] = RESULT_TTL_SECONDS
+    use_rollups: bool = True
+    version: int = 0
+    snapshot: Optional[str] = None
+    results_directory: Optional[str] = None
+    # instance returned by Insightly() for the current request, see activate()
+    _active: ClassVar[ContextVar[Optional[Insightly]]] = ContextVar(
+        "active_insightly", default=None
+    )
     # _instance: Optional[Insightly] = None
 
-    def __init__(self) -> None:
-        self.conn = duckdb.connect(database=":memory:")
-        self.db_name = "memory"
+    def __init__(
+        self,
+        database: str = ":memory:",
+        config: Optional[Dict[str, Any]] = None,
+        memory_limit: Optional[str] = None,
+        threads: Optional[int] = None,
+        temp_directory: Optional[str] = None,
+        snapshot: Optional[str] = None,
+        results_directory: Optional[str] = None,
+    ) -> None:
+        """
+        Open the DuckDB database.
+
+        Parameters
+        ----------
+        database : str, optional
+            Path of the database file, in memory by default.
+        config : dict, optional
+            DuckDB configuration options (i.e. {"memory_limit": "1GB"}),
+            on top of `default_config`.
+        memory_limit : str, optional
+            Memory DuckDB may use (i.e. "2GB"), larger operators spill.
+        threads : int, optional
+            Number of DuckDB threads.
+        temp_directory : str, optional
+            Folder operators spill to, each database uses a subfolder.
+        snapshot : str, optional
+            Path of a published snapshot to serve read-only instead of
+            `database`. The tables are served through views named after the
+            tables, and after the database, i.e. "ws_sales.orders", and
+            result tables are kept in memory, local to the process, unless
+            `results_directory` is set.
+        results_directory : str, optional
+            Folder to write result tables to as Parquet files, shared by the
+            processes serving the database, i.e. the reader workers.
+        """
+        if snapshot is not None:
+            database = ":memory:"
+            self.db_name = Path(snapshot).stem
+        else:
+            self.db_name = "memory" if database == ":memory:" else Path(database).stem
+        config = {**Insightly.default_config, **(config or {})}
+        for setting, value in (
+            ("memory_limit", memory_limit),
+            ("threads", threads),
+            ("temp_directory", temp_directory),
+        ):
+            if value is not None:
+                config[setting] = value
+        if "temp_directory" in config:
+            # databases of one process must not share spill files
+            config["temp_directory"] = os.path.join(
+                config["temp_directory"], self.db_name
+            )
+            os.makedirs(config["temp_directory"], exist_ok=True)
+        self.memory_ceiling = (
+            parse_size(config["memory_limit"]) if "memory_limit" in config else None
+        )
+        self.conn = duckdb.connect(database=database, config=config)
         self.tables = []
+        self.version = 0
         self._instance = None
+        # cursors of queries currently running, keyed by query id
+        self._running: dict[str, duckdb.DuckDBPyConnection] = {}
+        self._running_lock = threading.Lock()
+        # result tables and when they were stored, see drop_expired_results
+        self._results: dict[str, float] = {}
+        # rows of the result tables, counted once, see result_row_count
+        self._result_rows: dict[str, int] = {}
+        self._results_lock = threading.Lock()
+        self.rollups = RollupStore(self)
+        self._samples: Optional[SampleStore] = None
+        self._catalog: Optional[CatalogStore] = None
+        self.results_directory = results_directory
+        if results_directory is not None:
+            os.makedirs(results_directory, exist_ok=True)
+        self.snapshot = None
+        self._snapshot_lock = threading.Lock()
+        # snapshots are attached under a new alias each time, see attach_snapshot
+        self._snapshot_generation = 0
+        self._snapshot_alias: Optional[str] = None
+        # generation -> queries that started while it was served
+        self._snapshot_readers: dict[int, int] = {}
+        # aliases replaced by a newer snapshot, detached once drained
+        self._retired_snapshots: list[tuple[int, str]] = []
+        if snapshot is not None:
+            self.attach_snapshot(snapshot)
+        # pick up the tables of a database file that already exists
+        self._refresh_tables()
+        # results left by an earlier process expire like new ones
+        now = time.monotonic()
+        for (name,) in self.conn.execute("PRAGMA show_tables;").fetchall():
+            if name.startswith(RESULT_TABLE_PREFIX):
+                self._results[name] = now
+
+    @classmethod
+    def configure(
+        cls,
+        memory_limit: Optional[str] = None,
+        threads: Optional[int] = None,
+        temp_directory: Optional[str] = None,
+        max_temp_directory_size: Optional[str] = None,
+    ) -> None:
+        """
+        Sets the DuckDB configuration every database is opened with.
+
+        Call it before the first `Insightly()`, databases that are already
+        open keep their settings.
+
+        Parameters
+        ----------
+        memory_limit : str, optional
+            Memory each database may use (i.e. "2GB").
+        threads : int, optional
+            Number of DuckDB threads per database.
+        temp_directory : str, optional
+            Folder large joins, sorts and aggregations spill to.
+        max_temp_directory_size : str, optional
+            Disk space the spilled data may take (i.e. "50GB").
+
+        Returns
+        -------
+        None
+        """
+        config: Dict[str, Any] = {}
+        for setting, value in (
+            ("memory_limit", memory_limit),
+            ("threads", threads),
+            ("temp_directory", temp_directory),
+            ("max_temp_directory_size", max_temp_directory_size),
+        ):
+            if value is not None:
+                config[setting] = value
+        if memory_limit is not None:
+            # fail on startup rather than on the first query
+            parse_size(memory_limit)
+        cls.default_config = config
+
+    @contextmanager
+    def activate(self) -> Iterator[Insightly]:
+        """
+        Make `Insightly()` return this instance for the current context.
+
+        Used to run the workflow nodes, which call `Insightly()`, against a
+        workspace database instead of the process-wide one.
+
+        Returns
+        -------
+        Iterator[Insightly]
+            This instance, active until the context exits.
+        """
+        token = Insightly._active.set(self)
+        try:
+            yield self
+        finally:
+            Insightly._active.reset(token)
+
+    def close(self) -> None:
+        """
+        Closes the DuckDB connection.
+
+        Returns
+        -------
+        None
+        """
+        self.rollups.close()
+        if self._samples is not None:
+            self._samples.close()
+        self.conn.close()
+
+    def memory_usage(self) -> int:
+        """
+        Bytes of memory currently held by the DuckDB buffer manager.
+
+        Returns
+        -------
+        int
+            The memory usage of the database in bytes.
+        """
+        used = self.conn.execute(
+            "SELECT coalesce(sum(memory_usage_bytes), 0) FROM duckdb_memory()"
+        ).fetchone()[0]
+        return int(used)
+
+    def memory_report(self) -> Dict[str, Any]:
+        """
+        DuckDB settings, buffer usage, spill files and tables of the database.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The settings, the memory and temporary storage used per buffer
+            tag, the spill files, and the estimated size of each table.
+        """
+        cursor = self.conn.cursor()
+        try:
+            settings = dict(
+                cursor.execute(
+                    "SELECT name, value FROM duckdb_settings() WHERE name IN "
+                    "('memory_limit', 'threads', 'temp_directory', "
+                    "'max_temp_directory_size')"
+                ).fetchall()
+            )
+            buffers = [
+                {"tag": tag, "memory_bytes": memory, "temporary_bytes": temporary}
+                for tag, memory, temporary in cursor.execute(
+                    "SELECT tag, memory_usage_bytes, temporary_storage_bytes "
+                    "FROM duckdb_memory() ORDER BY memory_usage_bytes DESC"
+                ).fetchall()
+            ]
+            spill_files = [
+                {"path": path, "bytes": size}
+                for path, size in cursor.execute(
+                    "SELECT path, size FROM duckdb_temporary_files()"
+                ).fetchall()
+            ]
+            tables = cursor.execute(
+                "SELECT table_name, estimated_size, column_count "
+                # results of a snapshot are kept in the in-memory database
+                "FROM duckdb_tables() WHERE database_name IN (?, current_database())",
+                [self._snapshot_alias or self.db_name],
+            ).fetchall()
+        finally:
+            cursor.close()
+        return {
+            "db_name": self.db_name,
+            "settings": settings,
+            "memory_bytes": sum(b["memory_bytes"] for b in buffers),
+            "temporary_bytes": sum(b["temporary_bytes"] for b in buffers),
+            "buffers": buffers,
+            "spill_files": spill_files,
+            "result_tables": [
+                {"table_name": name, "estimated_rows": rows, "columns": columns}
+                for name, rows, columns in tables
+                if name.startswith(RESULT_TABLE_PREFIX)
+            ],
+            "tables": [
+                {"table_name": name, "estimated_rows": rows, "columns": columns}
+                for name, rows, columns in tables
+                if not name.startswith(RESULT_TABLE_PREFIX)
+            ],
+        }
+
+    @property
+    def samples(self) -> SampleStore:
+        """
+        Samples of the large tables, used for approximate answers.
+
+        Returns
+        -------
+        SampleStore
+            The samples of this database.
+        """
+        if self._samples is None:
+            # imported here, sampling reads results through Insightly
+            from insightly.sampling import SampleStore
+
+            self._samples = SampleStore(self)
+        return self._samples
+
+    @property
+    def catalog(self) -> CatalogStore:
+        """
+        Columns and categorical values of the tables, used by the templates.
+
+        Returns
+        -------
+        CatalogStore
+            The catalog of this database.
+        """
+        if self._catalog is None:
+            # imported here, the templates need the agent classes
+            from insightly.templates import CatalogStore
+
+            self._catalog = CatalogStore(self)
+        return self._catalog
+
+    def attach_snapshot(self, path: str) -> None:
+        """
+        Serves the tables of a published snapshot, replacing the previous one.
+
+        Each snapshot is attached under a new alias and each table is exposed
+        through a view in the in-memory database, in the main schema and in a
+        schema named after the database, so that queries naming tables with
+        or without the database name work. The views are swapped at once,
+        queries already running finish on the previous snapshot, which is
+        detached once they are done. Result tables are kept.
+
+        Parameters
+        ----------
+        path : str
+            The snapshot file, named after the database.
+
+        Returns
+        -------
+        None
+        """
+        with self._snapshot_lock:
+            generation = self._snapshot_generation + 1
+            alias = f"{INTERNAL_TABLE_PREFIX}snapshot_{generation}"
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute(f"ATTACH '{path}' AS {alias} (READ_ONLY)")
+                try:
+                    self._swap_views(cursor, alias)
+                except Exception:
+                    cursor.execute(f"DETACH {alias}")
+                    raise
+                if self._snapshot_alias is not None:
+                    self._retired_snapshots.append(
+                        (self._snapshot_generation, self._snapshot_alias)
+                    )
+                self._snapshot_generation = generation
+                self._snapshot_alias = alias
+                self._detach_drained(cursor)
+            finally:
+                cursor.close()
+            self.snapshot = path
+            self.version += 1
+            self._refresh_tables()
+        if self.use_rollups:
+            # rollups of this process were built from the previous snapshot
+            self.rollups.mark_stale()
+            self.rollups.refresh()
+        logger.info(f"Serving {self.db_name} from {path}")
+
+    def _swap_views(self, cursor: duckdb.DuckDBPyConnection, alias: str) -> None:
+        """points the views of the tables at an attached snapshot, in one
+        transaction so that queries see either snapshot, never a mix"""
+        tables = {
+            t
+            for (t,) in cursor.execute(
+                "SELECT table_name FROM duckdb_tables() "
+                "WHERE database_name = ? AND schema_name = 'main'",
+                [alias],
+            ).fetchall()
+        }
+        cursor.execute("BEGIN TRANSACTION")
+        try:
+            cursor.execute(
+                f"CREATE SCHEMA IF NOT EXISTS {quote_identifier(self.db_name)}"
+            )
+            for schema in ("main", self.db_name):
+                views = {
+                    v
+                    for (v,) in cursor.execute(
+                        "SELECT view_name FROM duckdb_views() "
+                        "WHERE database_name = current_database() "
+                        "AND schema_name = ? AND NOT internal",
+                        [schema],
+                    ).fetchall()
+                    # result tables of a results directory are views too
+                    if not v.startswith((RESULT_TABLE_PREFIX, INTERNAL_TABLE_PREFIX))
+                }
+                for view in views - tables:
+                    cursor.execute(
+                        f"DROP VIEW {quote_identifier(schema)}.{quote_identifier(view)}"
+                    )
+                for table in tables:
+                    cursor.execute(
+                        f"CREATE OR REPLACE VIEW "
+                        f"{quote_identifier(schema)}.{quote_identifier(table)} AS "
+                        f"SELECT * FROM {alias}.{quote_identifier(table)}"
+                    )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def _detach_drained(self, cursor: duckdb.DuckDBPyConnection) -> None:
+        """detach the replaced snapshots no running query may still read,
+        under the snapshot lock. A query may read any snapshot served since
+        it started, the views can be swapped before it is planned"""
+        oldest = min(self._snapshot_readers, default=None)
+        for generation, alias in list(self._retired_snapshots):
+            if oldest is None or generation < oldest:
+                cursor.execute(f"DETACH {alias}")
+                self._retired_snapshots.remove((generation, alias))
+                logger.debug(f"Detached {alias} of {self.db_name}")
+
+    @contextmanager
+    def reading_snapshot(self) -> Iterator[None]:
+        """
+        Keeps the snapshot served when a query starts attached until it is
+        done, see `attach_snapshot`.
+
+        Queries run with `execute_query` and `materialize_query` are kept
+        already, other readers of the tables wrap their queries in it.
+        """
+        with self._snapshot_lock:
+            generation = self._snapshot_generation
+            self._snapshot_readers[generation] = (
+                self._snapshot_readers.get(generation, 0) + 1
+            )
+        try:
+            yield
+        finally:
+            with self._snapshot_lock:
+                self._snapshot_readers[generation] -= 1
+                if not self._snapshot_readers[generation]:
+                    del self._snapshot_readers[generation]
+                if self._retired_snapshots:
+                    cursor = self.conn.cursor()
+                    try:
+                        self._detach_drained(cursor)
+                    finally:
+                        cursor.close()
+
+    def _check_writable(self) -> None:
+        """refuse to load data into a database serving a snapshot, the writer
+        process loads it"""
+        if self.snapshot is not None:
+            raise ReadOnlyDatabaseError(
+                f"{self.db_name} is served from a read-only snapshot, "
+                "load data through the writer process."
+            )
+
+    def _refresh_tables(self) -> None:
+        """set the list of tables for the database, leaving out query results
+        and bookkeeping"""
+        tables_tuple = self.conn.execute("PRAGMA show_tables;").fetchall()
+        self.tables = [
+            t[0]
+            for t in tables_tuple
+            if not t[0].startswith((RESULT_TABLE_PREFIX, INTERNAL_TABLE_PREFIX))
+        ]
 
     # def __new__(cls):
     #     """
@@ -66,7 +576,10 @@ class Insightly(metaclass=Singleton):
         -------
         None
         """
+        self._check_writable()
         # self.db_name = table_name
+        if table_name not in self.tables:
+            self.version += 1
         self.conn.execute(
             f"""
             CREATE TABLE IF NOT EXISTS {table_name} AS
@@ -74,8 +587,7 @@ class Insightly(metaclass=Singleton):
             """
         )
         # set the list of tables for the database for later usage
-        tables_tuple = self.conn.execute("PRAGMA show_tables;").fetchall()
-        self.tables = [t[0] for t in tables_tuple]
+        self._refresh_tables()
         logger.info("tables: {tables}".format(tables=self.tables))
 
     # reading the CSV file into a DuckDB table
@@ -96,6 +608,7 @@ class Insightly(metaclass=Singleton):
         -------
         None
         """
+        self._check_writable()
         self.db_name = db_name
         query: str = f"""
             CALL sqlite_attach('{path_to_db}');
@@ -103,10 +616,69 @@ class Insightly(metaclass=Singleton):
         """
         logger.debug(query)
         self.conn.execute(query)
+        self.version += 1
 
         # set the list of tables for the database for later usage
-        tables_tuple = self.conn.execute("PRAGMA show_tables;").fetchall()
-        self.tables = [t[0] for t in tables_tuple]
+        self._refresh_tables()
+
+    def read_delta_to_duckdb(
+        self,
+        table_uri: str,
+        table_name: str,
+        key_columns: Optional[list[str]] = None,
+    ) -> int:
+        """
+        Copies a Delta table into a DuckDB table that can be refreshed
+        incrementally with `refresh_delta_table`.
+
+        Parameters
+        ----------
+        table_uri : str
+            Local path or s3:// URI of the Delta table.
+        table_name : str
+            The name of the table to create in DuckDB.
+        key_columns : list[str], optional
+            Columns identifying a row, needed to apply updates and deletes
+            from the change data feed. Without them a refresh after updates
+            or deletes reloads the table.
+
+        Returns
+        -------
+        int
+            The Delta version that was loaded.
+        """
+        self._check_writable()
+        from insightly.delta import mirror_delta_table
+
+        version = mirror_delta_table(self, table_uri, table_name, key_columns)
+        self.version += 1
+        self._refresh_tables()
+        self.rollups.refresh(table_name)
+        logger.info("tables: {tables}".format(tables=self.tables))
+        return version
+
+    def refresh_delta_table(self, table_name: str) -> int:
+        """
+        Applies the Delta commits made since a mirrored table was last loaded.
+
+        Parameters
+        ----------
+        table_name : str
+            A table created with `read_delta_to_duckdb`.
+
+        Returns
+        -------
+        int
+            The number of rows inserted, updated or deleted.
+        """
+        self._check_writable()
+        from insightly.delta import refresh_delta_mirror
+
+        changed = refresh_delta_mirror(self, table_name)
+        if changed:
+            self.version += 1
+            self.rollups.refresh(table_name)
+        return changed
 
     def retrieve_table(self, table_name: str) -> duckdb.DuckDBPyRelation:
         """
@@ -167,6 +739,7 @@ class Insightly(metaclass=Singleton):
         -------
         None
         """
+        self._check_writable()
         # Create the table if it doesn't exist
         self.conn.execute(
             f"CREATE TABLE IF NOT EXISTS {table_name} AS SELECT * FROM df LIMIT 0"
@@ -177,22 +750,453 @@ class Insightly(metaclass=Singleton):
 
         # Commit the changes
         self.conn.commit()
+        self.version += 1
+        self._refresh_tables()
+        self.rollups.refresh(table_name)
+
+    @staticmethod
+    def apply_auto_limit(query: str, limit: int) -> str:
+        """
+        Adds a row limit to a SELECT query that does not already end with one.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query to limit.
+        limit : int
+            The maximum number of rows to return.
+
+        Returns
+        -------
+        str
+            The limited query, or the original query if it is not a plain
+            SELECT or already has a LIMIT clause.
+        """
+        stripped = query.strip().rstrip(";").strip()
+        if not re.match(r"^(select|with)\b", stripped, flags=re.IGNORECASE):
+            return query
+        if ";" in stripped:
+            # more than one statement, leave it alone
+            return query
+        if re.search(
+            r"\blimit\s+\d+(\s+offset\s+\d+)?$", stripped, flags=re.IGNORECASE
+        ):
+            return query
+        # on their own lines, a trailing line comment would swallow the paren
+        return f"SELECT * FROM (\n{stripped}\n) AS limited_query LIMIT {int(limit)}"
+
+    def cancel_query(self, query_id: str) -> bool:
+        """
+        Interrupts a query started with `execute_query(..., query_id=query_id)`.
+
+        Parameters
+        ----------
+        query_id : str
+            The id the query was started with.
+
+        Returns
+        -------
+        bool
+            True if a running query was found and interrupted.
+        """
+        with self._running_lock:
+            cursor = self._running.get(query_id)
+        if cursor is None:
+            return False
+        logger.warning(f"Cancelling query {query_id}")
+        cursor.interrupt()
+        return True
 
-    def execute_query(self, query: str) -> pd.DataFrame:
+    def execute_query(
+        self,
+        query: str,
+        timeout: Optional[float] = None,
+        auto_limit: Optional[int] = None,
+        query_id: Optional[str] = None,
+    ) -> Optional[pd.DataFrame]:
         """
         Executes a SQL query on the DuckDB connection.
 
+        The query runs on its own cursor so that it can be interrupted without
+        touching other queries on the shared database. Arguments left as None
+        fall back to the limits configured on the instance.
+
         Parameters
         ----------
         query : str
             The SQL query to execute
+        timeout : float, optional
+            Seconds before the query is interrupted.
+        auto_limit : int, optional
+            Row limit added to SELECT queries without a LIMIT clause.
+        query_id : str, optional
+            Id that can be passed to `cancel_query` to stop the query.
 
         Returns
         -------
-        pd.DataFrame
-            The result of the executed query as a relation.
+        pd.DataFrame, optional
+            The result of the executed query, or None for statements that do
+            not return rows.
+
+        Raises
+        ------
+        QueryTimeoutError
+            If the query ran past its deadline.
+        QueryCancelledError
+            If the query was cancelled with `cancel_query`.
         """
-        executed_query = self.conn.sql(query)
-        # commit
-        self.conn.commit()
-        return executed_query
+        return self._run_limited(
+            query,
+            lambda relation: relation.df(),
+            timeout=timeout,
+            auto_limit=auto_limit,
+            query_id=query_id,
+        )
+
+    def materialize_query(
+        self,
+        query: str,
+        table_name: str,
+        timeout: Optional[float] = None,
+        auto_limit: Optional[int] = None,
+        query_id: Optional[str] = None,
+    ) -> bool:
+        """
+        Executes a SQL query and stores its rows in a table inside DuckDB.
+
+        Same as `execute_query`, but the rows never leave the database, any
+        existing table with the same name is replaced. The table is created
+        by the cursor of the query and dropped after `result_ttl`. With a
+        `results_directory` the rows are written to a Parquet file there and
+        the table is a view over it, see `has_result`.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query to execute
+        table_name : str
+            The table to store the rows in.
+        timeout, auto_limit, query_id
+            See `execute_query`.
+
+        Returns
+        -------
+        bool
+            True if the query returned rows that were stored, False for
+            statements that do not return rows.
+
+        Raises
+        ------
+        QueryTimeoutError
+            If the query ran past its deadline.
+        QueryCancelledError
+            If the query was cancelled with `cancel_query`.
+        """
+
+        def store(relation: duckdb.DuckDBPyRelation) -> bool:
+            # runs on the cursor of the query, not the shared connection
+            if self.results_directory is None:
+                relation.query(
+                    "result",
+                    f"CREATE OR REPLACE TABLE {quote_identifier(table_name)} AS "
+                    "SELECT * FROM result",
+                )
+            else:
+                path = self._result_path(table_name)
+                # other processes only see the file once it is complete
+                relation.query(
+                    "result",
+                    f"COPY (SELECT * FROM result) TO '{path}.tmp' (FORMAT parquet)",
+                )
+                os.replace(f"{path}.tmp", path)
+                relation.query("result", self._result_view(table_name))
+            # counted once here rather than on every page that is read
+            rows = relation.query(
+                "result", f"SELECT count(*) FROM {quote_identifier(table_name)}"
+            ).fetchone()[0]
+            with self._results_lock:
+                self._results[table_name] = time.monotonic()
+                self._result_rows[table_name] = rows
+            return True
+
+        self.drop_expired_results()
+        stored = self._run_limited(
+            query,
+            store,
+            timeout=timeout,
+            auto_limit=auto_limit,
+            query_id=query_id,
+        )
+        return bool(stored)
+
+    def query_relation(
+        self,
+        query: str,
+        consume: Callable[[duckdb.DuckDBPyRelation], Any],
+        timeout: Optional[float] = None,
+    ) -> Any:
+        """
+        Runs a query the agent did not ask for, i.e. over the samples of the
+        tables, with the limits of `execute_query`.
+
+        The query is not recorded in the query history, nor answered from or
+        counted for rollups.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query to execute.
+        consume : Callable[[duckdb.DuckDBPyRelation], Any]
+            Reads the rows of the query from its relation, within the
+            deadline.
+        timeout : float, optional
+            See `execute_query`.
+
+        Returns
+        -------
+        Any
+            What `consume` returned, None for statements without rows.
+
+        Raises
+        ------
+        QueryTimeoutError
+            If the query ran past its deadline.
+        """
+        return self._run_limited(
+            query,
+            consume,
+            timeout=timeout,
+            record=False,
+        )
+
+    def has_result(self, table_name: str) -> bool:
+        """
+        Whether a result table can be read.
+
+        Result tables written to the results directory by another process
+        are made readable here on their first use.
+
+        Parameters
+        ----------
+        table_name : str
+            The result table.
+
+        Returns
+        -------
+        bool
+            False once the table expired, or when it was kept in the memory of
+            a process that has restarted or is another worker.
+        """
+        cursor = self.conn.cursor()
+        try:
+            exists = cursor.execute(
+                "SELECT count(*) > 0 FROM information_schema.tables "
+                "WHERE table_catalog = current_database() "
+                "AND table_schema = 'main' AND table_name = ?",
+                [table_name],
+            ).fetchone()[0]
+            if self.results_directory is None:
+                return exists
+            if not os.path.exists(self._result_path(table_name)):
+                if exists:
+                    # expired in another process
+                    self._drop_result(cursor, table_name)
+                return False
+            if not exists:
+                cursor.execute(self._result_view(table_name))
+                with self._results_lock:
+                    self._results.setdefault(table_name, time.monotonic())
+            return True
+        finally:
+            cursor.close()
+
+    def result_row_count(self, table_name: str) -> int:
+        """
+        The number of rows of a result table.
+
+        The rows are counted when the result is stored, or on first use
+        for results stored by another process.
+
+        Parameters
+        ----------
+        table_name : str
+            The result table, see `has_result`.
+
+        Returns
+        -------
+        int
+            The number of rows.
+        """
+        with self._results_lock:
+            rows = self._result_rows.get(table_name)
+        if rows is not None:
+            return rows
+        cursor = self.conn.cursor()
+        try:
+            rows = cursor.execute(
+                f"SELECT count(*) FROM {quote_identifier(table_name)}"
+            ).fetchone()[0]
+        finally:
+            cursor.close()
+        with self._results_lock:
+            if table_name in self._results:
+                self._result_rows[table_name] = rows
+        return rows
+
+    def _result_path(self, table_name: str) -> str:
+        """the Parquet file of a result table in the results directory"""
+        return os.path.join(self.results_directory, f"{table_name}.parquet")
+
+    def _result_view(self, table_name: str) -> str:
+        """the statement exposing the file of a result table as the table"""
+        return (
+            f"CREATE OR REPLACE VIEW {quote_identifier(table_name)} AS "
+            f"SELECT * FROM read_parquet('{self._result_path(table_name)}')"
+        )
+
+    def _drop_result(self, cursor: duckdb.DuckDBPyConnection, table_name: str) -> None:
+        """drop a result table, and its file in the results directory"""
+        with self._results_lock:
+            self._result_rows.pop(table_name, None)
+        if self.results_directory is None:
+            cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)}")
+            return
+        cursor.execute(f"DROP VIEW IF EXISTS {quote_identifier(table_name)}")
+        try:
+            os.remove(self._result_path(table_name))
+        except FileNotFoundError:
+            pass
+
+    def drop_expired_results(self) -> list[str]:
+        """
+        Drops the result tables stored more than `result_ttl` seconds ago.
+
+        Files of the results directory written more than `result_ttl`
+        seconds ago are deleted too, whichever process wrote them.
+
+        Returns
+        -------
+        list[str]
+            The names of the dropped tables.
+        """
+        if self.result_ttl is None:
+            return []
+        cutoff = time.monotonic() - self.result_ttl
+        with self._results_lock:
+            expired = [name for name, at in self._results.items() if at < cutoff]
+            for name in expired:
+                del self._results[name]
+        if self.results_directory is not None:
+            written_before = time.time() - self.result_ttl
+            for entry in os.scandir(self.results_directory):
+                name, extension = os.path.splitext(entry.name)
+                if extension != ".parquet" or name in expired:
+                    continue
+                try:
+                    if entry.stat().st_mtime < written_before:
+                        expired.append(name)
+                except FileNotFoundError:
+                    # dropped by another process meanwhile
+                    continue
+        if not expired:
+            return []
+        cursor = self.conn.cursor()
+        try:
+            for name in expired:
+                self._drop_result(cursor, name)
+        finally:
+            cursor.close()
+        logger.info(f"Dropped {len(expired)} expired result tables of {self.db_name}")
+        return expired
+
+    def _rewrite_with_rollups(self, query: str) -> Optional[str]:
+        """the query over a matching rollup, if any, failures fall back to the
+        query as it was asked"""
+        try:
+            return self.rollups.rewrite(query)
+        except Exception as e:
+            logger.warning(f"Could not rewrite the query to use a rollup: {e}")
+            return None
+
+    def _observe_for_rollups(self, query: str) -> None:
+        """count the shape of an executed query in the background, building
+        its rollup when it recurs"""
+        self.rollups.observe_later(query)
+
+    def _run_limited(
+        self,
+        query: str,
+        consume: Callable[[duckdb.DuckDBPyRelation], Any],
+        timeout: Optional[float] = None,
+        auto_limit: Optional[int] = None,
+        query_id: Optional[str] = None,
+        record: bool = True,
+    ) -> Any:
+        """run a query on its own cursor with the limits and hand its relation
+        to `consume` inside the deadline, relations are lazy. Queries that are
+        not recorded are not added to the history, nor answered from or
+        counted for rollups"""
+        timeout = timeout if timeout is not None else self.query_timeout
+        auto_limit = auto_limit or self.auto_limit
+        asked = query
+        use_rollups = self.use_rollups and record
+        rewritten = self._rewrite_with_rollups(query) if use_rollups else None
+        if auto_limit:
+            query = self.apply_auto_limit(query, auto_limit)
+        original = query
+        if rewritten is not None:
+            query = rewritten
+            if auto_limit:
+                query = self.apply_auto_limit(query, auto_limit)
+
+        cursor = self.conn.cursor()
+        if query_id is not None:
+            with self._running_lock:
+                self._running[query_id] = cursor
+
+        timed_out = threading.Event()
+
+        def interrupt() -> None:
+            timed_out.set()
+            cursor.interrupt()
+
+        timer = threading.Timer(timeout, interrupt) if timeout else None
+        start = time.perf_counter()
+        try:
+            if timer is not None:
+                timer.start()
+            with self.reading_snapshot():
+                try:
+                    executed_query = cursor.sql(query)
+                except duckdb.BinderException as e:
+                    if rewritten is None:
+                        raise
+                    # the rollup does not answer the query after all
+                    logger.warning(f"Could not answer the query from a rollup: {e}")
+                    query, rewritten = original, None
+                    executed_query = cursor.sql(query)
+                result = consume(executed_query) if executed_query is not None else None
+            # commit
+            cursor.commit()
+            if executed_query is None:
+                # statements without rows may have changed the data
+                self.version += 1
+                self.rollups.mark_stale()
+            if record:
+                history.query_history.record(
+                    asked, self.db_name, time.perf_counter() - start
+                )
+            if use_rollups and rewritten is None and executed_query is not None:
+                self._observe_for_rollups(asked)
+            return result
+        except duckdb.InterruptException as e:
+            if timed_out.is_set():
+                raise QueryTimeoutError(query, timeout) from e
+            raise QueryCancelledError(f"Query {query_id} was cancelled.") from e
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if query_id is not None:
+                with self._running_lock:
+                    self._running.pop(query_id, None)
+            cursor.close()
@@ -0,0 +1,84 @@
+"""Helpers to keep logging cheap on the hot path.
+
+Large payloads (DataFrames, prompts with the schema, SQL) are summarised to
+a byte budget before they are formatted, and debug records can be sampled
+per module so busy loggers only write a fraction of their records.
+"""
+
+import random
+from typing import Any, Optional
+
+# bytes of a payload kept in a log message
+LOG_PAYLOAD_BYTES: int = 2_048
+# records at this level and above are never sampled away (WARNING)
+SAMPLING_MAX_LEVEL: int = 30
+
+
+def summarise(value: Any, budget: Optional[int] = None) -> str:
+    """Describe a payload for a log message within a byte budget.
+
+    DataFrames are described by their shape and columns instead of being
+    formatted, everything else is truncated.
+
+    Parameters
+    ----------
+    value : Any
+        The payload to log.
+    budget : int, optional
+        Maximum bytes kept, LOG_PAYLOAD_BYTES by default.
+
+    Returns
+    -------
+    str
+        The summary.
+    """
+    budget = budget if budget is not None else LOG_PAYLOAD_BYTES
+    # duck typed so that logging does not import pandas
+    if hasattr(value, "shape") and hasattr(value, "columns"):
+        columns = ", ".join(str(c) for c in list(value.columns)[:20])
+        text = f"<DataFrame {value.shape[0]} rows x {value.shape[1]} columns: {columns}>"
+    elif isinstance(value, bytes):
+        text = value.decode(errors="replace")
+    else:
+        text = value if isinstance(value, str) else repr(value)
+
+    encoded = text.encode()
+    if len(encoded) <= budget:
+        return text
+    kept = encoded[:budget].decode(errors="ignore")
+    return f"{kept}... (+{len(encoded) - budget} bytes)"
+
+
+class SamplingFilter:
+    """Loguru filter keeping a fraction of the records of each module.
+
+    Attributes
+    ----------
+    rates : dict[str, float]
+        Fraction of records kept, keyed by module name or package prefix
+        (i.e. {"insightly.nodes": 0.1}). The longest matching prefix wins and
+        modules without a rate keep every record. Warnings and errors are
+        always kept.
+    """
+
+    def __init__(self, rates: dict[str, float]) -> None:
+        self.rates = rates
+        # resolved rate per module name
+        self._cache: dict[str, float] = {}
+
+    def rate(self, name: str) -> float:
+        """Fraction of the records of a module that is kept."""
+        if name not in self._cache:
+            matches = [
+                prefix
+                for prefix in self.rates
+                if name == prefix or name.startswith(prefix + ".")
+            ]
+            self._cache[name] = self.rates[max(matches, key=len)] if matches else 1.0
+        return self._cache[name]
+
+    def __call__(self, record: dict) -> bool:
+        if record["level"].no >= SAMPLING_MAX_LEVEL:
+            return True
+        rate = self.rate(record["name"] or "")
+        return rate >= 1.0 or random.random() < rate
@@ -0,0 +1,173 @@
+"""Counters and timings of the agent, reported by the /metrics endpoint.
+
+Metrics are kept in memory per process and keyed by a name and labels, i.e.
+the tokens sent to the LLM per node. Observed values (durations, token counts)
+keep a window of the most recent samples for percentiles.
+"""
+
+from __future__ import annotations
+import math
+import threading
+from collections import deque
+from typing import Any, Optional
+
+from insightly.utils import METRICS_WINDOW
+
+# a metric name with its labels sorted by name
+MetricKey = tuple[str, tuple[tuple[str, str], ...]]
+
+
+def _key(name: str, labels: dict[str, Any]) -> MetricKey:
+    """the key of a metric and its labels"""
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """the q-th percentile of sorted values, by the nearest rank"""
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class Metrics:
+    """
+    Counters, gauges and observed values of a process.
+
+    Attributes
+    ----------
+    window : int
+        Number of recent samples kept per observed metric.
+    """
+
+    def __init__(self, window: int = METRICS_WINDOW) -> None:
+        self.window = window
+        self._counters: dict[MetricKey, float] = {}
+        self._gauges: dict[MetricKey, float] = {}
+        self._samples: dict[MetricKey, deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        """
+        Adds to a counter.
+
+        Parameters
+        ----------
+        name : str
+            The counter, i.e. "llm_prompt_tokens".
+        value : float, optional
+            The amount added.
+        **labels
+            The labels of the counter, i.e. node="SQLConverterNode".
+
+        Returns
+        -------
+        None
+        """
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        """
+        Sets a gauge, i.e. the depth of a queue.
+
+        Parameters
+        ----------
+        name : str
+            The gauge.
+        value : float
+            Its current value.
+        **labels
+            The labels of the gauge.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """
+        Records a sample of an observed value, i.e. the duration of a call.
+
+        Parameters
+        ----------
+        name : str
+            The observed metric.
+        value : float
+            The sample.
+        **labels
+            The labels of the metric.
+
+        Returns
+        -------
+        None
+        """
+        key = _key(name, labels)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(value)
+
+    def percentile(
+        self, name: str, q: float, min_samples: int = 1, **labels: Any
+    ) -> Optional[float]:
+        """
+        A percentile of the recent samples of an observed metric.
+
+        Parameters
+        ----------
+        name : str
+            The observed metric.
+        q : float
+            The percentile, between 0 and 100.
+        min_samples : int, optional
+            Samples needed for the percentile to be meaningful.
+        **labels
+            The labels of the metric.
+
+        Returns
+        -------
+        float, optional
+            The percentile, None if fewer than `min_samples` samples were
+            observed.
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(_key(name, labels), ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return _percentile(samples, q)
+
+    def snapshot(self) -> dict[str, list[dict[str, Any]]]:
+        """
+        The current value of every metric.
+
+        Returns
+        -------
+        dict[str, list[dict[str, Any]]]
+            For each metric name, its labels and value, or for observed
+            metrics the count, mean, median, 95th percentile and maximum of
+            the recent samples.
+        """
+        with self._lock:
+            values = {**self._counters, **self._gauges}
+            samples = {key: sorted(s) for key, s in self._samples.items()}
+        report: dict[str, list[dict[str, Any]]] = {}
+        for (name, labels), value in sorted(values.items()):
+            report.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), observed in sorted(samples.items()):
+            report.setdefault(name, []).append(
+                {
+                    "labels": dict(labels),
+                    "count": len(observed),
+                    "mean": sum(observed) / len(observed),
+                    "p50": _percentile(observed, 50),
+                    "p95": _percentile(observed, 95),
+                    "max": observed[-1],
+                }
+            )
+        return report
+
+
+# the metrics of this process
+metrics = Metrics()
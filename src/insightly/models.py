@@ -0,0 +1,249 @@
+"""The chat model each node calls.
+
+Nodes that only classify or phrase an answer use a small, fast model and the
+nodes writing SQL a larger one. The model of each node, its timeout, maximum
+number of tokens, base URL (i.e. of a local OpenAI-compatible server), retries,
+deadline and hedging can be set in a TOML file::
+
+    [default]
+    model = "gpt-4o"
+
+    [nodes.CheckRelevanceNode]
+    model = "llama3.1:8b"
+    base_url = "http://localhost:11434/v1"
+    max_tokens = 32
+    hedge = true
+"""
+
+from __future__ import annotations
+import os
+import threading
+import tomllib
+from dataclasses import asdict, dataclass, fields, replace
+from loguru import logger
+from typing import TYPE_CHECKING, Any, Optional
+
+from insightly.utils import (
+    LARGE_MODEL,
+    LLM_DEADLINE_SECONDS,
+    LLM_RETRIES,
+    LLM_TIMEOUT_SECONDS,
+    SMALL_MODEL,
+)
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+
+# nodes writing SQL, every other node uses SMALL_MODEL unless configured
+SQL_NODES: frozenset[str] = frozenset({"SQLConverterNode", "RepairSQLNode"})
+
+
+@dataclass(frozen=True)
+class ModelConfig:
+    """
+    How a node calls its chat model.
+
+    Attributes
+    ----------
+    model : str
+        The model name.
+    timeout : float, optional
+        Seconds a single request may take before it fails.
+    max_tokens : int, optional
+        Maximum number of tokens of the answer.
+    base_url : str, optional
+        Base URL of an OpenAI-compatible server, OpenAI by default.
+    api_key_env : str, optional
+        Environment variable holding the API key, OPENAI_API_KEY by default.
+    temperature : float
+        The sampling temperature.
+    retries : int
+        Retries of a request that was rate limited or failed on the provider
+        side, see insightly.resilience.
+    deadline : float, optional
+        Seconds all requests of a call, retries included, may take.
+    hedge : bool
+        Whether to send a second request when the first is slower than
+        usual and take the first answer.
+    """
+
+    model: str
+    timeout: Optional[float] = LLM_TIMEOUT_SECONDS
+    max_tokens: Optional[int] = None
+    base_url: Optional[str] = None
+    api_key_env: Optional[str] = None
+    temperature: float = 0.0
+    retries: int = LLM_RETRIES
+    deadline: Optional[float] = LLM_DEADLINE_SECONDS
+    hedge: bool = False
+
+
+def _model_config(values: dict[str, Any], base: ModelConfig) -> ModelConfig:
+    """a config with the values of a table of the file set over a base config"""
+    known = {f.name for f in fields(ModelConfig)}
+    unknown = set(values) - known
+    if unknown:
+        raise ValueError(f"Unknown model settings: {', '.join(sorted(unknown))}.")
+    return replace(base, **values)
+
+
+class ModelRouter:
+    """
+    The model configuration of each node.
+
+    Attributes
+    ----------
+    default : ModelConfig
+        The configuration of the nodes writing SQL.
+    small : ModelConfig
+        The configuration of the other nodes.
+    nodes : dict[str, ModelConfig]
+        Configurations of single nodes, keyed by node class name.
+    """
+
+    def __init__(
+        self,
+        default: Optional[ModelConfig] = None,
+        small: Optional[ModelConfig] = None,
+        nodes: Optional[dict[str, ModelConfig]] = None,
+    ) -> None:
+        self.default = default or ModelConfig(LARGE_MODEL)
+        self.small = small or ModelConfig(SMALL_MODEL)
+        self.nodes = nodes or {}
+        self._clients: dict[ModelConfig, "ChatOpenAI"] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str) -> "ModelRouter":
+        """
+        Reads the configuration from a TOML file.
+
+        The [default] table configures the nodes writing SQL and [small]
+        the other nodes, which take the settings of [default] apart from the
+        model. [nodes.<NodeClass>] tables configure single nodes.
+
+        Parameters
+        ----------
+        path : str
+            The TOML file.
+
+        Returns
+        -------
+        ModelRouter
+            The router.
+        """
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+        default = _model_config(config.get("default", {}), ModelConfig(LARGE_MODEL))
+        small = _model_config(
+            config.get("small", {}), replace(default, model=SMALL_MODEL)
+        )
+        nodes = {
+            node: _model_config(values, default if node in SQL_NODES else small)
+            for node, values in config.get("nodes", {}).items()
+        }
+        return cls(default, small, nodes)
+
+    def config_for(self, node: str) -> ModelConfig:
+        """
+        The model configuration of a node.
+
+        Parameters
+        ----------
+        node : str
+            The class name of the node, i.e. "CheckRelevanceNode".
+
+        Returns
+        -------
+        ModelConfig
+            The configuration.
+        """
+        if node in self.nodes:
+            return self.nodes[node]
+        return self.default if node in SQL_NODES else self.small
+
+    def client(
+        self, config: ModelConfig, timeout: Optional[float] = None
+    ) -> "ChatOpenAI":
+        """
+        The chat model of a configuration, shared by the nodes using it.
+
+        Parameters
+        ----------
+        config : ModelConfig
+            The configuration.
+        timeout : float, optional
+            Seconds the requests may take instead of the timeout of the
+            configuration, i.e. the time left before the deadline of a call.
+
+        Returns
+        -------
+        ChatOpenAI
+            The chat model, which keeps its HTTP connections open between
+            calls.
+        """
+        with self._lock:
+            client = self._clients.get(config)
+            if client is None:
+                # imported on the first call, the OpenAI client is slow to import
+                from langchain_openai import ChatOpenAI
+
+                options: dict[str, Any] = {
+                    "model": config.model,
+                    "temperature": config.temperature,
+                    "timeout": config.timeout,
+                    "max_tokens": config.max_tokens,
+                    # retried by insightly.resilience
+                    "max_retries": 0,
+                }
+                if config.base_url is not None:
+                    options["base_url"] = config.base_url
+                if config.api_key_env is not None:
+                    options["api_key"] = os.getenv(config.api_key_env)
+                client = self._clients[config] = ChatOpenAI(**options)
+        if timeout is not None:
+            # a copy sharing the HTTP connections, the timeout is sent with
+            # every request
+            client = client.model_copy(
+                update={"model_kwargs": {**client.model_kwargs, "timeout": timeout}}
+            )
+        return client
+
+    def describe(self) -> dict[str, Any]:
+        """
+        The configuration, for the logs and the API.
+
+        Returns
+        -------
+        dict[str, Any]
+            The default, small and per-node configurations.
+        """
+        return {
+            "default": asdict(self.default),
+            "small": asdict(self.small),
+            "nodes": {node: asdict(config) for node, config in self.nodes.items()},
+        }
+
+
+# the router the nodes use, with the built-in models until setup_model_router
+model_router = ModelRouter()
+
+
+def setup_model_router(path: str) -> ModelRouter:
+    """
+    Configures the models of the nodes from a TOML file.
+
+    Parameters
+    ----------
+    path : str
+        The TOML file, see the module documentation.
+
+    Returns
+    -------
+    ModelRouter
+        The router the nodes now use.
+    """
+    global model_router
+    model_router = ModelRouter.from_file(path)
+    logger.info(f"Models of the nodes from {path}: {model_router.describe()}")
+    return model_router
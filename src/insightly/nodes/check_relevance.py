@@ -10,6 +10,7 @@ from langchain_core.runnables.config import RunnableConfig
 
 from insightly.classes import AgentState, ChatGPTNodeBase, T
 from insightly.insightly import Insightly
+from insightly.prompts import schema_prefix
 
 
 class CheckRelevance(BaseModel):
@@ -62,18 +63,14 @@ class CheckRelevanceNode(ChatGPTNodeBase):
             The updated state of the agent with the relevance information.
         """
         question: str = state["question"]
-        schema: str = Insightly().get_schema()
         logger.info(f"Checking relevance of the question: {question}")
-        system: str = (
-            """You are an assistant that determines whether a given question is related to the following database schema.
-
-Schema:
-{schema}
+        # the schema comes first, the prefix is shared with the other nodes
+        system: str = schema_prefix(Insightly()) + (
+            """
+You are an assistant that determines whether a given question is related to the database schema above.
 
 Respond with only "relevant" or "not_relevant".
-    """.format(
-                schema=schema
-            )
+"""
         )
         return system
 
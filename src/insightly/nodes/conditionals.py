@@ -1,5 +1,4 @@
 from loguru import logger
-from langgraph.graph import END
 
 from insightly.nodes.state import State
 from insightly.classes import ConditionalNode
@@ -20,30 +19,41 @@ class RelevanceConditionalNode(ConditionalNode):
             return State.GENERATE_FUNNY_RESPONSE
 
 
+class TemplateConditionalNode(ConditionalNode):
+    """Conditional node to skip the LLM when a template answered the question."""
+
+    def run(self, state: AgentState) -> str:
+        """Run the conditional node."""
+        if state.get("fast_path", False):
+            return State.EXECUTE_SQL
+        return State.CHECK_RELEVANCE
+
+
 class CheckErrorInSQLConditionalNode(ConditionalNode):
     """Conditional node to check for errors in SQL."""
 
     def run(self, state: AgentState) -> str:
         """Run the conditional node."""
+        from langgraph.graph import END
+
         logger.debug("Checking for errors in SQL.")
-        if not state.get("sql_error", False):
+        sql_query_info = state.get("sql_query_info") or {}
+        if state.get("fast_path", False):
+            if sql_query_info.get("sql_error", False):
+                logger.info("Template query failed, asking the LLM instead.")
+                return State.CHECK_RELEVANCE
+            # answers of templates are described without the LLM
+            return State.DESCRIBE_RESULT if state["meant_as_query"] else END
+        if not sql_query_info.get("sql_error", False):
             if state["meant_as_query"]:
                 # if the question is meant to be answered with SQL statement,
                 # generate a human response
                 return State.GENERATE_SUCCESS_RESPONSE
             # if not meant as query, get columns to plot
             return State.GET_COLUMNS
+        elif state["attempts"] < MAX_NUM_ATTEMPTS:
+            # fix the failed query, the question is left as it is
+            return State.REPAIR_SQL
         else:
-            return State.REGENERATE_QUERY
-
-
-class CheckNumberOfAttemptsConditionalNode(ConditionalNode):
-    """Conditional node to check the number of attempts."""
-
-    def run(self, state: AgentState) -> str:
-        """Run the conditional node."""
-        logger.debug("Checking the number of attempts.")
-        if state["attempts"] < MAX_NUM_ATTEMPTS:
-            return State.REGENERATE_QUERY
-        else:
+            logger.warning("SQL query still fails after the last repair.")
             return END
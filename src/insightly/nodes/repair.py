@@ -0,0 +1,176 @@
+"""SQL repair node for Insightly agent"""
+
+import re
+from loguru import logger
+
+from pydantic import BaseModel, Field
+from langchain_core.runnables.config import RunnableConfig
+
+import insightly.repairs as repairs
+from insightly.classes import AgentState, ChatGPTNodeBase, RepairAttempt, T
+from insightly.insightly import Insightly
+from insightly.log import summarise
+
+
+class RepairedSQL(BaseModel):
+    """The fixed SQL query.
+
+    Attributes
+    ----------
+    sql_query: str
+        The failed SQL query with the error fixed.
+    """
+
+    sql_query: str = Field(description="The failed SQL query with the error fixed.")
+
+
+def _escape(text: str) -> str:
+    """text with braces escaped, they would be read as prompt template variables"""
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def schema_slice(insightly: Insightly, sql_query: str) -> str:
+    """
+    The schema of the tables a query refers to.
+
+    Parameters
+    ----------
+    insightly : Insightly
+        The database the query ran on.
+    sql_query : str
+        The query, which may not parse.
+
+    Returns
+    -------
+    str
+        The schema of the tables named in the query, of every table if it
+        names none of them.
+    """
+    tables = [
+        table
+        for table in insightly.tables
+        if re.search(rf"\b{re.escape(table)}\b", sql_query, re.IGNORECASE)
+    ]
+    if not tables:
+        return insightly.get_schema()
+    return "".join(insightly.get_schema(table_name=table) for table in tables)
+
+
+class RepairSQLNode(ChatGPTNodeBase):
+    """Class to fix a failed SQL query.
+
+    The failed query is fixed with a rule learned from an earlier fix of the
+    same error when there is one. Otherwise the model is sent the query, the
+    exact error and the schema of the tables it refers to, and edits the
+    query rather than writing a new one from the question.
+    """
+
+    def __init__(self, OutputClass: type[T]) -> None:
+        """
+        Initialize the RepairSQLNode class.
+        """
+        super().__init__(OutputClass=OutputClass)
+
+    def init_query(self, state: AgentState, config: RunnableConfig) -> str:
+        """Build the system prompt with the schema of the tables of the query.
+
+        Parameters
+        ----------
+        state : AgentState
+            The current state of the agent.
+        config : RunnableConfig
+            The configuration for the runnable.
+
+        Returns
+        -------
+        str
+            The system prompt to be used for the ChatOpenAI model.
+        """
+        insightly = Insightly()
+        sql_query_info = state["sql_query_info"]
+        error = str(sql_query_info["query_result"])
+        system = """You are an assistant that fixes DuckDB SQL queries that failed. Change only what the error requires and keep what the query computes.
+Tables are referenced as {db_name}.<table>. The tables of the query are:
+{schema}
+Provide only the fixed SQL query without any explanations.
+""".format(
+            db_name=insightly.db_name,
+            schema=schema_slice(insightly, sql_query_info["sql_query"]),
+        )
+        hints = repairs.repair_rules.hints(error, insightly.db_name)
+        if hints:
+            system += "\nErrors like this one were fixed before with these edits:\n"
+            system += "".join(
+                f"- {rule['error']}: "
+                + ", ".join(f"'{old}' -> '{new}'" for old, new in rule["edits"])
+                + "\n"
+                for rule in hints
+            )
+        return _escape(system)
+
+    def post_query(
+        self, result: RepairedSQL, state: AgentState, config: RunnableConfig
+    ) -> AgentState:
+        """Replace the failed query with the fixed one.
+
+        Parameters
+        ----------
+        result : RepairedSQL
+            The fixed query.
+        state : AgentState
+            The current state of the agent.
+        config : RunnableConfig
+            The configuration for the runnable.
+
+        Returns
+        -------
+        AgentState
+            The updated state of the agent with the fixed query and the
+            attempts increased by one.
+        """
+        state["sql_query_info"]["sql_query"] = result.sql_query
+        state["attempts"] += 1
+        logger.debug(f"Repaired SQL query: {summarise(result.sql_query)}")
+        return state
+
+    def run(self, state: AgentState, config: RunnableConfig) -> AgentState:
+        """Fix the failed query with a learned rule or a single model call.
+
+        Parameters
+        ----------
+        state : AgentState
+            The current state of the agent.
+        config : RunnableConfig
+            The configuration for the runnable.
+
+        Returns
+        -------
+        AgentState
+            The updated state of the agent with the fixed query.
+        """
+        sql_query_info = state["sql_query_info"]
+        failed_query = sql_query_info["sql_query"]
+        error = str(sql_query_info["query_result"])
+        previous = sql_query_info.get("repair") or {}
+        logger.info(f"Repairing SQL query after: {summarise(error)}")
+
+        fixed = None
+        if not previous.get("from_rule"):
+            # a rule that already failed on this question is not tried again
+            fixed = repairs.repair_rules.apply(
+                error, failed_query, Insightly().db_name
+            )
+        sql_query_info["repair"] = RepairAttempt(
+            sql_query=failed_query, error=error, from_rule=fixed is not None
+        )
+        if fixed is not None:
+            return self.post_query(RepairedSQL(sql_query=fixed), state, config)
+
+        system = self.init_query(state, config)
+        human = (
+            f"Question: {state['question']}\n"
+            f"Query:\n{failed_query}\n"
+            f"Error:\n{error}"
+        )
+        result: RepairedSQL = self.run_chatgpt(question=_escape(human), system=system)
+        return self.post_query(result, state, config)
@@ -2,10 +2,9 @@ from loguru import logger
 
 from pydantic import BaseModel, Field
 from langchain_core.runnables.config import RunnableConfig
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
 
 from insightly.classes import AgentState, ChatGPTNodeBase, T, SqlQueryInfo
+from insightly.log import summarise
 
 
 class FunnyResponse(BaseModel):
@@ -98,110 +97,9 @@ class FunnyResponseNode(ChatGPTNodeBase):
             The updated state of the agent with the funny response.
         """
         system = self.init_query(state, config)
-        logger.info(f"Running node with question: {system}")
+        logger.info(f"Running node with question: {summarise(system)}")
         result: T = self.run_chatgpt(
             question="I can't help with that unfortunately!",
             system=system,
         )
         return self.post_query(result, state, config)
-
-
-class RewrittenQuestion(BaseModel):
-    """Field to retrieve the rewritten question.
-
-    Attributes
-    ----------
-    question: str
-        The rewritten question generated by the assistant.
-    """
-
-    question: str = Field(description="The rewritten question.")
-
-
-class RegenerateQueryNode(ChatGPTNodeBase):
-    """Class to regenerate the SQL query by rewriting the question.
-
-    This class is used to reformulate the original question to enable more precise SQL queries.
-    """
-
-    def __init__(self, OutputClass: type[T]) -> None:
-        """
-        Initialize the RegenerateQueryNode class.
-        """
-        super().__init__(OutputClass=OutputClass)
-
-    def init_query(self, state: AgentState, config: RunnableConfig) -> str:
-        """Regenerate the SQL query by rewriting the question.
-
-        Parameters
-        ----------
-        state : AgentState
-            The current state of the agent.
-        config : RunnableConfig
-            The configuration for the runnable.
-
-        Returns
-        -------
-        str
-            The system prompt to be used for the ChatOpenAI model.
-        """
-        logger.debug("Regenerating the SQL query by rewriting the question.")
-        system = """You are an assistant that reformulates an original question to enable more precise SQL queries. Ensure that all necessary details, such as table joins, are preserved to retrieve complete and accurate data.
-        """
-        return system
-
-    def run(self, state: AgentState, config: RunnableConfig) -> AgentState:
-        """Run the node to get an output and an AgentState. Different compared to base class
-        as the input to the human part of the model has some clarifications to what to generate.
-
-        Parameters
-        ----------
-        state : AgentState
-            The current state of the agent.
-        config : RunnableConfig
-            The configuration for the runnable.
-
-        Returns
-        -------
-        AgentState
-            The updated state of the agent with the rewritten question.
-        """
-        system = self.init_query(state, config)
-        rewrite_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", system),
-                (
-                    "human",
-                    f"Original Question: {state['question']}\nReformulate the question to enable more precise SQL queries, ensuring all necessary details are preserved.",
-                ),
-            ]
-        )
-        llm = ChatOpenAI(temperature=0)
-        structured_llm = llm.with_structured_output(RewrittenQuestion)
-        rewriter = rewrite_prompt | structured_llm
-        result = rewriter.invoke({})
-        return self.post_query(result, state, config)
-
-    def post_query(
-        self, result: RewrittenQuestion, state: AgentState, config: RunnableConfig
-    ):
-        """adds pydantic result to the state and returns with a + 1 to the attempts
-
-        Parameters
-        ----------
-        result : RewrittenQuestion
-            The result of the query indicating the rewritten question.
-        state : AgentState
-            The state of the agent containing the question and other information.
-        config : RunnableConfig
-            The configuration for the runnable.
-
-        Returns
-        -------
-        AgentState
-            The updated state of the agent with the rewritten question.
-        """
-        state["question"] = result.question
-        state["attempts"] += 1
-        logger.debug(f"Rewritten question: {state['question']}")
-        return state
@@ -2,14 +2,18 @@
 
 from loguru import logger
 
-import duckdb
 from pydantic import BaseModel, Field
 from pydantic import Field, BaseModel
 from langchain_core.runnables.config import RunnableConfig
 
-from insightly.classes import AgentState, ChatGPTNodeBase, Node, T, PlotType
-from insightly.plotting import BarPlot, ScatterPlot
-from insightly.insightly import Insightly
+import insightly.admission as admission
+import insightly.repairs as repairs
+from insightly.admission import AdmissionRejected
+from insightly.classes import AgentState, ChatGPTNodeBase, Node, T
+from insightly.insightly import Insightly, QueryTimeoutError
+from insightly.log import summarise
+from insightly.prompts import schema_prefix
+from insightly.results import describe_handle, make_handle
 
 
 class ConvertToSQL(BaseModel):
@@ -59,20 +63,15 @@ class SQLConverterNode(ChatGPTNodeBase):
         """
         logger.info("Convert natural language to SQL")
         question = state["question"]
-        schema = Insightly().get_schema()
         logger.info(f"Converting question to SQL: {question}")
-        system = """You are an assistant that converts natural language questions into SQL queries based on the following schema:
-database name: {db_name}
-{schema}
-
-All tables should begin with the database name (i.e. {db_name}.foods).
+        # the schema comes first, the prefix is shared with the other nodes
+        system = schema_prefix(Insightly()) + """
+You are an assistant that converts natural language questions into SQL queries based on the schema above.
 
 Provide only the SQL query without any explanations. Alias columns appropriately to match the expected keys in the result.
 
 For example, alias 'food.name' as 'food_name' and 'food.price' as 'price'.
-""".format(
-            schema=schema, db_name=Insightly().db_name
-        )
+"""
         return system
 
     def post_query(
@@ -109,18 +108,17 @@ class ExecuteSQL(Node):
         This function retrieves the SQL query from the state and prepares
         """
         sql_query = state["sql_query_info"]["sql_query"].strip()
-        logger.info(f"Executing SQL query: {sql_query}")
+        logger.info(f"Executing SQL query: {summarise(sql_query)}")
         return sql_query
 
-    def post_query(
-        self, result: duckdb.DuckDBPyRelation, state: AgentState, config: RunnableConfig
-    ):
+    def post_query(self, result: bool, state: AgentState, config: RunnableConfig):
         """Post querym select required info to the state
 
         Parameters
         ----------
-        result : duckdb.DuckDBPyRelation
-            The result of the SQL query execution.
+        result : bool
+            Whether the query returned rows, which are then stored in the
+            result table.
         state : AgentState
             The current state of the agent.
         config : RunnableConfig
@@ -131,15 +129,22 @@ class ExecuteSQL(Node):
         AgentState
             The updated state of the agent with the SQL query result.
         """
-        sql_query: str = state["sql_query_info"]["sql_query"]
-        if sql_query.lower().startswith("select"):
-            dataframe = result.df()
-            state["sql_query_info"]["query_result"] = dataframe
-            logger.debug("SUCCESSFUL EXECUTION OF SQL QUERY")
-            # duckdb add the new df to the database
-            Insightly().add_df_to_duckdb(
-                dataframe, state["sql_query_info"]["table_name"]
+        repair = state["sql_query_info"].get("repair")
+        if repair is not None:
+            # the repaired query worked, keep the fix for the next such error
+            repairs.repair_rules.learn(
+                repair["error"],
+                repair["sql_query"],
+                state["sql_query_info"]["sql_query"],
+                Insightly().db_name,
+            )
+            state["sql_query_info"]["repair"] = None
+        if result:
+            # the state only keeps a handle, the rows stay in DuckDB
+            state["sql_query_info"]["query_result"] = make_handle(
+                state["sql_query_info"]["table_name"]
             )
+            logger.debug("SUCCESSFUL EXECUTION OF SQL QUERY")
             state["sql_query_info"]["sql_error"] = False
             logger.debug("SQL SELECT query executed successfully.")
         else:
@@ -148,10 +153,64 @@ class ExecuteSQL(Node):
             ] = "The action has been successfully completed."
             state["sql_query_info"]["sql_error"] = False
             logger.debug("SQL command executed successfully.")
+        return state
+
+    def preview(self, sql_query: str, state: AgentState, configurable: dict) -> None:
+        """Stream an approximate answer computed over samples of the tables.
+
+        The preview is written to the custom stream of the graph, see
+        `insightly.workflow.stream`, before the exact query runs. It runs with
+        the limits of the exact query and holds a DuckDB slot, and is skipped
+        when no slot is free.
+
+        Parameters
+        ----------
+        sql_query : str
+            The SQL query to approximate.
+        state : AgentState
+            The current state of the agent.
+        configurable : dict
+            The `configurable` section of the config, with the query timeout.
+        """
+        from langgraph.config import get_stream_writer
+
+        from insightly.sampling import approximate_query
+
+        try:
+            with admission.admission_controller.duckdb_slot():
+                preview = approximate_query(
+                    Insightly(),
+                    sql_query,
+                    timeout=configurable.get("query_timeout"),
+                )
+        except AdmissionRejected:
+            logger.debug("No DuckDB slot for the approximate answer")
+            return
+        except Exception as e:
+            logger.warning(f"Could not compute an approximate answer: {e}")
+            return
+        if preview is None:
+            return
+        logger.debug(
+            f"Approximate answer over {preview['sample_fraction']:.4%} of the rows"
+        )
+        get_stream_writer()(
+            {
+                "question": state["question"],
+                "sql_query": sql_query,
+                "preview": preview,
+            }
+        )
 
     def run(self, state: AgentState, config: RunnableConfig) -> AgentState:
         """Run the SQL query and execute it on the database.
 
+        Per-request limits can be passed through the `configurable` section of
+        the config as `query_timeout` and `auto_limit`; they fall back to the
+        limits set on `Insightly`. Memory and threads are set per database.
+        With `approximate` set, an answer over samples of the large tables is
+        streamed first.
+
         Parameters
         ----------
         state : AgentState
@@ -165,9 +224,32 @@ class ExecuteSQL(Node):
             The updated state of the agent with the SQL query result.
         """
         sql_query: str = self.init_query(state, config)
+        configurable: dict = (config or {}).get("configurable", {})
+        if configurable.get("approximate"):
+            self.preview(sql_query, state, configurable)
         try:
-            result: duckdb.DuckDBPyRelation = Insightly().execute_query(sql_query)
+            # bounded across the databases of the process, see insightly.admission
+            with admission.admission_controller.duckdb_slot():
+                result: bool = Insightly().materialize_query(
+                    sql_query,
+                    state["sql_query_info"]["table_name"],
+                    timeout=configurable.get("query_timeout"),
+                    auto_limit=configurable.get("auto_limit"),
+                    query_id=configurable.get("query_id"),
+                )
             return self.post_query(result, state, config)
+        except AdmissionRejected:
+            # the query is not wrong, the question is turned away
+            raise
+        except QueryTimeoutError as e:
+            # tell the retry path that the query was too expensive, not wrong
+            state["sql_query_info"]["query_result"] = (
+                f"Error executing SQL query: {str(e)} "
+                "Write a cheaper query, i.e. filter or aggregate earlier, "
+                "avoid cross joins and limit the number of rows returned."
+            )
+            state["sql_query_info"]["sql_error"] = True
+            logger.error(f"SQL query timed out after {e.timeout:g} seconds.")
         except Exception as e:
             state["sql_query_info"][
                 "query_result"
@@ -221,14 +303,15 @@ class GetColumnsNode(ChatGPTNodeBase):
             table_name=state["sql_query_info"]["table_name"]
         )
         logger.debug(f"Getting columns: {question}")
-        logger.debug("current schema: ", schema)
-        system = """You are an assistant that chooses the appropriate columns for a scatter plot based on the following schema:
-
-{schema}
+        logger.debug(f"current schema: {summarise(schema)}")
+        # the instructions come first, they are the same for every question
+        system = """You are an assistant that chooses the appropriate columns for a scatter plot based on the schema below.
 
 Provide only the columns to be used in the scatter plot without any explanations.
 The columns should be suitable for a scatter plot, typically two numerical columns.
 Only return the names of the columns with no SQL, in the order they should be used in the plot (i.e. x1, y1, x2, y2).
+
+{schema}
 """.format(
             schema=schema
         )
@@ -237,8 +320,7 @@ Only return the names of the columns with no SQL, in the order they should be us
     def post_query(
         self, result: Columns, state: AgentState, config: RunnableConfig
     ) -> AgentState:
-        """turn the columns into a plot, add the plot and columns to the sstate
-        and return the state
+        """add the columns to plot to the state and return the state
 
         Parameters
         ----------
@@ -252,22 +334,12 @@ Only return the names of the columns with no SQL, in the order they should be us
         Returns
         -------
         AgentState
-            The updated state of the agent with the selected columns and plot.
+            The updated state of the agent with the selected columns.
         """
         state["plot_query_info"]["columns"] = result.columns
-        # create a plot dependent on the type of plot type passed earlier
-        if state["plot_query_info"]["plot_type"] == PlotType.SCATTER:
-            scatter_plot = ScatterPlot()
-            state["plot_query_info"]["result"] = scatter_plot.generate(
-                state["sql_query_info"]["query_result"],
-                state["plot_query_info"]["columns"],
-            )
-        elif state["plot_query_info"]["plot_type"] == PlotType.BAR:
-            bar_plot = BarPlot()
-            state["plot_query_info"]["result"] = bar_plot.generate(
-                state["sql_query_info"]["query_result"],
-                state["plot_query_info"]["columns"],
-            )
+        # the figure is built from the result table when it is returned, so
+        # the state never carries it (see insightly.plotting.build_figure)
+        state["plot_query_info"]["result"] = None
         logger.info(
             f"Selected columns for scatter plot: {state['plot_query_info']['columns']}"
         )
@@ -313,7 +385,15 @@ class HumanResponseNode(ChatGPTNodeBase):
             The system prompt to be used for the ChatOpenAI model.
         """
         question = state["question"]
-        answer: str = state["sql_query_info"]["query_result"]
+        query_result = state["sql_query_info"]["query_result"]
+        # only the preview rows of the result are shown to the model
+        answer: str = (
+            query_result
+            if isinstance(query_result, str)
+            else describe_handle(query_result)
+        )
+        # braces would be read as prompt template variables
+        answer = answer.replace("{", "{{").replace("}", "}}")
         logger.debug(f"Waiting for human response to the question: {question}")
         system = """You are an assistant that retrieves the result of a question asked
     by a human and provides a normal response based on the question. The answer is {answer}""".format(
@@ -4,7 +4,6 @@ is intended to be an SQL query or a plot based on the provided schema.
 """
 
 from loguru import logger
-from random import randint
 
 from pydantic import BaseModel, Field
 from langchain_core.runnables.config import RunnableConfig
@@ -19,6 +18,8 @@ from insightly.classes import (
     T,
 )
 from insightly.insightly import Insightly
+from insightly.prompts import schema_prefix
+from insightly.utils import result_table_name
 
 
 class CheckIfSQLOrPlotReturn(BaseModel):
@@ -73,15 +74,14 @@ class SQLOrPlotNode(ChatGPTNodeBase):
         logger.info(
             f"Checking if the question requires an SQL query or a plot: {question}"
         )
-        schema = Insightly().get_schema()
-        system = """
-You are an assistant that determines whether a given question requires an SQL query or a plot based on the following schema:
-{schema}
+        # the schema comes first, the prefix is shared with the other nodes
+        system = schema_prefix(Insightly()) + """
+You are an assistant that determines whether a given question requires an SQL query or a plot based on the schema above.
 
 Respond with 'sql' if the question is related to data retrieval or manipulation that can be expressed in SQL.
 If the question is related to data visualization, choose one of the following plot types with no explanation: {plot_types}.
 """.format(
-            schema=schema, plot_types=", ".join([member.value for member in PlotType])
+            plot_types=", ".join([member.value for member in PlotType])
         )
         return system
 
@@ -105,12 +105,14 @@ If the question is related to data visualization, choose one of the following pl
             The updated state of the agent with the SQL query or plot information.
         """
         state["meant_as_query"] = result.meant_as_query == QueryType.SQL
+        # from here on the LLM answers, even after a template query failed
+        state["fast_path"] = False
         logger.info("MEANT AS QUERY: {}".format(state["meant_as_query"]))
-        # generate a random table name for the SQL query and the typed dictionaries
+        # name a new result table for the SQL query and the typed dictionaries
         state["sql_query_info"] = SqlQueryInfo(
             sql_query="",
             query_result="",
-            table_name=f"transformation_{randint(0, 10000)}",
+            table_name=result_table_name(),
             query_rows=[],
         )
         state["plot_query_info"] = PlotQueryInfo(
@@ -0,0 +1,123 @@
+"""Template nodes answering common questions without the LLM"""
+
+from loguru import logger
+
+from langchain_core.runnables.config import RunnableConfig
+
+from insightly.classes import AgentState, Node, PlotQueryInfo, SqlQueryInfo
+from insightly.insightly import Insightly
+from insightly.results import describe_handle
+from insightly.templates import TemplateAnswer, match_template
+from insightly.utils import result_table_name
+
+
+class TemplateNode(Node):
+    """Class to answer a question with a template before asking the LLM.
+
+    The question is matched against the templates of `insightly.templates`.
+    On a match the SQL query and plot are set directly and the run goes on to
+    EXECUTE_SQL, otherwise it starts the LLM graph at CHECK_RELEVANCE.
+    """
+
+    def post_query(
+        self, result: TemplateAnswer, state: AgentState, config: RunnableConfig
+    ) -> AgentState:
+        """Set the query and plot of the template answer.
+
+        Parameters
+        ----------
+        result : TemplateAnswer
+            The query and plot the template produced.
+        state : AgentState
+            The current state of the agent.
+        config : RunnableConfig
+            The configuration for the runnable.
+
+        Returns
+        -------
+        AgentState
+            The updated state of the agent, ready to execute the query.
+        """
+        state["fast_path"] = True
+        state["relevance"] = "relevant"
+        state["meant_as_query"] = result["meant_as_query"]
+        state["sql_query_info"] = SqlQueryInfo(
+            sql_query=result["sql_query"],
+            query_result="",
+            table_name=result_table_name(),
+            query_rows=[],
+        )
+        state["plot_query_info"] = PlotQueryInfo(
+            plot_type=result["plot_type"].value if result["plot_type"] else None,
+            columns=result["columns"],
+            result=None,
+        )
+        logger.info(f"Answered by a template: {result['sql_query']}")
+        return state
+
+    def run(self, state: AgentState, config: RunnableConfig) -> AgentState:
+        """Match the question against the templates.
+
+        Templates can be turned off for a request with `templates` set to
+        False in the `configurable` section of the config.
+
+        Parameters
+        ----------
+        state : AgentState
+            The current state of the agent.
+        config : RunnableConfig
+            The configuration for the runnable.
+
+        Returns
+        -------
+        AgentState
+            The updated state of the agent, with `fast_path` set if a
+            template answered the question.
+        """
+        state["fast_path"] = False
+        configurable: dict = (config or {}).get("configurable", {})
+        if not configurable.get("templates", True):
+            return state
+        try:
+            result = match_template(Insightly(), state["question"])
+        except Exception as e:
+            # the LLM graph can still answer
+            logger.warning(f"Could not match the question to a template: {e}")
+            return state
+        if result is None:
+            logger.debug("No template matched the question.")
+            return state
+        return self.post_query(result, state, config)
+
+
+class DescribeResultNode(Node):
+    """Class to describe the result of a template query without the LLM."""
+
+    def run(self, state: AgentState, config: RunnableConfig) -> AgentState:
+        """Describe the result as the success response.
+
+        Parameters
+        ----------
+        state : AgentState
+            The current state of the agent.
+        config : RunnableConfig
+            The configuration for the runnable.
+
+        Returns
+        -------
+        AgentState
+            The updated state of the agent with the success response.
+        """
+        query_result = state["sql_query_info"]["query_result"]
+        if isinstance(query_result, str):
+            response = query_result
+        elif query_result["row_count"] == 1 and len(query_result["columns"]) == 1:
+            name = query_result["columns"][0]["name"]
+            response = f"The {name} is {query_result['preview'][name][0]}."
+        else:
+            response = (
+                f"The result has {query_result['row_count']} rows:\n"
+                f"{describe_handle(query_result)}"
+            )
+        state["sql_query_info"]["success_response"] = response
+        return state
@@ -1,18 +1,105 @@
+from typing import Optional
+
 from loguru import logger
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 
-from insightly.plots.plot import Plot
+from insightly.plots.plot import Plot, is_numeric_type
+from insightly.utils import BAR_TOP_N, quote_identifier
+
+# aggregates a bar can show, with how to combine them for the "other" bar
+AGGREGATES: dict[str, str] = {
+    "sum": "sum(value)",
+    "count": "sum(value)",
+    "avg": "sum(total) / nullif(sum(n), 0)",
+}
 
 
 class BarPlot(Plot):
-    def generate(self, df: pd.DataFrame, columns: list[str]) -> go.Figure:
+    def __init__(self, aggregate: str = "sum", top_n: int = BAR_TOP_N) -> None:
+        """
+        Initialize the BarPlot class.
+
+        Parameters
+        ----------
+        aggregate : str, optional
+            How to combine the values of a category, "sum", "count" or "avg".
+            Non-numeric values are always counted.
+        top_n : int, optional
+            Number of categories to show before the rest are grouped as "other".
+        """
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"Unknown bar aggregate {aggregate!r}.")
+        self.aggregate = aggregate
+        self.top_n = top_n
+
+    def reduce(
+        self,
+        df: Optional[pd.DataFrame],
+        columns: list[str],
+        table_name: Optional[str] = None,
+    ) -> tuple[str, pd.DataFrame]:
         # columns = state.get("columns", [])
         # if len(columns) != 2:
         #     raise ValueError("Bar plot requires exactly one column.")
         logger.debug("GENERATE BAR PLOT")
-        logger.debug(df)
 
-        # Generate a bar plot (this is a placeholder, actual plotting code would go here)
-        return px.bar(df, x=columns[0], y=columns[1])
+        # aggregate in DuckDB so the figure has one bar per category
+        with self.source(df, table_name) as (cursor, source):
+            x = quote_identifier(columns[0])
+            aggregate = self.aggregate
+            y = "*"
+            if len(columns) > 1:
+                y = quote_identifier(columns[1])
+                y_type = cursor.execute(f"DESCRIBE SELECT {y} FROM {source}").fetchone()[1]
+                if not is_numeric_type(y_type):
+                    aggregate = "count"
+            else:
+                # a single column can only be counted
+                aggregate = "count"
+            if y == "*" or aggregate == "sum":
+                y_label = columns[1] if y != "*" else "count"
+            else:
+                y_label = f"{aggregate} of {columns[1]}"
+            y_total = f"sum({y})" if aggregate == "avg" else "NULL"
+
+            # temporary tables belong to the cursor and go away when it closes
+            cursor.execute(
+                f"""
+                CREATE TEMP TABLE bar_groups AS
+                SELECT {x} AS category, {aggregate}({y}) AS value,
+                    {y_total} AS total, count({y}) AS n
+                FROM {source}
+                GROUP BY {x}
+                """
+            )
+            n_categories = cursor.execute("SELECT count(*) FROM bar_groups").fetchone()[0]
+            if n_categories <= self.top_n:
+                bars = cursor.execute(
+                    "SELECT category, value FROM bar_groups ORDER BY category"
+                ).df()
+            else:
+                bars = cursor.execute(
+                    f"""
+                    WITH ranked AS (
+                        SELECT *, row_number() OVER (ORDER BY value DESC NULLS LAST) AS rank
+                        FROM bar_groups
+                    )
+                    SELECT category, value FROM (
+                        SELECT category::VARCHAR AS category, value, rank
+                        FROM ranked WHERE rank <= {self.top_n}
+                        UNION ALL
+                        SELECT 'other', {AGGREGATES[aggregate]}, {self.top_n + 1}
+                        FROM ranked WHERE rank > {self.top_n}
+                    )
+                    ORDER BY rank
+                    """
+                ).df()
+        logger.debug(f"Bar plot aggregated to {len(bars)} of {n_categories} categories")
+        bars.columns = [columns[0], y_label]
+        return "bars", bars
+
+    def figure(self, kind: str, data: pd.DataFrame, columns: list[str]) -> go.Figure:
+        # the second column is named after the aggregate
+        return px.bar(data, x=data.columns[0], y=data.columns[1])
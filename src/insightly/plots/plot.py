@@ -1,20 +1,145 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Iterator, Optional
 
+import duckdb
 import pandas as pd
 import plotly.graph_objects as go
 
+from insightly.insightly import Insightly
+from insightly.utils import quote_identifier
+
+# DuckDB column types that can be binned or summed
+NUMERIC_TYPES: set[str] = {
+    "TINYINT",
+    "SMALLINT",
+    "INTEGER",
+    "BIGINT",
+    "HUGEINT",
+    "UTINYINT",
+    "USMALLINT",
+    "UINTEGER",
+    "UBIGINT",
+    "FLOAT",
+    "DOUBLE",
+}
+
+
+# DuckDB column types holding points in time, binned like numbers
+TEMPORAL_TYPES: set[str] = {
+    "DATE",
+    "TIME",
+    "TIMESTAMP",
+    "TIMESTAMP_S",
+    "TIMESTAMP_MS",
+    "TIMESTAMP_NS",
+    "TIMESTAMP WITH TIME ZONE",
+}
+
+
+def is_numeric_type(column_type: str) -> bool:
+    """Check whether a DuckDB column type is numeric."""
+    return column_type in NUMERIC_TYPES or column_type.startswith("DECIMAL")
+
+
+def is_temporal_type(column_type: str) -> bool:
+    """Check whether a DuckDB column type is a date, time or timestamp."""
+    return column_type in TEMPORAL_TYPES
+
+
 class Plot(ABC):
-    @abstractmethod
-    def generate(self, df: pd.DataFrame, columns: list[str]) -> go.Figure:
+    def generate(
+        self,
+        df: Optional[pd.DataFrame],
+        columns: list[str],
+        table_name: Optional[str] = None,
+    ) -> go.Figure:
         """Plot the data and return the path to the plot.
 
         Parameters
         ----------
         can put anything you want into this bad boy
+        df : pd.DataFrame, optional
+            The rows to plot, read from `table_name` when None.
+        table_name : str, optional
+            The DuckDB table holding the rows to plot, used to aggregate
+            large results in the database instead of in the figure.
 
         Returns
         -------
         str
             The path to the plot.
         """
-        pass
+        kind, data = self.reduce(df, columns, table_name)
+        return self.figure(kind, data, columns)
+
+    @abstractmethod
+    def reduce(
+        self,
+        df: Optional[pd.DataFrame],
+        columns: list[str],
+        table_name: Optional[str] = None,
+    ) -> tuple[str, pd.DataFrame]:
+        """Select and aggregate the rows to plot in DuckDB.
+
+        Parameters
+        ----------
+        df : pd.DataFrame, optional
+            The rows to plot, read from `table_name` when None.
+        columns : list[str]
+            The columns to plot.
+        table_name : str, optional
+            The DuckDB table holding the rows to plot.
+
+        Returns
+        -------
+        tuple[str, pd.DataFrame]
+            How the rows are to be drawn and the rows, holding only the
+            plotted columns.
+        """
+
+    @abstractmethod
+    def figure(self, kind: str, data: pd.DataFrame, columns: list[str]) -> go.Figure:
+        """Draw the rows returned by `reduce`.
+
+        Parameters
+        ----------
+        kind : str
+            How the rows are to be drawn, as returned by `reduce`.
+        data : pd.DataFrame
+            The rows returned by `reduce`.
+        columns : list[str]
+            The columns to plot.
+
+        Returns
+        -------
+        go.Figure
+            The figure.
+        """
+
+    @contextmanager
+    def source(
+        self, df: pd.DataFrame, table_name: Optional[str] = None
+    ) -> Iterator[tuple[duckdb.DuckDBPyConnection, str]]:
+        """Open a cursor to query the rows to plot in DuckDB.
+
+        Parameters
+        ----------
+        df : pd.DataFrame, optional
+            The rows to plot, registered as a view if there is no table.
+        table_name : str, optional
+            The DuckDB table holding the rows to plot.
+
+        Returns
+        -------
+        Iterator[tuple[duckdb.DuckDBPyConnection, str]]
+            The cursor and the quoted name to select the rows from.
+        """
+        cursor = Insightly().conn.cursor()
+        try:
+            if table_name is None:
+                cursor.register("plot_source", df)
+                table_name = "plot_source"
+            yield cursor, quote_identifier(table_name)
+        finally:
+            cursor.close()
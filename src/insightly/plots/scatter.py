@@ -1,15 +1,172 @@
 
+from typing import Optional
+
+from loguru import logger
+import duckdb
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
 
-from insightly.plots.plot import Plot
+from insightly.plots.plot import Plot, is_numeric_type, is_temporal_type
+from insightly.utils import (
+    SCATTER_AGGREGATE_THRESHOLD,
+    SCATTER_DENSITY_BINS,
+    SCATTER_SAMPLE_POINTS,
+    SCATTER_WEBGL_THRESHOLD,
+    quote_identifier,
+)
+
 
 class ScatterPlot(Plot):
-    def generate(self, df: pd.DataFrame, columns: list[str]) -> go.Figure:
+    def reduce(
+        self,
+        df: Optional[pd.DataFrame],
+        columns: list[str],
+        table_name: Optional[str] = None,
+    ) -> tuple[str, pd.DataFrame]:
         # columns = state.get("columns", [])
         if len(columns) != 2:
             raise ValueError("Scatter plot requires exactly two columns.")
-        
-        # Generate a scatter plot (this is a placeholder, actual plotting code would go here)
-        return px.scatter(df, x=columns[0], y=columns[1])
\ No newline at end of file
+
+        with self.source(df, table_name) as (cursor, source):
+            n_rows: int = (
+                len(df)
+                if df is not None
+                else cursor.execute(f"SELECT count(*) FROM {source}").fetchone()[0]
+            )
+            if n_rows > SCATTER_AGGREGATE_THRESHOLD:
+                # too many points for the browser, reduce them in DuckDB first
+                return self._aggregate(cursor, source, columns, n_rows)
+            x, y = (quote_identifier(column) for column in columns)
+            return "points", cursor.execute(f"SELECT {x}, {y} FROM {source}").df()
+
+    def figure(self, kind: str, data: pd.DataFrame, columns: list[str]) -> go.Figure:
+        if kind == "density":
+            return px.density_heatmap(
+                data,
+                x=columns[0],
+                y=columns[1],
+                z="count",
+                histfunc="sum",
+                nbinsx=SCATTER_DENSITY_BINS,
+                nbinsy=SCATTER_DENSITY_BINS,
+            )
+        if len(data) <= SCATTER_WEBGL_THRESHOLD:
+            return px.scatter(data, x=columns[0], y=columns[1])
+        return px.scatter(data, x=columns[0], y=columns[1], render_mode="webgl")
+
+    def _aggregate(
+        self,
+        cursor: duckdb.DuckDBPyConnection,
+        source: str,
+        columns: list[str],
+        n_rows: int,
+    ) -> tuple[str, pd.DataFrame]:
+        """Bin numbers and times into a density grid, sample anything else.
+
+        Parameters
+        ----------
+        cursor : duckdb.DuckDBPyConnection
+            The cursor to run the aggregation on.
+        source : str
+            The quoted table holding the rows to plot.
+        columns : list[str]
+            The x and y columns.
+        n_rows : int
+            The number of rows in the table.
+
+        Returns
+        -------
+        tuple[str, pd.DataFrame]
+            The counts of a density grid, or a sample of the points.
+        """
+        x, y = (quote_identifier(column) for column in columns)
+        described = cursor.execute(f"DESCRIBE SELECT {x}, {y} FROM {source}").fetchall()
+        x_type, y_type = (row[1] for row in described)
+
+        if _binnable(x_type) and _binnable(y_type):
+            logger.debug(f"Binning {n_rows} scatter points into a density grid")
+            bins = SCATTER_DENSITY_BINS
+            density = cursor.execute(
+                f"""
+                WITH points AS (
+                    SELECT {_to_axis(x, x_type)} AS x, {_to_axis(y, y_type)} AS y
+                    FROM {source}
+                    WHERE {x} IS NOT NULL AND {y} IS NOT NULL
+                ),
+                bounds AS (
+                    SELECT min(x) AS x0, max(x) AS x1, min(y) AS y0, max(y) AS y1 FROM points
+                ),
+                binned AS (
+                    SELECT
+                        least(coalesce(floor((x - x0) / nullif(x1 - x0, 0) * {bins}), 0), {bins} - 1) AS xb,
+                        least(coalesce(floor((y - y0) / nullif(y1 - y0, 0) * {bins}), 0), {bins} - 1) AS yb,
+                        count(*) AS n
+                    FROM points, bounds
+                    GROUP BY ALL
+                )
+                SELECT
+                    {_from_axis(f"x0 + (xb + 0.5) * (x1 - x0) / {bins}", x_type)} AS x,
+                    {_from_axis(f"y0 + (yb + 0.5) * (y1 - y0) / {bins}", y_type)} AS y,
+                    n
+                FROM binned, bounds
+                """
+            ).df()
+            density.columns = [columns[0], columns[1], "count"]
+            return "density", density
+
+        # stratified by x so that rare categories keep their points, numbers
+        # and times are stratified by bin since nearly every value is unique
+        logger.debug(f"Sampling {SCATTER_SAMPLE_POINTS} of {n_rows} scatter points")
+        fraction = SCATTER_SAMPLE_POINTS / n_rows
+        bins = SCATTER_DENSITY_BINS
+        stratum = (
+            f"least(coalesce(floor((x_axis - min(x_axis) OVER ()) / "
+            f"nullif(max(x_axis) OVER () - min(x_axis) OVER (), 0) * {bins}), 0), "
+            f"{bins} - 1)"
+            if _binnable(x_type)
+            else x
+        )
+        x_axis = _to_axis(x, x_type) if _binnable(x_type) else "NULL"
+        sample = cursor.execute(
+            f"""
+            SELECT * FROM (
+                SELECT {x}, {y} FROM (
+                    SELECT
+                        {x},
+                        {y},
+                        row_number() OVER (PARTITION BY stratum ORDER BY random()) AS rn,
+                        count(*) OVER (PARTITION BY stratum) AS stratum_rows
+                    FROM (
+                        SELECT *, {stratum} AS stratum
+                        FROM (SELECT {x}, {y}, {x_axis} AS x_axis FROM {source})
+                    )
+                )
+                WHERE rn <= greatest(1, ceil(stratum_rows * {fraction}))
+            )
+            -- one row is kept per stratum, cap the total
+            USING SAMPLE {SCATTER_SAMPLE_POINTS} ROWS
+            """
+        ).df()
+        return "points", sample
+
+
+def _binnable(column_type: str) -> bool:
+    """whether a column can be binned, numbers and points in time"""
+    return is_numeric_type(column_type) or is_temporal_type(column_type)
+
+
+def _to_axis(column: str, column_type: str) -> str:
+    """the column as a DOUBLE to bin, seconds since the epoch for times"""
+    if is_temporal_type(column_type):
+        return f"epoch({column})"
+    return f"{column}::DOUBLE"
+
+
+def _from_axis(value: str, column_type: str) -> str:
+    """a binned DOUBLE back as a value of the column type"""
+    if column_type == "TIME":
+        return f"TIME '00:00:00' + to_microseconds((({value}) * 1e6)::BIGINT)"
+    if is_temporal_type(column_type):
+        return f"make_timestamp((({value}) * 1e6)::BIGINT)"
+    return value
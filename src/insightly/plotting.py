@@ -1,3 +1,50 @@
 from insightly.plots.scatter import ScatterPlot
 from insightly.plots.bar import BarPlot
-from insightly.plots.plot import Plot
\ No newline at end of file
+from insightly.plots.plot import Plot
+
+import plotly.graph_objects as go
+
+from insightly.classes import PlotQueryInfo, PlotType, SqlQueryInfo
+
+
+def make_plot(plot_type: str) -> Plot:
+    """Create the plot of a plot type.
+
+    Parameters
+    ----------
+    plot_type : str
+        The PlotType value chosen by the agent.
+
+    Returns
+    -------
+    Plot
+        The plot.
+    """
+    # create a plot dependent on the type of plot type passed earlier
+    if plot_type == PlotType.SCATTER:
+        return ScatterPlot()
+    if plot_type == PlotType.BAR:
+        return BarPlot()
+    raise ValueError(f"Unknown plot type {plot_type}.")
+
+
+def build_figure(sql_query_info: SqlQueryInfo, plot_query_info: PlotQueryInfo) -> go.Figure:
+    """Build the figure of a plot answer from its result table.
+
+    Parameters
+    ----------
+    sql_query_info : SqlQueryInfo
+        The query info holding the handle of the result.
+    plot_query_info : PlotQueryInfo
+        The plot type and columns chosen by the agent.
+
+    Returns
+    -------
+    go.Figure
+        The figure.
+    """
+    return make_plot(plot_query_info["plot_type"]).generate(
+        None,
+        plot_query_info["columns"],
+        table_name=sql_query_info["query_result"]["table_name"],
+    )
@@ -0,0 +1,157 @@
+"""Layout and token accounting of the prompts sent to the LLM.
+
+The system prompt of every node that needs the schema starts with the same
+prefix: the database name and the schema. The prefix only changes with the
+version of the database, so the provider can cache it across nodes and
+questions. The instructions of the node follow it, and the question comes
+last, in the human message.
+"""
+
+from __future__ import annotations
+import threading
+import weakref
+from loguru import logger
+from typing import TYPE_CHECKING, Any, Callable, Optional, Union
+
+from insightly.metrics import metrics
+from insightly.utils import TOKEN_ENCODING
+
+if TYPE_CHECKING:
+    from insightly.insightly import Insightly
+
+# prefix of each open database, with the version it was built for
+_prefixes: "weakref.WeakKeyDictionary[Insightly, tuple[int, str]]" = (
+    weakref.WeakKeyDictionary()
+)
+_prefixes_lock = threading.Lock()
+# the encoder of TOKEN_ENCODING, False once tiktoken turned out to be missing
+_encode: Union[Callable[[str], list[int]], bool, None] = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of a prompt locally.
+
+    Uses tiktoken when it is installed, otherwise estimates 4 characters
+    per token.
+
+    Parameters
+    ----------
+    text : str
+        The prompt.
+
+    Returns
+    -------
+    int
+        The number of tokens.
+    """
+    global _encode
+    if _encode is None:
+        try:
+            import tiktoken
+
+            _encode = tiktoken.get_encoding(TOKEN_ENCODING).encode
+        except ImportError:
+            _encode = False
+        except Exception as e:
+            # the encoding is downloaded on first use, which fails offline
+            logger.warning(f"Could not load the {TOKEN_ENCODING} encoding: {e}")
+            _encode = False
+    if _encode is False:
+        return len(text) // 4 + 1
+    return len(_encode(text))
+
+
+def schema_prefix(insightly: "Insightly") -> str:
+    """
+    The prefix shared by the system prompts of the nodes that need the schema.
+
+    Parameters
+    ----------
+    insightly : Insightly
+        The database the question is about.
+
+    Returns
+    -------
+    str
+        The database name and the schema of every table, with braces
+        escaped for prompt templates. The same string is returned until the
+        version of the database changes.
+    """
+    with _prefixes_lock:
+        cached = _prefixes.get(insightly)
+        if cached is not None and cached[0] == insightly.version:
+            return cached[1]
+        prefix = """You answer questions about the DuckDB database described below.
+Database name: {db_name}
+All tables should begin with the database name (i.e. {db_name}.foods).
+
+Schema:
+{schema}
+""".format(
+            db_name=insightly.db_name, schema=insightly.get_schema()
+        )
+        # braces would be read as prompt template variables
+        prefix = prefix.replace("{", "{{").replace("}", "}}")
+        _prefixes[insightly] = (insightly.version, prefix)
+        return prefix
+
+
+def check_budget(node: str, system: str, question: str, budget: int) -> int:
+    """
+    Counts the tokens of a prompt before it is sent and records them.
+
+    Parameters
+    ----------
+    node : str
+        The node sending the prompt.
+    system : str
+        The system prompt.
+    question : str
+        The human message.
+    budget : int
+        Tokens the node is expected to send at most.
+
+    Returns
+    -------
+    int
+        The number of tokens counted.
+    """
+    tokens = count_tokens(system) + count_tokens(question)
+    metrics.observe("llm_prompt_tokens_counted", tokens, node=node)
+    if tokens > budget:
+        metrics.increment("llm_prompt_over_budget", node=node)
+        logger.warning(f"Prompt of {node} has {tokens} tokens, over its {budget}")
+    return tokens
+
+
+def record_usage(node: str, model: str, usage: Optional[dict[str, Any]]) -> None:
+    """
+    Records the tokens the provider reported for a call.
+
+    Parameters
+    ----------
+    node : str
+        The node that made the call.
+    model : str
+        The model that answered it.
+    usage : dict, optional
+        The usage metadata of the response, i.e. {"input_tokens": 1200,
+        "output_tokens": 30, "input_token_details": {"cache_read": 1024}}.
+
+    Returns
+    -------
+    None
+    """
+    if not usage:
+        return
+    prompt = usage.get("input_tokens", 0)
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+    completion = usage.get("output_tokens", 0)
+    labels = {"node": node, "model": model}
+    metrics.increment("llm_prompt_tokens", prompt, **labels)
+    metrics.increment("llm_cached_prompt_tokens", cached, **labels)
+    metrics.increment("llm_uncached_prompt_tokens", prompt - cached, **labels)
+    metrics.increment("llm_completion_tokens", completion, **labels)
+    logger.debug(f"{node} sent {prompt} prompt tokens, {cached} of them cached")
+
@@ -0,0 +1,157 @@
+"""Plot rendering in a pool of worker processes.
+
+Building figures and exporting static images is CPU bound and holds the GIL,
+so the API aggregates the rows to plot in DuckDB, hands the few plotted rows
+to warm worker processes as Arrow IPC and gets the serialised figure back.
+"""
+
+from __future__ import annotations
+import io
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from loguru import logger
+from typing import TYPE_CHECKING, Optional
+
+from insightly.figures import FigureFormat, serialise_figure
+from insightly.utils import PLOT_RENDER_TIMEOUT_SECONDS, import_pyarrow
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+
+def _warm_worker() -> None:
+    """Import plotting and start the image export engine once per worker."""
+    import plotly.express  # noqa: F401
+    import plotly.graph_objects as go
+    import insightly.plotting  # noqa: F401
+
+    try:
+        # the first export starts the persistent kaleido process
+        go.Figure().to_image(format="png", width=10, height=10)
+    except Exception as e:
+        logger.warning(f"Static image export unavailable in plot worker: {e}")
+
+
+def _render(
+    plot_type: str, kind: str, data: bytes, columns: list[str], figure_format: str
+) -> bytes:
+    """Build and serialise a figure inside a worker process.
+
+    Parameters
+    ----------
+    plot_type : str
+        The PlotType value of the plot.
+    kind : str
+        How the rows are drawn, see `Plot.reduce`.
+    data : bytes
+        The reduced rows as an Arrow IPC stream.
+    columns : list[str]
+        The columns to plot.
+    figure_format : str
+        The FigureFormat value to serialise to.
+
+    Returns
+    -------
+    bytes
+        The serialised figure.
+    """
+    from insightly.plotting import make_plot
+
+    pa = import_pyarrow()
+    df = pa.ipc.open_stream(data).read_pandas()
+    figure = make_plot(plot_type).figure(kind, df, columns)
+    return serialise_figure(figure, FigureFormat(figure_format))
+
+
+def to_arrow_ipc(table: "pa.Table") -> bytes:
+    """Serialise an Arrow table to the IPC streaming format."""
+    pa = import_pyarrow()
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+class PlotRenderer:
+    """Renders plots in a pool of warm worker processes.
+
+    Attributes
+    ----------
+    max_workers : int
+        Number of worker processes.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        if import_pyarrow() is None:
+            raise RuntimeError("pyarrow is required to render plots in worker processes.")
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) // 2)
+        # spawn, forking a process with DuckDB and server threads is not safe
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_worker,
+        )
+        logger.info(f"Started plot renderer with {self.max_workers} workers")
+
+    def submit(
+        self,
+        plot_type: str,
+        kind: str,
+        data: "pd.DataFrame",
+        columns: list[str],
+        figure_format: FigureFormat,
+    ) -> Future:
+        """Start rendering a plot.
+
+        Parameters
+        ----------
+        plot_type : str
+            The PlotType value of the plot.
+        kind : str
+            How the rows are drawn, see `Plot.reduce`.
+        data : pd.DataFrame
+            The rows returned by `Plot.reduce`.
+        columns : list[str]
+            The columns to plot.
+        figure_format : FigureFormat
+            The format to serialise the figure to.
+
+        Returns
+        -------
+        Future
+            Resolves to the serialised figure.
+        """
+        table = import_pyarrow().Table.from_pandas(data, preserve_index=False)
+        return self._pool.submit(
+            _render, plot_type, kind, to_arrow_ipc(table), columns, figure_format.value
+        )
+
+    def render(
+        self,
+        plot_type: str,
+        kind: str,
+        data: "pd.DataFrame",
+        columns: list[str],
+        figure_format: FigureFormat,
+        timeout: float = PLOT_RENDER_TIMEOUT_SECONDS,
+    ) -> bytes:
+        """Render a plot and wait for the result, see `submit`.
+
+        Raises
+        ------
+        TimeoutError
+            If the figure was not rendered within `timeout` seconds.
+        """
+        future = self.submit(plot_type, kind, data, columns, figure_format)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # only drops it if still queued, a running render finishes unused
+            future.cancel()
+            raise
+
+    def shutdown(self) -> None:
+        """Stop the worker processes."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
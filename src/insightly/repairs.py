@@ -0,0 +1,343 @@
+"""Rules learned from repaired SQL queries, keyed by the pattern of the error.
+
+When a failed query is fixed, the edits that turned it into the working query
+are kept under the pattern of its error (the first line of the message with
+names and numbers replaced). A later query failing with the same error on the
+same database is fixed by the same edit without asking the model, and other
+errors of the same pattern show the model how they were fixed before.
+"""
+
+from __future__ import annotations
+import difflib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from loguru import logger
+from typing import Iterator, Optional, TypedDict
+
+from insightly.utils import REPAIR_HINTS, REPAIR_RULES_SIZE
+
+# prefix ExecuteSQL puts before the DuckDB error message
+ERROR_PREFIX: str = "Error executing SQL query: "
+# quoted names and literals, identifiers, numbers and single characters
+TOKEN_PATTERN = re.compile(r"\"(?:[^\"]|\"\")*\"|'(?:[^']|'')*'|\w+|\S")
+QUOTED_PATTERN = re.compile(r"\"((?:[^\"]|\"\")*)\"|'((?:[^']|'')*)'")
+NUMBER_PATTERN = re.compile(r"\b\d+(?:\.\d+)?\b")
+
+
+class RepairRule(TypedDict):
+    """The edits that fixed a query failing with an error.
+
+    Attributes
+    ----------
+    pattern : str
+        The pattern of the error, see `error_pattern`.
+    db_name : str
+        The database the query ran on.
+    error : str
+        The first line of the error the rule was learned from.
+    edits : list[list[str]]
+        The fragments of the failed query and what they were replaced with.
+    hits : int
+        Number of queries the edits fixed.
+    """
+
+    pattern: str
+    db_name: str
+    error: str
+    edits: list[list[str]]
+    hits: int
+
+
+def _first_line(error: str) -> str:
+    """the first line of an error message, without the prefix of ExecuteSQL"""
+    error = error.strip()
+    if error.startswith(ERROR_PREFIX):
+        error = error[len(ERROR_PREFIX) :]
+    return error.splitlines()[0].strip() if error else ""
+
+
+def error_pattern(error: str) -> str:
+    """
+    The pattern of an error message, shared by errors of the same kind.
+
+    Parameters
+    ----------
+    error : str
+        The error message.
+
+    Returns
+    -------
+    str
+        The first line of the message with quoted names replaced by <name>
+        and numbers by <n>, i.e. 'Binder Error: Referenced column <name> not
+        found in FROM clause!'.
+    """
+    pattern = QUOTED_PATTERN.sub("<name>", _first_line(error))
+    return NUMBER_PATTERN.sub("<n>", pattern)
+
+
+def error_subjects(error: str) -> list[str]:
+    """
+    The names quoted in the first line of an error message.
+
+    Parameters
+    ----------
+    error : str
+        The error message.
+
+    Returns
+    -------
+    list[str]
+        The names, i.e. the column that was not found, lower case.
+    """
+    return [
+        (double or single).lower()
+        for double, single in QUOTED_PATTERN.findall(_first_line(error))
+        if double or single
+    ]
+
+
+def _tokens(query: str) -> list[re.Match]:
+    """the tokens of a query with their positions"""
+    return list(TOKEN_PATTERN.finditer(query))
+
+
+def query_edits(failed_query: str, fixed_query: str) -> list[list[str]]:
+    """
+    The fragments of a query that were changed to fix it.
+
+    Parameters
+    ----------
+    failed_query : str
+        The query that failed.
+    fixed_query : str
+        The query that worked.
+
+    Returns
+    -------
+    list[list[str]]
+        Pairs of the fragment of the failed query and the fragment that
+        replaced it, an empty fragment for insertions and deletions. An edit
+        made in several places is listed once.
+    """
+    before, after = _tokens(failed_query), _tokens(fixed_query)
+    matcher = difflib.SequenceMatcher(
+        a=[t.group() for t in before], b=[t.group() for t in after], autojunk=False
+    )
+    edits = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        old = failed_query[before[i1].start() : before[i2 - 1].end()] if i2 > i1 else ""
+        new = fixed_query[after[j1].start() : after[j2 - 1].end()] if j2 > j1 else ""
+        if [old, new] not in edits:
+            edits.append([old, new])
+    return edits
+
+
+def _mentions(fragment: str, subjects: list[str]) -> bool:
+    """whether a fragment of a query holds one of the names of an error"""
+    names = {token.group().strip("\"'").lower() for token in _tokens(fragment)}
+    return any(subject in names for subject in subjects)
+
+
+def _replace(query: str, old: str, new: str) -> Optional[str]:
+    """query with every occurrence of the tokens of a fragment replaced"""
+    tokens = _tokens(query)
+    wanted = [t.group() for t in _tokens(old)]
+    parts, last, i = [], 0, 0
+    while wanted and i <= len(tokens) - len(wanted):
+        if [t.group() for t in tokens[i : i + len(wanted)]] == wanted:
+            parts += [query[last : tokens[i].start()], new]
+            last = tokens[i + len(wanted) - 1].end()
+            i += len(wanted)
+        else:
+            i += 1
+    if not parts:
+        return None
+    return "".join(parts) + query[last:]
+
+
+class RepairRules:
+    """
+    The most recently used repair rules, optionally kept in a JSON lines file.
+
+    Attributes
+    ----------
+    path : str, optional
+        File the rules are appended to and loaded from.
+    max_rules : int
+        Number of rules kept, the least recently used are dropped.
+    """
+
+    def __init__(
+        self, path: Optional[str] = None, max_rules: int = REPAIR_RULES_SIZE
+    ) -> None:
+        self.path = path
+        self.max_rules = max_rules
+        self._rules: OrderedDict[str, RepairRule] = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        rule: RepairRule = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line cut short by a crash
+                        continue
+                    # later lines hold the newer hit counts
+                    self._keep(rule)
+
+    @staticmethod
+    def _key(rule: RepairRule) -> str:
+        """the identity of a rule, its database, pattern and edits"""
+        return json.dumps([rule["db_name"], rule["pattern"], rule["edits"]])
+
+    def _keep(self, rule: RepairRule) -> None:
+        """stores a rule as the most recently used one"""
+        key = self._key(rule)
+        self._rules[key] = rule
+        self._rules.move_to_end(key)
+        while len(self._rules) > self.max_rules:
+            self._rules.popitem(last=False)
+
+    def _matching(self, error: str, db_name: str) -> Iterator[RepairRule]:
+        """the rules learned from errors of the same pattern, most used first"""
+        pattern = error_pattern(error)
+        rules = [
+            r
+            for r in self._rules.values()
+            if r["pattern"] == pattern and r["db_name"] == db_name
+        ]
+        yield from sorted(rules, key=lambda r: r["hits"], reverse=True)
+
+    def learn(
+        self, error: str, failed_query: str, fixed_query: str, db_name: str
+    ) -> Optional[RepairRule]:
+        """
+        Keeps the edits that fixed a query.
+
+        Parameters
+        ----------
+        error : str
+            The error the failed query raised.
+        failed_query : str
+            The query that failed.
+        fixed_query : str
+            The query that then worked.
+        db_name : str
+            The database the queries ran on.
+
+        Returns
+        -------
+        RepairRule, optional
+            The rule, None if the queries are the same.
+        """
+        edits = query_edits(failed_query, fixed_query)
+        if not edits:
+            return None
+        rule: RepairRule = {
+            "pattern": error_pattern(error),
+            "db_name": db_name,
+            "error": _first_line(error),
+            "edits": edits,
+            "hits": 1,
+        }
+        with self._lock:
+            known = self._rules.get(self._key(rule))
+            if known is not None:
+                rule["hits"] = known["hits"] + 1
+            self._keep(rule)
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(rule) + "\n")
+        logger.debug(f"Learned a fix for '{rule['pattern']}': {edits}")
+        return rule
+
+    def apply(self, error: str, query: str, db_name: str) -> Optional[str]:
+        """
+        Fixes a query with a rule learned from the same error.
+
+        Only rules made of a single edit of a fragment holding one of the
+        names of the error (i.e. the column that was not found) are applied.
+
+        Parameters
+        ----------
+        error : str
+            The error the query raised.
+        query : str
+            The query.
+        db_name : str
+            The database the query ran on.
+
+        Returns
+        -------
+        str, optional
+            The fixed query, None if no rule applies.
+        """
+        subjects = error_subjects(error)
+        if not subjects:
+            return None
+        with self._lock:
+            for rule in self._matching(error, db_name):
+                if len(rule["edits"]) != 1:
+                    continue
+                old, new = rule["edits"][0]
+                if not old or not _mentions(old, subjects):
+                    continue
+                fixed = _replace(query, old, new)
+                if fixed is not None and fixed != query:
+                    logger.info(f"Fixed the query with a rule for '{rule['pattern']}'")
+                    return fixed
+        return None
+
+    def hints(
+        self, error: str, db_name: str, limit: int = REPAIR_HINTS
+    ) -> list[RepairRule]:
+        """
+        The rules learned from errors of the same pattern.
+
+        Parameters
+        ----------
+        error : str
+            The error to fix.
+        db_name : str
+            The database the query ran on.
+        limit : int, optional
+            Maximum number of rules returned.
+
+        Returns
+        -------
+        list[RepairRule]
+            The rules, the most used first.
+        """
+        with self._lock:
+            return list(self._matching(error, db_name))[:limit]
+
+
+# the rules the repair node uses, in memory until setup_repair_rules is called
+repair_rules = RepairRules()
+
+
+def setup_repair_rules(path: str) -> RepairRules:
+    """
+    Keeps the learned repair rules in a file so they survive restarts.
+
+    Parameters
+    ----------
+    path : str
+        The JSON lines file to append the rules to.
+
+    Returns
+    -------
+    RepairRules
+        The rules failed queries are now repaired with.
+    """
+    global repair_rules
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    repair_rules = RepairRules(path)
+    logger.info(f"Recording repair rules to {path}")
+    return repair_rules
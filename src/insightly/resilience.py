@@ -0,0 +1,253 @@
+"""Deadlines, retries and hedging of the LLM calls.
+
+A request that was rate limited or failed on the provider side is retried
+with jittered exponential backoff, waiting at least as long as the provider
+asked to, until the retries or the deadline of the call run out. No request
+is given more time than is left before the deadline. Nodes on
+the latency-critical path can hedge their calls: when a request takes longer
+than the 95th percentile of the recent calls of the node, a second request
+is sent and the first answer is taken.
+"""
+
+from __future__ import annotations
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from loguru import logger
+from typing import TYPE_CHECKING, Any, Callable, Optional, TypeVar
+
+from insightly.metrics import metrics
+from insightly.utils import (
+    LLM_BACKOFF_SECONDS,
+    LLM_HEDGE_MIN_SAMPLES,
+    LLM_HEDGE_PERCENTILE,
+    LLM_HEDGE_WORKERS,
+    LLM_MAX_BACKOFF_SECONDS,
+)
+
+if TYPE_CHECKING:
+    from insightly.models import ModelConfig
+
+R = TypeVar("R")
+
+# threads running hedged requests, created on the first hedged call
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _hedge_executor() -> ThreadPoolExecutor:
+    """the threads running hedged requests"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=LLM_HEDGE_WORKERS, thread_name_prefix="llm-hedge"
+            )
+        return _executor
+
+
+def retryable(error: BaseException) -> bool:
+    """
+    Whether a failed request is worth sending again.
+
+    Parameters
+    ----------
+    error : BaseException
+        The error of the request.
+
+    Returns
+    -------
+    bool
+        True for rate limits, timeouts, connection errors and server errors,
+        False for errors the same request would fail with again.
+    """
+    import openai
+
+    return isinstance(
+        error,
+        (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError),
+    )
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    Seconds the provider asked to wait before the next request.
+
+    Parameters
+    ----------
+    error : BaseException
+        The error of the request.
+
+    Returns
+    -------
+    float, optional
+        The retry-after-ms or retry-after header of the response, None if
+        neither is set or the error has no response.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        # retry-after can also be an HTTP date, the backoff is used then
+        pass
+    return None
+
+
+def backoff(attempt: int, error: Optional[BaseException] = None) -> float:
+    """
+    Seconds to wait before a retry.
+
+    Parameters
+    ----------
+    attempt : int
+        Number of retries already made.
+    error : BaseException, optional
+        The error of the last request.
+
+    Returns
+    -------
+    float
+        A random delay up to LLM_BACKOFF_SECONDS doubled for each retry and
+        capped at LLM_MAX_BACKOFF_SECONDS, or the delay the provider asked
+        for if it is longer.
+    """
+    cap = min(LLM_MAX_BACKOFF_SECONDS, LLM_BACKOFF_SECONDS * 2**attempt)
+    delay = random.uniform(0, cap)
+    asked = retry_after(error) if error is not None else None
+    return max(delay, asked) if asked is not None else delay
+
+
+def _request_timeout(
+    config: "ModelConfig", deadline: Optional[float], labels: dict[str, str]
+) -> Optional[float]:
+    """seconds the next request may take, its timeout cut to the time left"""
+    if deadline is None:
+        return config.timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(f"The call of {labels['node']} passed its deadline.")
+    return remaining if config.timeout is None else min(config.timeout, remaining)
+
+
+def _timed(
+    call: Callable[[Optional[float]], R],
+    timeout: Optional[float],
+    labels: dict[str, str],
+) -> R:
+    """runs a request and observes its duration if it succeeded"""
+    start = time.perf_counter()
+    result = call(timeout)
+    metrics.observe("llm_call_seconds", time.perf_counter() - start, **labels)
+    return result
+
+
+def _submit(
+    call: Callable[[Optional[float]], R],
+    timeout: Optional[float],
+    labels: dict[str, str],
+) -> Future:
+    """runs a request on the hedge threads, with the context of the caller"""
+    context = contextvars.copy_context()
+    return _hedge_executor().submit(context.run, _timed, call, timeout, labels)
+
+
+def _hedged(
+    call: Callable[[Optional[float]], R],
+    delay: float,
+    config: "ModelConfig",
+    deadline: Optional[float],
+    labels: dict[str, str],
+) -> R:
+    """sends a request, and a second one after the delay, taking the first answer"""
+    first = _submit(call, _request_timeout(config, deadline, labels), labels)
+    pending = {first}
+    done, _ = wait(pending, timeout=delay)
+    if not done:
+        metrics.increment("llm_hedges", **labels)
+        logger.debug(f"Hedging the call of {labels['node']} after {delay:.2f}s")
+        pending.add(_submit(call, _request_timeout(config, deadline, labels), labels))
+    error: Optional[BaseException] = None
+    while pending:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            # the requests still running finish on their threads and are dropped
+            raise TimeoutError(f"The call of {labels['node']} passed its deadline.")
+        for future in done:
+            if future.exception() is None:
+                if future is not first:
+                    metrics.increment("llm_hedge_wins", **labels)
+                return future.result()
+            error = future.exception()
+    assert error is not None
+    raise error
+
+
+def call_llm(
+    call: Callable[[Optional[float]], R], node: str, config: "ModelConfig"
+) -> R:
+    """
+    Makes an LLM call with the retries, deadline and hedging of its model.
+
+    Parameters
+    ----------
+    call : Callable[[Optional[float]], R]
+        Sends one request with the given timeout in seconds, None for the
+        timeout of the client, and returns its answer.
+    node : str
+        The node making the call.
+    config : ModelConfig
+        The model configuration of the node.
+
+    Returns
+    -------
+    R
+        The first answer received.
+
+    Raises
+    ------
+    TimeoutError
+        If the call passed its deadline.
+    Exception
+        The error of the last request, when it is not worth retrying or the
+        retries or the deadline ran out.
+    """
+    labels = {"node": node, "model": config.model}
+    deadline = None if config.deadline is None else time.monotonic() + config.deadline
+    attempt = 0
+    while True:
+        delay = None
+        if config.hedge:
+            delay = metrics.percentile(
+                "llm_call_seconds",
+                LLM_HEDGE_PERCENTILE,
+                min_samples=LLM_HEDGE_MIN_SAMPLES,
+                **labels,
+            )
+        try:
+            if delay is None:
+                return _timed(call, _request_timeout(config, deadline, labels), labels)
+            return _hedged(call, delay, config, deadline, labels)
+        except Exception as e:
+            if not retryable(e) or attempt >= config.retries:
+                metrics.increment("llm_errors", **labels)
+                raise
+            wait_for = backoff(attempt, e)
+            if deadline is not None and time.monotonic() + wait_for >= deadline:
+                metrics.increment("llm_errors", **labels)
+                logger.warning(f"No time left to retry the call of {node}: {e}")
+                raise
+            attempt += 1
+            metrics.increment("llm_retries", **labels)
+            logger.warning(
+                f"Retrying the call of {node} in {wait_for:.2f}s "
+                f"({attempt}/{config.retries}): {e}"
+            )
+            time.sleep(wait_for)
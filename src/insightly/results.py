@@ -0,0 +1,529 @@
+"""Columnar, paginated access to the materialised results of queries."""
+
+from __future__ import annotations
+import base64
+import binascii
+import hashlib
+import hmac
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+import duckdb
+
+from insightly.classes import ResultHandle
+from insightly.insightly import Insightly
+from insightly.utils import (
+    MAX_RESULT_PAGE_SIZE,
+    RESULT_PAGE_SIZE,
+    RESULT_PREVIEW_ROWS,
+    RESULT_TABLE_PREFIX,
+    import_pyarrow,
+    quote_identifier,
+)
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+ARROW_STREAM_MEDIA_TYPE: str = "application/vnd.apache.arrow.stream"
+# bytes read from an export file and rows fetched per Arrow batch at a time
+EXPORT_CHUNK_BYTES: int = 1024 * 1024
+EXPORT_BATCH_ROWS: int = 64 * 1024
+RESULT_TABLE_PATTERN = re.compile(rf"^{RESULT_TABLE_PREFIX}[0-9a-f]+$")
+# types JSON can carry as they are, everything else is sent as text
+JSON_NATIVE_TYPES: tuple[str, ...] = (
+    "BOOLEAN",
+    "TINYINT",
+    "SMALLINT",
+    "INTEGER",
+    "BIGINT",
+    "UTINYINT",
+    "USMALLINT",
+    "UINTEGER",
+    "UBIGINT",
+    "FLOAT",
+    "DOUBLE",
+    "VARCHAR",
+)
+JSON_FLOAT_TYPES: tuple[str, ...] = ("FLOAT", "DOUBLE")
+
+
+class ExportFormat(str, Enum):
+    """File format a query result can be exported as.
+
+    Attributes
+    ----------
+    PARQUET : str
+        Parquet file, zstd compressed.
+    CSV : str
+        CSV file with a header row.
+    ARROW : str
+        Arrow IPC stream.
+    """
+
+    PARQUET = "parquet"
+    CSV = "csv"
+    ARROW = "arrow"
+
+    @property
+    def media_type(self) -> str:
+        """The media type of the exported file."""
+        return {
+            ExportFormat.PARQUET: "application/vnd.apache.parquet",
+            ExportFormat.CSV: "text/csv",
+            ExportFormat.ARROW: ARROW_STREAM_MEDIA_TYPE,
+        }[self]
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a page cursor cannot be decoded or is for another table."""
+
+
+class ResultAccessError(PermissionError):
+    """Raised when a result token does not grant access to a result table."""
+
+
+# key the result tokens are signed with, random per process until
+# setup_result_signing, so tokens then only work on the process that made them
+_signing_key: bytes = os.urandom(32)
+
+
+def setup_result_signing(key: str) -> None:
+    """Sign result tokens with a key shared by all worker processes.
+
+    Parameters
+    ----------
+    key : str
+        The secret key.
+    """
+    global _signing_key
+    _signing_key = key.encode()
+
+
+def sign_result(table_name: str, db_name: str, tenant: str) -> str:
+    """Build the token granting a tenant access to a result table.
+
+    Parameters
+    ----------
+    table_name : str
+        The result table.
+    db_name : str
+        The database holding it, which is tied to the workspace.
+    tenant : str
+        Who asked the question.
+
+    Returns
+    -------
+    str
+        The token to send with /results and /export requests.
+    """
+    message = "\0".join((table_name, db_name, tenant)).encode()
+    digest = hmac.new(_signing_key, message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def check_result_token(
+    token: Optional[str], table_name: str, db_name: str, tenant: str
+) -> None:
+    """Make sure a token was issued for a result table, database and tenant.
+
+    Parameters
+    ----------
+    token : str, optional
+        The token returned with the answer.
+    table_name : str
+        The result table requested.
+    db_name : str
+        The database the table is read from.
+    tenant : str
+        Who requests the table.
+
+    Raises
+    ------
+    ResultAccessError
+        If the token is missing or was issued for anything else.
+    """
+    # compared as bytes, strings with other than ASCII characters cannot be
+    if token is None or not hmac.compare_digest(
+        token.encode(), sign_result(table_name, db_name, tenant).encode()
+    ):
+        raise ResultAccessError(f"No access to the result {table_name}.")
+
+
+def check_result_table(table_name: str) -> None:
+    """Make sure a table name refers to a query result table.
+
+    Parameters
+    ----------
+    table_name : str
+        The name of the table.
+
+    Raises
+    ------
+    ValueError
+        If the name is not the name of a result table.
+    """
+    if not RESULT_TABLE_PATTERN.match(table_name):
+        raise ValueError(f"{table_name!r} is not a query result table.")
+
+
+def encode_cursor(table_name: str, offset: int) -> str:
+    """Build the opaque cursor pointing at a row of a result table."""
+    payload = json.dumps({"t": table_name, "o": offset}).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, table_name: str) -> int:
+    """Read the row offset from a cursor built by `encode_cursor`.
+
+    Parameters
+    ----------
+    cursor : str
+        The cursor returned with the previous page.
+    table_name : str
+        The table the page is requested for.
+
+    Returns
+    -------
+    int
+        The offset of the first row of the page.
+
+    Raises
+    ------
+    InvalidCursorError
+        If the cursor is malformed or belongs to another table.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+        offset = int(payload["o"])
+    except (binascii.Error, ValueError, KeyError, TypeError) as e:
+        raise InvalidCursorError("Malformed result cursor.") from e
+    if payload.get("t") != table_name or offset < 0:
+        raise InvalidCursorError("Result cursor does not belong to this table.")
+    return offset
+
+
+def _json_column(name: str, column_type: str) -> str:
+    """select list item of a column as JSON can carry it"""
+    column = quote_identifier(name)
+    if column_type in JSON_FLOAT_TYPES:
+        # NaN and infinities are not valid JSON, they are sent as null
+        return f"CASE WHEN isfinite({column}) THEN {column} END AS {column}"
+    if column_type in JSON_NATIVE_TYPES:
+        return column
+    return f"CAST({column} AS VARCHAR) AS {column}"
+
+
+def json_columns(schema: list[tuple[str, str]]) -> str:
+    """Select list of columns with the types JSON cannot carry cast to text,
+    and non-finite floats replaced by null."""
+    return ", ".join(_json_column(name, column_type) for name, column_type in schema)
+
+
+def _page_query(
+    conn: duckdb.DuckDBPyConnection, table_name: str, offset: int, page_size: int
+) -> tuple[list[tuple[str, str]], str]:
+    """Describe a result table and build the query selecting one page of it."""
+    table = quote_identifier(table_name)
+    schema = [
+        (row[0], row[1])
+        for row in conn.execute(f"DESCRIBE SELECT * FROM {table}").fetchall()
+    ]
+    selected = json_columns(schema)
+    query = f"SELECT {selected} FROM {table} LIMIT {page_size} OFFSET {offset}"
+    return schema, query
+
+
+def result_page(
+    table_name: str,
+    cursor: Optional[str] = None,
+    page_size: int = RESULT_PAGE_SIZE,
+) -> dict[str, Any]:
+    """Read one page of a result table as column arrays.
+
+    Parameters
+    ----------
+    table_name : str
+        The result table to read.
+    cursor : str, optional
+        The cursor returned with the previous page, the first page if None.
+    page_size : int, optional
+        Maximum number of rows in the page.
+
+    Returns
+    -------
+    dict[str, Any]
+        The schema, the column arrays, the total number of rows and the
+        cursor of the next page (None on the last page).
+    """
+    check_result_table(table_name)
+    page_size = max(1, min(page_size, MAX_RESULT_PAGE_SIZE))
+    offset = decode_cursor(cursor, table_name) if cursor else 0
+
+    row_count = Insightly().result_row_count(table_name)
+    conn = Insightly().conn.cursor()
+    try:
+        schema, query = _page_query(conn, table_name, offset, page_size)
+        # fetchnumpy is columnar, masked values become None in tolist()
+        columns = conn.execute(query).fetchnumpy()
+    finally:
+        conn.close()
+
+    data = {name: columns[name].tolist() for name, _ in schema}
+    n_rows = len(next(iter(data.values()), []))
+    next_offset = offset + n_rows
+    return {
+        "table_name": table_name,
+        "columns": [{"name": name, "type": column_type} for name, column_type in schema],
+        "data": data,
+        "offset": offset,
+        "row_count": row_count,
+        "next_cursor": (
+            encode_cursor(table_name, next_offset)
+            if next_offset < row_count
+            else None
+        ),
+    }
+
+
+def result_exists(table_name: str) -> bool:
+    """Check whether a result table is in the active database.
+
+    Parameters
+    ----------
+    table_name : str
+        The result table.
+
+    Returns
+    -------
+    bool
+        False once the table expired, or when it was kept in the memory of a
+        process that has restarted or is another worker, see
+        `insightly.insightly.Insightly.has_result`.
+    """
+    return Insightly().has_result(table_name)
+
+
+def make_handle(table_name: str, preview_rows: int = RESULT_PREVIEW_ROWS) -> ResultHandle:
+    """Build the handle the agent state keeps instead of the rows of a result.
+
+    Parameters
+    ----------
+    table_name : str
+        The result table.
+    preview_rows : int, optional
+        Number of rows copied into the handle.
+
+    Returns
+    -------
+    ResultHandle
+        The table name, row count, schema and preview rows.
+    """
+    page = result_page(table_name, page_size=preview_rows)
+    return ResultHandle(
+        table_name=table_name,
+        row_count=page["row_count"],
+        columns=page["columns"],
+        preview=page["data"],
+    )
+
+
+def load_result(handle: ResultHandle) -> pd.DataFrame:
+    """Read all rows of a result into a DataFrame.
+
+    Parameters
+    ----------
+    handle : ResultHandle
+        The handle of the result.
+
+    Returns
+    -------
+    pd.DataFrame
+        The rows of the result table.
+    """
+    check_result_table(handle["table_name"])
+    conn = Insightly().conn.cursor()
+    try:
+        return conn.table(handle["table_name"]).df()
+    finally:
+        conn.close()
+
+
+def describe_handle(handle: ResultHandle) -> str:
+    """Describe a result in a few lines for a prompt, using only the preview."""
+    names = [column["name"] for column in handle["columns"]]
+    rows = zip(*(handle["preview"][name] for name in names))
+    lines = [" | ".join(names)]
+    lines += [" | ".join(str(value) for value in row) for row in rows]
+    shown = len(lines) - 1
+    if handle["row_count"] > shown:
+        lines.append(f"... {handle['row_count'] - shown} more rows")
+    return "\n".join(lines)
+
+
+def result_page_arrow(
+    table_name: str,
+    cursor: Optional[str] = None,
+    page_size: int = RESULT_PAGE_SIZE,
+) -> bytes:
+    """Read one page of a result table as an Arrow IPC stream.
+
+    Parameters
+    ----------
+    table_name : str
+        The result table to read.
+    cursor : str, optional
+        The cursor returned with the previous page, the first page if None.
+    page_size : int, optional
+        Maximum number of rows in the page.
+
+    Returns
+    -------
+    bytes
+        The page in the Arrow IPC streaming format.
+    """
+    pa = import_pyarrow()
+    if pa is None:
+        raise RuntimeError("pyarrow is required for Arrow responses.")
+    check_result_table(table_name)
+    page_size = max(1, min(page_size, MAX_RESULT_PAGE_SIZE))
+    offset = decode_cursor(cursor, table_name) if cursor else 0
+
+    conn = Insightly().conn.cursor()
+    try:
+        table = conn.execute(
+            f"SELECT * FROM {quote_identifier(table_name)} "
+            f"LIMIT {page_size} OFFSET {offset}"
+        ).arrow()
+    finally:
+        conn.close()
+
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def accepts_arrow(accept: Optional[str]) -> bool:
+    """Check whether the client accepts Arrow IPC and pyarrow is available."""
+    if accept is None or ARROW_STREAM_MEDIA_TYPE not in accept:
+        return False
+    return import_pyarrow() is not None
+
+
+class ResultExport:
+    """The chunks of an exported result and what they hold on to.
+
+    The chunks are read from a cursor or a temporary file, `close` releases
+    them whether the chunks were read or not. A generator cannot do this
+    itself, it never runs its cleanup if it was not started.
+
+    Parameters
+    ----------
+    chunks : Iterator[bytes]
+        The chunks of the exported file.
+    conn : duckdb.DuckDBPyConnection, optional
+        The cursor the chunks are read from.
+    folder : str, optional
+        The temporary folder the file was written to.
+    """
+
+    def __init__(
+        self,
+        chunks: Iterator[bytes],
+        conn: Optional[duckdb.DuckDBPyConnection] = None,
+        folder: Optional[str] = None,
+    ) -> None:
+        self.chunks = chunks
+        self.conn = conn
+        self.folder = folder
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.chunks
+
+    def close(self) -> None:
+        """Release the cursor and remove the folder, safe to call again."""
+        self.chunks.close()
+        if self.conn is not None:
+            self.conn.close()
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def _stream_file(path: str) -> Iterator[bytes]:
+    """Yield a file in chunks."""
+    with open(path, "rb") as f:
+        while chunk := f.read(EXPORT_CHUNK_BYTES):
+            yield chunk
+
+
+def _stream_arrow(reader: "pa.RecordBatchReader") -> Iterator[bytes]:
+    """Yield an Arrow IPC stream one record batch at a time."""
+    pa = import_pyarrow()
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    # the end of stream marker is written on close
+    yield sink.getvalue()
+
+
+def export_result(table_name: str, export_format: ExportFormat) -> ResultExport:
+    """Export a result table without holding it in memory.
+
+    Parquet and CSV are written by DuckDB with COPY into a temporary file that
+    is streamed back in chunks, Arrow is streamed batch by batch from a
+    record batch reader. The export is started before this returns, so the
+    chunks can be read after the active database has changed. The export
+    must be closed once it was sent, or when it will not be.
+
+    Parameters
+    ----------
+    table_name : str
+        The result table to export.
+    export_format : ExportFormat
+        The format to export to.
+
+    Returns
+    -------
+    ResultExport
+        The chunks of the exported file.
+    """
+    check_result_table(table_name)
+    table = quote_identifier(table_name)
+    conn = Insightly().conn.cursor()
+
+    if export_format == ExportFormat.ARROW:
+        if import_pyarrow() is None:
+            conn.close()
+            raise RuntimeError("pyarrow is required for Arrow exports.")
+        reader = conn.execute(f"SELECT * FROM {table}").fetch_record_batch(
+            EXPORT_BATCH_ROWS
+        )
+        return ResultExport(_stream_arrow(reader), conn=conn)
+
+    folder = tempfile.mkdtemp(prefix="insightly_export_")
+    path = os.path.join(folder, f"{table_name}.{export_format.value}")
+    options = (
+        "FORMAT parquet, COMPRESSION zstd"
+        if export_format == ExportFormat.PARQUET
+        else "FORMAT csv, HEADER true"
+    )
+    try:
+        conn.execute(f"COPY (SELECT * FROM {table}) TO '{path}' ({options})")
+    except Exception:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    finally:
+        conn.close()
+    return ResultExport(_stream_file(path), folder=folder)
@@ -0,0 +1,625 @@
+"""Pre-aggregated rollup tables for the aggregate queries asked most often.
+
+Questions are often variations of the same GROUP BY over one table. Once a
+shape (table, columns used outside aggregates, aggregated columns) has been
+executed a few times, its rollup is stored in DuckDB: the table grouped by
+those columns with the count, sum, min and max of the aggregated ones.
+Matching queries are rewritten to re-aggregate the rollup, which gives the
+same answer because these aggregates can be combined, instead of scanning
+the base table.
+"""
+
+from __future__ import annotations
+import copy
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from loguru import logger
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+import duckdb
+
+from insightly.history import QueryRecord, deserialise_sql, serialise_sql
+from insightly.utils import (
+    INTERNAL_TABLE_PREFIX,
+    ROLLUP_MAX_FRACTION,
+    ROLLUP_MIN_QUERIES,
+    quote_identifier,
+)
+
+if TYPE_CHECKING:
+    from insightly.insightly import Insightly
+
+# DuckDB table recording the rollups of a database
+ROLLUPS_TABLE: str = f"{INTERNAL_TABLE_PREFIX}rollups"
+
+# aggregates answered from a rollup, and the partial aggregates they need
+PARTIALS: dict[str, tuple[str, ...]] = {
+    "count_star": (),
+    "count": ("count",),
+    "sum": ("sum",),
+    "min": ("min",),
+    "max": ("max",),
+    "avg": ("sum", "count"),
+    "mean": ("sum", "count"),
+}
+
+# names of all DuckDB aggregate functions, loaded on first use
+_aggregate_functions: Optional[frozenset[str]] = None
+
+
+def _aggregates() -> frozenset[str]:
+    """names of the DuckDB aggregate functions, to spot the ones a rollup
+    cannot answer"""
+    global _aggregate_functions
+    if _aggregate_functions is None:
+        with duckdb.connect() as conn:
+            _aggregate_functions = frozenset(
+                name
+                for (name,) in conn.execute(
+                    "SELECT DISTINCT function_name FROM duckdb_functions() "
+                    "WHERE function_type = 'aggregate'"
+                ).fetchall()
+            ) | {"count_star"}
+    return _aggregate_functions
+
+
+def _partial_column(partial: str, column: str) -> str:
+    """name of the rollup column holding a partial aggregate of a column"""
+    return f"{partial}__{column}"
+
+
+@dataclass(frozen=True)
+class RollupShape:
+    """The part of an aggregate query a rollup has to match.
+
+    Attributes
+    ----------
+    base_table : str
+        The table the query reads.
+    dimensions : frozenset[str]
+        Columns used outside aggregates, the rollup is grouped by them.
+    measures : frozenset[str]
+        Partial aggregates the rollup holds, as "partial:column".
+    """
+
+    base_table: str
+    dimensions: frozenset[str]
+    measures: frozenset[str]
+
+    @property
+    def rollup_name(self) -> str:
+        """Name of the table holding the rollup of this shape's dimensions."""
+        digest = hashlib.sha1(
+            ",".join(sorted(self.dimensions)).encode()
+        ).hexdigest()[:10]
+        return f"{INTERNAL_TABLE_PREFIX}rollup_{self.base_table}_{digest}"
+
+
+def _walk_aggregates(
+    expression: Any, outside: list[str], inside: list[tuple[str, Optional[str]]]
+) -> bool:
+    """collect the column references outside aggregates and the aggregates of
+    a tree, False if it holds anything a rollup cannot answer"""
+    if isinstance(expression, list):
+        return all(_walk_aggregates(e, outside, inside) for e in expression)
+    if not isinstance(expression, dict):
+        return True
+    kind = expression.get("class")
+    if kind in ("SUBQUERY", "STAR", "WINDOW"):
+        # other tables, every column, or windows over the grouped rows
+        return False
+    if kind == "COLUMN_REF":
+        outside.append(expression["column_names"][-1])
+        return True
+    if kind == "FUNCTION" and expression["function_name"] in _aggregates():
+        name = expression["function_name"]
+        children = expression.get("children", [])
+        if (
+            name not in PARTIALS
+            or expression.get("distinct")
+            or expression.get("filter")
+            or expression.get("order_bys", {}).get("orders")
+        ):
+            return False
+        if name == "count_star" or (name == "count" and not children):
+            inside.append(("count_star", None))
+            return True
+        if len(children) != 1 or children[0].get("class") != "COLUMN_REF":
+            return False
+        inside.append((name, children[0]["column_names"][-1]))
+        return True
+    return all(
+        _walk_aggregates(value, outside, inside) for value in expression.values()
+    )
+
+
+def query_shape(
+    tree: dict[str, Any], table_columns: dict[str, set[str]]
+) -> Optional[RollupShape]:
+    """
+    Finds the rollup shape of a query.
+
+    Parameters
+    ----------
+    tree : dict
+        The query, as returned by `insightly.history.serialise_sql`.
+    table_columns : dict[str, set[str]]
+        The columns of each table of the database.
+
+    Returns
+    -------
+    RollupShape, optional
+        The shape, None if the query does not aggregate a single table with
+        aggregates a rollup can answer.
+    """
+    node = tree["statements"][0]["node"]
+    source = node.get("from_table", {})
+    if (
+        source.get("type") != "BASE_TABLE"
+        or source["table_name"] not in table_columns
+        or node.get("cte_map", {}).get("map")
+    ):
+        return None
+    columns = table_columns[source["table_name"]]
+    outside: list[str] = []
+    inside: list[tuple[str, Optional[str]]] = []
+    parts = [
+        node.get(key)
+        for key in (
+            "select_list",
+            "where_clause",
+            "group_expressions",
+            "having",
+            "modifiers",
+        )
+    ]
+    if not _walk_aggregates(parts, outside, inside) or not inside:
+        return None
+    # DuckDB resolves identifiers case-insensitively
+    names = {column.lower(): column for column in columns}
+    aliases = {
+        expression["alias"].lower()
+        for expression in node.get("select_list", [])
+        if expression.get("alias")
+    }
+    dimensions = set()
+    for reference in outside:
+        if reference.lower() in names:
+            dimensions.add(names[reference.lower()])
+        elif reference.lower() not in aliases:
+            # neither a column nor an alias, the query is left to DuckDB
+            return None
+    measures = set()
+    for name, column in inside:
+        if column is None:
+            continue
+        if column.lower() not in names:
+            return None
+        column = names[column.lower()]
+        measures.update(f"{partial}:{column}" for partial in PARTIALS[name])
+    return RollupShape(source["table_name"], frozenset(dimensions), frozenset(measures))
+
+
+def _replace_aggregates(expression: Any, replacements: dict[str, Any]) -> Any:
+    """copy of a tree with each aggregate replaced by its re-aggregation over
+    the rollup"""
+    if isinstance(expression, list):
+        return [_replace_aggregates(e, replacements) for e in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if (
+        expression.get("class") == "FUNCTION"
+        and expression["function_name"] in PARTIALS
+    ):
+        name = expression["function_name"]
+        children = expression.get("children", [])
+        column = children[0]["column_names"][-1] if children else None
+        if name == "count_star" or column is None:
+            # a count over no groups is 0, a sum over them is NULL
+            template = 'coalesce(CAST(sum("count_star") AS BIGINT), 0)'
+        elif name == "count":
+            counts = quote_identifier(_partial_column("count", column))
+            template = f"coalesce(CAST(sum({counts}) AS BIGINT), 0)"
+        elif name in ("avg", "mean"):
+            template = (
+                f"sum({quote_identifier(_partial_column('sum', column))}) / "
+                f"sum({quote_identifier(_partial_column('count', column))})"
+            )
+        else:
+            template = f"{name}({quote_identifier(_partial_column(name, column))})"
+        if template not in replacements:
+            replacements[template] = serialise_sql(f"SELECT {template}")[
+                "statements"
+            ][0]["node"]["select_list"][0]
+        replaced = copy.deepcopy(replacements[template])
+        replaced["alias"] = expression.get("alias", "")
+        return replaced
+    return {
+        key: _replace_aggregates(value, replacements) for key, value in expression.items()
+    }
+
+
+class RollupStore:
+    """
+    The rollups of a database, built once a query shape recurs.
+
+    Rollups are recorded in a bookkeeping table so they survive restarts of
+    a database file. They are rebuilt when their base table is reloaded and
+    are not used while they may be out of date. Executed queries are counted
+    and their rollups built on a background thread, see `observe_later`.
+
+    Attributes
+    ----------
+    insightly : Insightly
+        The database holding the rollups.
+    min_queries : int
+        Times a shape is executed before its rollup is built.
+    max_fraction : float
+        Rollups with more rows than this fraction of their base table are
+        not worth keeping.
+    """
+
+    def __init__(
+        self,
+        insightly: "Insightly",
+        min_queries: int = ROLLUP_MIN_QUERIES,
+        max_fraction: float = ROLLUP_MAX_FRACTION,
+    ) -> None:
+        self.insightly = insightly
+        self.min_queries = min_queries
+        self.max_fraction = max_fraction
+        self._seen: Counter[RollupShape] = Counter()
+        self._lock = threading.RLock()
+        self._created = False
+        # counts queries and builds rollups, created on the first query
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def _cursor(self) -> duckdb.DuckDBPyConnection:
+        """a cursor on the database, creating the bookkeeping table first"""
+        cursor = self.insightly.conn.cursor()
+        if not self._created:
+            with self._lock:
+                # concurrent creations conflict even with IF NOT EXISTS
+                if not self._created:
+                    cursor.execute(
+                        f"""
+                        CREATE TABLE IF NOT EXISTS {ROLLUPS_TABLE} (
+                            rollup_name VARCHAR PRIMARY KEY,
+                            base_table VARCHAR,
+                            dimensions VARCHAR[],
+                            measures VARCHAR[],
+                            row_count BIGINT,
+                            useful BOOLEAN,
+                            stale BOOLEAN
+                        )
+                        """
+                    )
+                    self._created = True
+        return cursor
+
+    def _table_columns(self, cursor: duckdb.DuckDBPyConnection) -> dict[str, set[str]]:
+        """columns of each table the agent can query"""
+        columns: dict[str, set[str]] = {t: set() for t in self.insightly.tables}
+        for table, column in cursor.execute(
+            "SELECT table_name, column_name FROM information_schema.columns"
+        ).fetchall():
+            if table in columns:
+                columns[table].add(column)
+        return columns
+
+    def _rollups(
+        self, cursor: duckdb.DuckDBPyConnection, base_table: Optional[str] = None
+    ) -> Iterator[tuple[RollupShape, int, bool, bool]]:
+        """the recorded rollups with their row count, usefulness and staleness"""
+        query = (
+            f"SELECT base_table, dimensions, measures, row_count, useful, stale "
+            f"FROM {ROLLUPS_TABLE}"
+        )
+        params: list[Any] = []
+        if base_table is not None:
+            query += " WHERE base_table = ?"
+            params.append(base_table)
+        for table, dimensions, measures, rows, useful, stale in cursor.execute(
+            query, params
+        ).fetchall():
+            shape = RollupShape(table, frozenset(dimensions), frozenset(measures))
+            yield shape, rows, useful, stale
+
+    def build(self, shape: RollupShape) -> bool:
+        """
+        Builds or rebuilds the rollup of a shape.
+
+        Measures of an existing rollup over the same dimensions are kept, so
+        one rollup answers every shape grouped by those columns.
+
+        Parameters
+        ----------
+        shape : RollupShape
+            The shape to pre-aggregate.
+
+        Returns
+        -------
+        bool
+            True if the rollup is small enough to be used.
+        """
+        # the snapshot the rollup is built from stays attached meanwhile
+        with self.insightly.reading_snapshot(), self._lock:
+            cursor = self._cursor()
+            try:
+                measures = set(shape.measures)
+                for existing, _, _, _ in self._rollups(cursor, shape.base_table):
+                    if existing.rollup_name == shape.rollup_name:
+                        measures |= existing.measures
+                shape = RollupShape(
+                    shape.base_table, shape.dimensions, frozenset(measures)
+                )
+
+                dimensions = [quote_identifier(c) for c in sorted(shape.dimensions)]
+                aggregates = ['count(*) AS "count_star"'] + [
+                    f"{partial}({quote_identifier(column)}) AS "
+                    f"{quote_identifier(_partial_column(partial, column))}"
+                    for partial, column in (m.split(":", 1) for m in sorted(measures))
+                ]
+                base = quote_identifier(shape.base_table)
+                cursor.execute(
+                    f"CREATE OR REPLACE TABLE {quote_identifier(shape.rollup_name)} AS "
+                    f"SELECT {', '.join(dimensions + aggregates)} FROM {base} "
+                    "GROUP BY ALL"
+                )
+                rows = cursor.execute(
+                    f"SELECT count(*) FROM {quote_identifier(shape.rollup_name)}"
+                ).fetchone()[0]
+                base_rows = cursor.execute(f"SELECT count(*) FROM {base}").fetchone()[0]
+                useful = rows <= max(1, base_rows * self.max_fraction)
+                if not useful:
+                    # grouped by too many distinct values to save a scan
+                    cursor.execute(f"DROP TABLE {quote_identifier(shape.rollup_name)}")
+                cursor.execute(
+                    f"INSERT OR REPLACE INTO {ROLLUPS_TABLE} "
+                    "VALUES (?, ?, ?, ?, ?, ?, false)",
+                    [
+                        shape.rollup_name,
+                        shape.base_table,
+                        sorted(shape.dimensions),
+                        sorted(shape.measures),
+                        rows,
+                        useful,
+                    ],
+                )
+            finally:
+                cursor.close()
+            logger.info(
+                f"Built rollup {shape.rollup_name} of {shape.base_table} by "
+                f"{sorted(shape.dimensions)}: {rows} rows from {base_rows}"
+                + ("" if useful else ", too large to use")
+            )
+            return useful
+
+    def observe(self, query: str) -> None:
+        """
+        Counts an executed query and builds its rollup once its shape recurs.
+
+        Parameters
+        ----------
+        query : str
+            The executed SQL query.
+
+        Returns
+        -------
+        None
+        """
+        tree = serialise_sql(query)
+        if tree is None:
+            return
+        with self._lock:
+            cursor = self._cursor()
+            try:
+                shape = query_shape(tree, self._table_columns(cursor))
+                known = {
+                    s.rollup_name: (s, useful, stale)
+                    for s, _, useful, stale in self._rollups(cursor)
+                }
+            finally:
+                cursor.close()
+            if shape is None:
+                return
+            existing = known.get(shape.rollup_name)
+            if existing is not None:
+                rollup, useful, stale = existing
+                if useful and stale:
+                    # the data changed, the shape is still asked for
+                    self.build(shape)
+                    return
+                if not useful or shape.measures <= rollup.measures:
+                    # already built, or known to be too large
+                    return
+            self._seen[shape] += 1
+            if self._seen[shape] >= self.min_queries:
+                del self._seen[shape]
+                self.build(shape)
+
+    def observe_later(self, query: str) -> None:
+        """
+        Counts an executed query with `observe` on the background thread, so
+        the query that recurred does not wait for its rollup to be built.
+
+        Parameters
+        ----------
+        query : str
+            The executed SQL query.
+
+        Returns
+        -------
+        None
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="rollups"
+                )
+            self._executor.submit(self._observe_logged, query)
+
+    def _observe_logged(self, query: str) -> None:
+        """observe, logging failures since nobody waits for them"""
+        try:
+            self.observe(query)
+        except Exception as e:
+            logger.warning(f"Could not build a rollup for the query: {e}")
+
+    def close(self) -> None:
+        """
+        Drops the queries not counted yet, before the database is closed.
+
+        Returns
+        -------
+        None
+        """
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def mine(self, records: list[QueryRecord]) -> list[RollupShape]:
+        """
+        Builds the rollups of the shapes that recur in a query history.
+
+        Parameters
+        ----------
+        records : list[QueryRecord]
+            The executed queries.
+
+        Returns
+        -------
+        list[RollupShape]
+            The shapes whose rollups were built and are used.
+        """
+        cursor = self._cursor()
+        try:
+            table_columns = self._table_columns(cursor)
+        finally:
+            cursor.close()
+        counts: Counter[RollupShape] = Counter()
+        for record in records:
+            tree = serialise_sql(record["query"])
+            shape = query_shape(tree, table_columns) if tree is not None else None
+            if shape is not None:
+                counts[shape] += 1
+        return [
+            shape
+            for shape, count in counts.most_common()
+            if count >= self.min_queries and self.build(shape)
+        ]
+
+    def mark_stale(self, base_table: Optional[str] = None) -> None:
+        """
+        Stops using the rollups of a table, or all of them, until they are
+        rebuilt by `refresh`.
+
+        Parameters
+        ----------
+        base_table : str, optional
+            The table whose data changed, all tables by default.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            cursor = self._cursor()
+            try:
+                if base_table is None:
+                    cursor.execute(f"UPDATE {ROLLUPS_TABLE} SET stale = true")
+                else:
+                    cursor.execute(
+                        f"UPDATE {ROLLUPS_TABLE} SET stale = true WHERE base_table = ?",
+                        [base_table],
+                    )
+            finally:
+                cursor.close()
+
+    def refresh(self, base_table: Optional[str] = None) -> None:
+        """
+        Rebuilds the rollups of a table after its data changed.
+
+        Parameters
+        ----------
+        base_table : str, optional
+            The table that was loaded, all stale rollups by default.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            cursor = self._cursor()
+            try:
+                rollups = [
+                    shape
+                    for shape, _, useful, stale in self._rollups(cursor, base_table)
+                    if (stale or base_table is not None) and useful
+                ]
+            finally:
+                cursor.close()
+            for shape in rollups:
+                if shape.base_table in self.insightly.tables:
+                    self.build(shape)
+
+    def rewrite(self, query: str) -> Optional[str]:
+        """
+        Rewrites a query to read from a rollup that answers it.
+
+        Parameters
+        ----------
+        query : str
+            The SQL query.
+
+        Returns
+        -------
+        str, optional
+            The query over the smallest matching rollup, None if no
+            up-to-date rollup matches.
+        """
+        tree = serialise_sql(query)
+        if tree is None:
+            return None
+        cursor = self._cursor()
+        try:
+            shape = query_shape(tree, self._table_columns(cursor))
+            if shape is None:
+                return None
+            matches = [
+                (rows, rollup)
+                for rollup, rows, useful, stale in self._rollups(cursor, shape.base_table)
+                if useful
+                and not stale
+                and shape.dimensions <= rollup.dimensions
+                and shape.measures <= rollup.measures
+            ]
+            if not matches:
+                return None
+            _, rollup = min(matches, key=lambda match: match[0])
+            # keep the column names of the original query
+            names = cursor.sql(query).columns
+        finally:
+            cursor.close()
+
+        node = tree["statements"][0]["node"]
+        source = node["from_table"]
+        if not source.get("alias"):
+            # qualified references keep pointing at the table name
+            source["alias"] = source["table_name"]
+        source.update(table_name=rollup.rollup_name, schema_name="", catalog_name="")
+        replacements: dict[str, Any] = {}
+        for key in ("select_list", "having", "modifiers"):
+            if key in node:
+                node[key] = _replace_aggregates(node[key], replacements)
+        for expression, name in zip(node["select_list"], names):
+            if not expression.get("alias"):
+                expression["alias"] = name
+        rewritten = deserialise_sql(tree)
+        logger.debug(f"Answering from rollup {rollup.rollup_name}")
+        return rewritten
@@ -0,0 +1,411 @@
+"""Approximate answers from stored samples of large tables.
+
+A Bernoulli sample of each large table is kept in DuckDB. Queries are run
+over the samples with counts and sums scaled up by the sampling fraction,
+and 95% error bounds are returned for the aggregates of the select list, so
+a rough answer can be shown while the exact query runs.
+"""
+
+from __future__ import annotations
+import copy
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+import duckdb
+
+import insightly.admission as admission
+from insightly.history import deserialise_sql, serialise_sql
+from insightly.insightly import QueryTimeoutError
+from insightly.results import json_columns
+from insightly.utils import (
+    APPROX_MIN_ROWS,
+    APPROX_SAMPLE_ROWS,
+    APPROX_Z,
+    INTERNAL_TABLE_PREFIX,
+    RESULT_PAGE_SIZE,
+    quote_identifier,
+)
+
+if TYPE_CHECKING:
+    from insightly.insightly import Insightly
+
+# aggregates that grow with the number of rows, they are divided by the fraction
+SCALED_AGGREGATES: frozenset[str] = frozenset({"count_star", "count", "sum"})
+# prefix of the columns added to compute the error bounds
+BOUND_PREFIX: str = "__approx_"
+# column added with the number of rows of the whole answer
+ROW_COUNT: str = "__approx_rows"
+
+
+class SampleStore:
+    """
+    Bernoulli samples of the large tables of a database.
+
+    Samples are built on a background thread, holding a DuckDB slot, the
+    first time they are asked for after the version of the database changed.
+    Until then the table has no sample and no approximate answer.
+
+    Attributes
+    ----------
+    insightly : Insightly
+        The database holding the samples.
+    min_rows : int
+        Tables with fewer rows are not sampled.
+    sample_rows : int
+        Expected number of rows of a sample.
+    """
+
+    def __init__(
+        self,
+        insightly: "Insightly",
+        min_rows: int = APPROX_MIN_ROWS,
+        sample_rows: int = APPROX_SAMPLE_ROWS,
+    ) -> None:
+        self.insightly = insightly
+        self.min_rows = min_rows
+        self.sample_rows = sample_rows
+        # table -> (database version, sample table or None, fraction)
+        self._samples: dict[str, tuple[int, Optional[str], float]] = {}
+        # tables whose sample is being built
+        self._building: set[str] = set()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def sample(self, table_name: str) -> Optional[tuple[Optional[str], float]]:
+        """
+        The sample of a table, its build is started if it is missing or out
+        of date.
+
+        Parameters
+        ----------
+        table_name : str
+            The table to sample.
+
+        Returns
+        -------
+        tuple[Optional[str], float], optional
+            The sample table and the fraction of rows it holds, None and 1.0
+            for tables too small to sample. None while the sample is built.
+        """
+        with self._lock:
+            cached = self._samples.get(table_name)
+            if cached is not None and cached[0] == self.insightly.version:
+                return cached[1], cached[2]
+            if table_name not in self._building:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="samples"
+                    )
+                self._building.add(table_name)
+                self._executor.submit(self._build_logged, table_name)
+            return None
+
+    def _build_logged(self, table_name: str) -> None:
+        """build, logging failures since nobody waits for them"""
+        try:
+            self._build(table_name)
+        except Exception as e:
+            logger.warning(f"Could not sample {table_name}: {e}")
+        finally:
+            with self._lock:
+                self._building.discard(table_name)
+
+    def _build(self, table_name: str) -> None:
+        """counts the rows of a table and samples it if it is large enough"""
+        # a change made while the sample is built makes it out of date at once
+        version = self.insightly.version
+        base = quote_identifier(table_name)
+        with (
+            admission.admission_controller.duckdb_slot(),
+            self.insightly.reading_snapshot(),
+        ):
+            cursor = self.insightly.conn.cursor()
+            try:
+                rows = cursor.execute(f"SELECT count(*) FROM {base}").fetchone()[0]
+                sample_name, fraction = None, 1.0
+                if rows >= self.min_rows:
+                    sample_name = f"{INTERNAL_TABLE_PREFIX}sample_{table_name}"
+                    fraction = self.sample_rows / rows
+                    cursor.execute(
+                        f"CREATE OR REPLACE TABLE {quote_identifier(sample_name)} AS "
+                        f"SELECT * FROM {base} "
+                        f"USING SAMPLE {fraction * 100:.10f} PERCENT (bernoulli)"
+                    )
+                    logger.info(
+                        f"Sampled {fraction:.4%} of the {rows} rows of {table_name}"
+                    )
+            finally:
+                cursor.close()
+        with self._lock:
+            self._samples[table_name] = (version, sample_name, fraction)
+
+    def close(self) -> None:
+        """
+        Drops the samples not built yet, before the database is closed.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+def _base_tables(expression: Any) -> Iterator[dict[str, Any]]:
+    """the table references of a syntax tree"""
+    if isinstance(expression, dict):
+        if expression.get("type") == "BASE_TABLE" and "table_name" in expression:
+            yield expression
+            return
+        for value in expression.values():
+            yield from _base_tables(value)
+    elif isinstance(expression, list):
+        for value in expression:
+            yield from _base_tables(value)
+
+
+def _expression(sql: str) -> dict[str, Any]:
+    """the syntax tree of a single select list expression"""
+    return serialise_sql(f"SELECT {sql}")["statements"][0]["node"]["select_list"][0]
+
+
+def _is_aggregate(expression: Any) -> bool:
+    """whether an expression is a count, sum or average"""
+    return (
+        isinstance(expression, dict)
+        and expression.get("class") == "FUNCTION"
+        and expression.get("function_name") in SCALED_AGGREGATES | {"avg", "mean"}
+    )
+
+
+def _scale(expression: Any, scale: float) -> Any:
+    """copy of a tree with counts and sums divided by the sampling fraction"""
+    if isinstance(expression, list):
+        return [_scale(e, scale) for e in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if (
+        expression.get("class") == "FUNCTION"
+        and expression.get("function_name") in SCALED_AGGREGATES
+        and not expression.get("distinct")
+    ):
+        scaled = _expression(f"__aggregate__ / {scale!r}")
+        aggregate = copy.deepcopy(expression)
+        scaled["alias"], aggregate["alias"] = aggregate.get("alias", ""), ""
+        scaled["children"][0] = aggregate
+        return scaled
+    return {key: _scale(value, scale) for key, value in expression.items()}
+
+
+def _column_names(insightly: "Insightly", query: str) -> Optional[list[str]]:
+    """the names DuckDB gives the columns of a query, it is bound but not run"""
+    with insightly.reading_snapshot():
+        cursor = insightly.conn.cursor()
+        try:
+            return cursor.sql(query).columns
+        except duckdb.Error:
+            return None
+        finally:
+            cursor.close()
+
+
+def _scale_select_list(
+    insightly: "Insightly", query: str, select_list: list[dict[str, Any]], scale: float
+) -> list[dict[str, Any]]:
+    """the select list scaled, unaliased items keep the name of the exact column
+    rather than taking the one of their scaled expression"""
+    scaled = _scale(select_list, scale)
+    if any(expression.get("class") == "STAR" for expression in select_list):
+        # the positions of the items no longer match the result columns
+        return scaled
+    names: Optional[list[str]] = None
+    for i, expression in enumerate(select_list):
+        if expression.get("alias") or scaled[i] == expression:
+            continue
+        names = names or _column_names(insightly, query)
+        if names is None:
+            break
+        scaled[i]["alias"] = names[i]
+    return scaled
+
+
+def _bound_columns(select_list: list[dict[str, Any]]) -> dict[int, tuple[str, str]]:
+    """the select list items that are a single aggregate, with the kind of
+    bound and the column it aggregates"""
+    bounds: dict[int, tuple[str, str]] = {}
+    if any(expression.get("class") == "STAR" for expression in select_list):
+        # the positions of the items no longer match the result columns
+        return bounds
+    for i, expression in enumerate(select_list):
+        if not _is_aggregate(expression) or expression.get("distinct"):
+            continue
+        name = expression["function_name"]
+        children = expression.get("children", [])
+        if name == "count_star" or (name == "count" and not children):
+            bounds[i] = ("count", "*")
+        elif len(children) == 1 and children[0].get("class") == "COLUMN_REF":
+            column = quote_identifier(children[0]["column_names"][-1])
+            bounds[i] = ("avg" if name == "mean" else name, column)
+    return bounds
+
+
+def _bound_expressions(i: int, kind: str, column: str) -> list[str]:
+    """hidden select list items computing the error bound of item i"""
+    value = f"CAST({column} AS DOUBLE)"
+    n = "count(*)" if column == "*" else f"count({column})"
+    if kind == "count":
+        return [f"{n} AS {BOUND_PREFIX}n_{i}"]
+    if kind == "sum":
+        return [f"sum({value} * {value}) AS {BOUND_PREFIX}sq_{i}"]
+    return [
+        f"stddev_samp({value}) AS {BOUND_PREFIX}sd_{i}",
+        f"{n} AS {BOUND_PREFIX}n_{i}",
+    ]
+
+
+def _bound(
+    kind: str, hidden: dict[str, Any], i: int, fraction: float
+) -> Optional[float]:
+    """half width of the 95% interval of an aggregate over a Bernoulli sample"""
+    finite = 1 - fraction
+    if kind == "count":
+        n = hidden.get(f"{BOUND_PREFIX}n_{i}")
+        return None if n is None else APPROX_Z * math.sqrt(n * finite) / fraction
+    if kind == "sum":
+        squares = hidden.get(f"{BOUND_PREFIX}sq_{i}")
+        if squares is None:
+            return None
+        return APPROX_Z * math.sqrt(finite * squares) / fraction
+    sd, n = hidden.get(f"{BOUND_PREFIX}sd_{i}"), hidden.get(f"{BOUND_PREFIX}n_{i}")
+    if sd is None or not n:
+        return None
+    return APPROX_Z * sd / math.sqrt(n) * math.sqrt(finite)
+
+
+def approximate_query(
+    insightly: "Insightly",
+    query: str,
+    max_rows: int = RESULT_PAGE_SIZE,
+    timeout: Optional[float] = None,
+) -> Optional[dict[str, Any]]:
+    """
+    Runs a query over the samples of the large tables it reads.
+
+    Counts and sums are divided by the sampling fraction, averages, minima
+    and maxima are left as they are. Other aggregates, i.e. distinct counts,
+    are computed over the sample as they are and have no error bound.
+
+    Parameters
+    ----------
+    insightly : Insightly
+        The database to query.
+    query : str
+        The SQL query.
+    max_rows : int, optional
+        Maximum number of rows returned.
+    timeout : float, optional
+        Seconds before the query over the samples is interrupted, see
+        `Insightly.execute_query`.
+
+    Returns
+    -------
+    dict, optional
+        The columns, column arrays, sampling fraction and, for each column
+        that is a count, sum or average, the 95% error bound of each row.
+        None if the query reads no table large enough to be sampled, if the
+        sample of a table is still being built or if the query failed.
+    """
+    tree = serialise_sql(query)
+    if tree is None:
+        return None
+    fraction = 1.0
+    sampled = 0
+    for table in _base_tables(tree):
+        if table["table_name"] not in insightly.tables:
+            continue
+        sample = insightly.samples.sample(table["table_name"])
+        if sample is None:
+            # answering without the sample would take as long as the query
+            return None
+        sample_name, table_fraction = sample
+        if sample_name is None:
+            continue
+        if not table.get("alias"):
+            # qualified references keep pointing at the table name
+            table["alias"] = table["table_name"]
+        table.update(table_name=sample_name, schema_name="", catalog_name="")
+        fraction *= table_fraction
+        sampled += 1
+    if not sampled:
+        return None
+
+    node = tree["statements"][0]["node"]
+    distinct = any(
+        m.get("type") == "DISTINCT_MODIFIER" for m in node.get("modifiers", [])
+    )
+    # error bounds assume one sampled table and one row per group
+    bounds = (
+        _bound_columns(node["select_list"]) if sampled == 1 and not distinct else {}
+    )
+    node["select_list"] = _scale_select_list(
+        insightly, query, node["select_list"], fraction
+    )
+    for key in ("having", "modifiers"):
+        if key in node:
+            node[key] = _scale(node[key], fraction)
+    for i, (kind, column) in bounds.items():
+        node["select_list"].extend(
+            _expression(sql) for sql in _bound_expressions(i, kind, column)
+        )
+    approximate = deserialise_sql(tree)
+
+    def consume(
+        relation: duckdb.DuckDBPyRelation,
+    ) -> tuple[list[tuple[str, str]], dict[str, Any]]:
+        schema = list(zip(relation.columns, [str(t) for t in relation.types]))
+        page = relation.query(
+            "approximate",
+            f"SELECT {json_columns(schema)}, count(*) OVER () AS {ROW_COUNT} "
+            f"FROM approximate LIMIT {int(max_rows)}",
+        )
+        return schema, page.fetchnumpy()
+
+    try:
+        schema, columns = insightly.query_relation(
+            approximate,
+            consume,
+            timeout=timeout,
+        )
+    except (duckdb.Error, QueryTimeoutError) as e:
+        logger.warning(f"Could not run the query over the samples: {e}")
+        return None
+    counts = columns.pop(ROW_COUNT)
+    row_count = int(counts[0]) if len(counts) else 0
+
+    hidden = {
+        name: columns[name].tolist()
+        for name, _ in schema
+        if name.startswith(BOUND_PREFIX)
+    }
+    visible = [(name, t) for name, t in schema if not name.startswith(BOUND_PREFIX)]
+    n_rows = min(row_count, max_rows)
+    error_bounds = {
+        visible[i][0]: [
+            _bound(kind, {k: v[row] for k, v in hidden.items()}, i, fraction)
+            for row in range(n_rows)
+        ]
+        for i, (kind, _) in bounds.items()
+    }
+    return {
+        "columns": [{"name": name, "type": t} for name, t in visible],
+        "data": {name: columns[name].tolist() for name, _ in visible},
+        "row_count": row_count,
+        "sample_fraction": fraction,
+        "confidence": 0.95,
+        "error_bounds": error_bounds,
+    }
@@ -0,0 +1,221 @@
+"""Snapshots of the databases, shared by read-only worker processes.
+
+DuckDB does not let other processes open a database file while one process
+writes to it. In multi-process serving a single writer process loads the
+data, and publishes a copy of the tables of a database after every change:
+
+    <root>/<db_name>/v<version>/<db_name>.duckdb
+    <root>/<db_name>/CURRENT     the version readers should serve
+
+Worker processes attach the current snapshot read-only, which any number of
+processes can do at once, and attach the next one when CURRENT changes.
+"""
+
+from __future__ import annotations
+import os
+import re
+import shutil
+import threading
+from loguru import logger
+from typing import TYPE_CHECKING, Optional
+
+from insightly.utils import SNAPSHOT_KEEP, quote_identifier
+
+if TYPE_CHECKING:
+    from insightly.insightly import Insightly
+
+# file holding the version readers should serve
+POINTER_FILE: str = "CURRENT"
+SNAPSHOT_ALIAS: str = "_insightly_snapshot"
+_VERSION_DIR = re.compile(r"^v(\d+)$")
+
+# snapshots are published one at a time per process
+_publish_lock = threading.Lock()
+
+
+class SnapshotNotFoundError(LookupError):
+    """Raised when a database has no published snapshot yet."""
+
+
+def snapshot_path(root: str, db_name: str, version: int) -> str:
+    """
+    Path of a snapshot.
+
+    Parameters
+    ----------
+    root : str
+        Folder holding the snapshots of every database.
+    db_name : str
+        The name of the database, i.e. "ws_sales".
+    version : int
+        The version of the snapshot.
+
+    Returns
+    -------
+    str
+        The path of the DuckDB file, named after the database so that
+        readers see the same catalog name as the writer.
+    """
+    return os.path.join(root, db_name, f"v{version}", f"{db_name}.duckdb")
+
+
+def current_version(root: str, db_name: str) -> Optional[int]:
+    """
+    The version of a database readers should serve.
+
+    Parameters
+    ----------
+    root : str
+        Folder holding the snapshots of every database.
+    db_name : str
+        The name of the database.
+
+    Returns
+    -------
+    int, optional
+        The version, None if nothing was published yet.
+    """
+    try:
+        with open(os.path.join(root, db_name, POINTER_FILE)) as f:
+            return int(f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def current_snapshot(root: str, db_name: str) -> str:
+    """
+    Path of the snapshot of a database readers should serve.
+
+    Parameters
+    ----------
+    root : str
+        Folder holding the snapshots of every database.
+    db_name : str
+        The name of the database.
+
+    Returns
+    -------
+    str
+        The path of the DuckDB file.
+
+    Raises
+    ------
+    SnapshotNotFoundError
+        If nothing was published for the database yet.
+    """
+    version = current_version(root, db_name)
+    if version is None:
+        raise SnapshotNotFoundError(f"No data was published for {db_name} yet.")
+    return snapshot_path(root, db_name, version)
+
+
+def publish_snapshot(
+    insightly: "Insightly", root: str, keep: int = SNAPSHOT_KEEP
+) -> int:
+    """
+    Copies the tables of a database into a new snapshot and points readers
+    at it.
+
+    Result tables and bookkeeping tables are left out, readers keep their own.
+
+    Parameters
+    ----------
+    insightly : Insightly
+        The database, opened read-write by the writer process.
+    root : str
+        Folder holding the snapshots of every database.
+    keep : int, optional
+        Snapshots kept, older ones are deleted.
+
+    Returns
+    -------
+    int
+        The version of the snapshot.
+    """
+    db_name = insightly.db_name
+    with _publish_lock:
+        version = (current_version(root, db_name) or 0) + 1
+        path = snapshot_path(root, db_name, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            # left over by a publish that failed before moving CURRENT
+            os.remove(path)
+        cursor = insightly.conn.cursor()
+        try:
+            cursor.execute(f"ATTACH '{path}' AS {SNAPSHOT_ALIAS}")
+            try:
+                # one transaction, so the tables are copied as of one point
+                cursor.execute("BEGIN TRANSACTION")
+                for table in insightly.tables:
+                    cursor.execute(
+                        f"CREATE TABLE {SNAPSHOT_ALIAS}.{quote_identifier(table)} "
+                        f"AS SELECT * FROM {quote_identifier(db_name)}."
+                        f"{quote_identifier(table)}"
+                    )
+                cursor.execute("COMMIT")
+            finally:
+                cursor.execute(f"DETACH {SNAPSHOT_ALIAS}")
+        finally:
+            cursor.close()
+        # readers only see the snapshot once it is complete
+        pointer = os.path.join(root, db_name, POINTER_FILE)
+        with open(f"{pointer}.tmp", "w") as f:
+            f.write(str(version))
+        os.replace(f"{pointer}.tmp", pointer)
+        logger.info(f"Published version {version} of {db_name} at {path}")
+        _prune(root, db_name, version - keep)
+    return version
+
+
+def _prune(root: str, db_name: str, below: int) -> None:
+    """deletes the snapshots older than a version, readers still attached to
+    one keep reading it until they detach"""
+    folder = os.path.join(root, db_name)
+    for entry in os.listdir(folder):
+        match = _VERSION_DIR.match(entry)
+        if match is not None and int(match.group(1)) <= below:
+            shutil.rmtree(os.path.join(folder, entry), ignore_errors=True)
+
+
+class SnapshotWatcher:
+    """
+    Notices when a new snapshot of a database was published.
+
+    Only the modification time of CURRENT is read on every check, the file
+    itself when it changed.
+
+    Attributes
+    ----------
+    root : str
+        Folder holding the snapshots of every database.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        # db_name -> modification time of CURRENT when it was last read
+        self._seen: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def changed(self, db_name: str) -> bool:
+        """
+        Whether the snapshot of a database changed since the last check.
+
+        Parameters
+        ----------
+        db_name : str
+            The name of the database.
+
+        Returns
+        -------
+        bool
+            True if CURRENT was written since the last check, the first
+            check only records the current state.
+        """
+        try:
+            mtime = os.stat(os.path.join(self.root, db_name, POINTER_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            previous = self._seen.get(db_name)
+            self._seen[db_name] = mtime
+        return previous is not None and previous != mtime
@@ -0,0 +1,469 @@
+"""Answers to common question templates without the LLM.
+
+Questions such as "average age where sex is female", "count by embarked" or
+"plot fare vs age" are parsed word by word against a catalog of the tables:
+their column names, the values of their categorical columns and their 0/1
+flag columns. Every word has to be a known column, value, number or template
+word, otherwise the question is left to the LLM graph.
+"""
+
+from __future__ import annotations
+import re
+import threading
+from dataclasses import dataclass, field
+from loguru import logger
+from typing import TYPE_CHECKING, Optional, TypedDict
+
+from insightly.classes import PlotType
+from insightly.utils import (
+    TEMPLATE_MAX_CATEGORIES,
+    TEMPLATE_MAX_VALUE_LENGTH,
+    quote_identifier,
+)
+
+if TYPE_CHECKING:
+    from insightly.insightly import Insightly
+
+WORD_PATTERN = re.compile(r"\d+(?:\.\d+)?|[a-z0-9_]+(?:'[a-z]+)?|[<>=!]+")
+
+# phrases of the templates, as tuples of words
+AGGREGATES: dict[tuple[str, ...], str] = {
+    ("average",): "avg",
+    ("mean",): "avg",
+    ("avg",): "avg",
+    ("total",): "sum",
+    ("sum",): "sum",
+    ("maximum",): "max",
+    ("max",): "max",
+    ("highest",): "max",
+    ("largest",): "max",
+    ("minimum",): "min",
+    ("min",): "min",
+    ("lowest",): "min",
+    ("smallest",): "min",
+    ("median",): "median",
+    ("count",): "count",
+    ("number",): "count",
+    ("how", "many"): "count",
+}
+COMPARISONS: dict[tuple[str, ...], str] = {
+    ("greater", "than"): ">",
+    ("more", "than"): ">",
+    ("over",): ">",
+    ("above",): ">",
+    (">",): ">",
+    ("at", "least"): ">=",
+    (">=",): ">=",
+    ("less", "than"): "<",
+    ("fewer", "than"): "<",
+    ("under",): "<",
+    ("below",): "<",
+    ("<",): "<",
+    ("at", "most"): "<=",
+    ("<=",): "<=",
+    ("=",): "=",
+    ("equal", "to"): "=",
+    ("!=",): "<>",
+}
+GROUPINGS: set[tuple[str, ...]] = {
+    ("by",),
+    ("per",),
+    ("for", "each"),
+    ("grouped", "by"),
+    ("broken", "down", "by"),
+}
+VERSUS: set[tuple[str, ...]] = {("vs",), ("versus",), ("against",)}
+NEGATIONS: set[tuple[str, ...]] = {("not",), ("did", "not"), ("didn't",), ("non",)}
+PLOTS: dict[tuple[str, ...], Optional[PlotType]] = {
+    ("plot",): None,
+    ("chart",): None,
+    ("graph",): None,
+    ("draw",): None,
+    ("visualize",): None,
+    ("visualise",): None,
+    ("scatter",): PlotType.SCATTER,
+    ("bar",): PlotType.BAR,
+    ("bars",): PlotType.BAR,
+}
+# items that make the column before them part of a filter
+FILTER_ITEMS: frozenset[str] = frozenset({"compare", "number", "value", "not"})
+# words that carry no meaning in the templates
+STOPWORDS: frozenset[str] = frozenset(
+    "a all an and are as be did do does for from get give has have in is list me "
+    "of on please records rows show tell that the there to was were what what's "
+    "whats when where which who whose with".split()
+)
+
+
+class TemplateAnswer(TypedDict):
+    """A question answered by a template.
+
+    Attributes
+    ----------
+    sql_query : str
+        The SQL query answering the question.
+    meant_as_query : bool
+        Whether the answer is the result of the query rather than a plot.
+    plot_type : PlotType, optional
+        The type of plot, None for queries.
+    columns : list[str]
+        The columns of the result to plot, empty for queries.
+    """
+
+    sql_query: str
+    meant_as_query: bool
+    plot_type: Optional[PlotType]
+    columns: list[str]
+
+
+@dataclass
+class TableCatalog:
+    """
+    What the templates know of a table.
+
+    Attributes
+    ----------
+    table_name : str
+        The table.
+    columns : dict[str, str]
+        The type of each column.
+    values : dict[str, list[str]]
+        The values of the categorical columns, keyed by lower case value.
+    flags : set[str]
+        The columns only holding 0 and 1 or booleans.
+    """
+
+    table_name: str
+    columns: dict[str, str] = field(default_factory=dict)
+    values: dict[str, list[str]] = field(default_factory=dict)
+    flags: set[str] = field(default_factory=set)
+
+
+def _words(text: str) -> list[str]:
+    """the lower case words of a text"""
+    return WORD_PATTERN.findall(text.lower())
+
+
+class CatalogStore:
+    """
+    The catalog of the tables of a database, rebuilt when its version changes.
+
+    Attributes
+    ----------
+    insightly : Insightly
+        The database described.
+    """
+
+    def __init__(self, insightly: "Insightly") -> None:
+        self.insightly = insightly
+        self._catalog: list[TableCatalog] = []
+        self._lexers: list[_Lexer] = []
+        self._version: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _describe(self, table_name: str) -> TableCatalog:
+        """the columns, categorical values and flags of a table"""
+        table = TableCatalog(table_name)
+        with self.insightly.reading_snapshot():
+            cursor = self.insightly.conn.cursor()
+            try:
+                base = quote_identifier(table_name)
+                described = cursor.execute(f"DESCRIBE {base}").fetchall()
+                table.columns = {
+                    name: column_type for name, column_type, *_ in described
+                }
+                for name, column_type in table.columns.items():
+                    column = quote_identifier(name)
+                    if column_type == "BOOLEAN":
+                        table.flags.add(name)
+                    elif column_type == "VARCHAR":
+                        # an estimate first, listing the values of an id column
+                        # would read all of them
+                        distinct = cursor.execute(
+                            f"SELECT approx_count_distinct({column}) FROM {base}"
+                        ).fetchone()[0]
+                        if distinct > TEMPLATE_MAX_CATEGORIES:
+                            continue
+                        for (value,) in cursor.execute(
+                            f"SELECT DISTINCT {column} FROM {base} "
+                            f"WHERE {column} IS NOT NULL "
+                            f"AND length({column}) <= {TEMPLATE_MAX_VALUE_LENGTH}"
+                        ).fetchall():
+                            table.values.setdefault(value.lower(), []).append(name)
+                    elif "INT" in column_type:
+                        low, high, distinct = cursor.execute(
+                            f"SELECT min({column}), max({column}), "
+                            f"count(DISTINCT {column}) FROM {base}"
+                        ).fetchone()
+                        if (low, high, distinct) == (0, 1, 2):
+                            table.flags.add(name)
+            finally:
+                cursor.close()
+        return table
+
+    def _update(self) -> None:
+        """rebuilds the catalog if the database changed since it was built"""
+        if self._version != self.insightly.version:
+            self._catalog = [self._describe(t) for t in self.insightly.tables]
+            self._lexers = [_Lexer(table) for table in self._catalog]
+            self._version = self.insightly.version
+            logger.debug(f"Built the template catalog of {len(self._catalog)} tables")
+
+    def catalog(self) -> list[TableCatalog]:
+        """
+        The catalog of each table, built if it is missing or out of date.
+
+        Returns
+        -------
+        list[TableCatalog]
+            The catalogs.
+        """
+        with self._lock:
+            self._update()
+            return self._catalog
+
+    def lexers(self) -> list["_Lexer"]:
+        """the lexers of the templates of each table"""
+        with self._lock:
+            self._update()
+            return self._lexers
+
+
+class _Lexer:
+    """turns the words of a question into the items of a table's templates"""
+
+    def __init__(self, table: TableCatalog) -> None:
+        self.table = table
+        self.phrases: dict[tuple[str, ...], tuple[str, object]] = {}
+        for phrase, function in AGGREGATES.items():
+            self.phrases[phrase] = ("aggregate", function)
+        for phrase, operator in COMPARISONS.items():
+            self.phrases[phrase] = ("compare", operator)
+        for phrase in GROUPINGS:
+            self.phrases[phrase] = ("group", None)
+        for phrase in VERSUS:
+            self.phrases[phrase] = ("versus", None)
+        for phrase in NEGATIONS:
+            self.phrases[phrase] = ("not", None)
+        for phrase, plot_type in PLOTS.items():
+            self.phrases[phrase] = ("plot", plot_type)
+        # the table name is read as a stopword
+        self.phrases[tuple(_words(table.table_name.replace("_", " ")))] = ("stop", None)
+        for value, columns in table.values.items():
+            phrase = tuple(_words(value))
+            # a value of several columns is ambiguous, and single letters or
+            # template words would be read into any question
+            if len(columns) == 1 and len(value) > 1 and phrase not in self.phrases:
+                if not set(phrase) <= STOPWORDS:
+                    self.phrases[phrase] = ("value", (columns[0], value))
+        for name in table.columns:
+            # columns win over values and template words of the same name
+            self.phrases[tuple(_words(name.replace("_", " ")))] = ("column", name)
+            self.phrases[(name.lower(),)] = ("column", name)
+        self.longest = max(len(phrase) for phrase in self.phrases)
+
+    def items(self, question: str) -> Optional[list[tuple[str, object]]]:
+        """the items of a question, None if a word is not known"""
+        words = _words(question)
+        items: list[tuple[str, object]] = []
+        i = 0
+        while i < len(words):
+            for n in range(min(self.longest, len(words) - i), 0, -1):
+                item = self.phrases.get(tuple(words[i : i + n]))
+                if item is not None:
+                    break
+            else:
+                if re.fullmatch(r"\d+(?:\.\d+)?", words[i]):
+                    item, n = ("number", words[i]), 1
+                elif words[i] in STOPWORDS:
+                    i += 1
+                    continue
+                else:
+                    return None
+            if item[0] != "stop":
+                items.append(item)
+            i += n
+        return items
+
+
+def _literal(value: str, column_type: str) -> str:
+    """a value of a question as a SQL literal for a column"""
+    if column_type == "VARCHAR":
+        return "'" + value.replace("'", "''") + "'"
+    return value
+
+
+def _parse(table: TableCatalog, items: list[tuple[str, object]]) -> Optional[tuple]:
+    """the measures, filters, group, plot type, whether it is "y vs x" and the
+    columns left without a role of a question"""
+    measures: list[tuple[str, Optional[str]]] = []
+    filters: list[str] = []
+    group: Optional[str] = None
+    loose: list[tuple[str, bool]] = []
+    plot: Optional[PlotType] = None
+    is_plot = versus = negated = False
+    i = 0
+    while i < len(items):
+        kind, value = items[i]
+        following = items[i + 1] if i + 1 < len(items) else (None, None)
+        if kind == "aggregate":
+            after = items[i + 2][0] if i + 2 < len(items) else None
+            if following[0] == "column" and after not in FILTER_ITEMS:
+                if value == "count" and following[1] in table.flags:
+                    # "how many survived" counts the rows of the flag
+                    measures.append(("count", None))
+                    filters.append(f"{quote_identifier(following[1])} = 1")
+                else:
+                    measures.append((value, following[1]))
+                i += 1
+            elif value == "count":
+                # "count where age over 30", the column belongs to a filter
+                measures.append(("count", None))
+            else:
+                return None
+        elif kind == "group":
+            if following[0] != "column" or group is not None:
+                return None
+            group = following[1]
+            i += 1
+        elif kind == "compare":
+            if not loose or following[0] != "number":
+                return None
+            column, _ = loose.pop()
+            operator = "<>" if negated and value == "=" else value
+            filters.append(f"{quote_identifier(column)} {operator} {following[1]}")
+            i += 1
+        elif kind == "number":
+            # "pclass 1", the "is" in between is a stopword
+            if not loose:
+                return None
+            column, _ = loose.pop()
+            operator = "<>" if negated else "="
+            literal = _literal(value, table.columns[column])
+            filters.append(f"{quote_identifier(column)} {operator} {literal}")
+        elif kind == "value":
+            column, text = value
+            if loose and loose[-1][0] == column:
+                # "sex is female", the column is named before its value
+                loose.pop()
+            operator = "<>" if negated else "="
+            # compared case-insensitively, the catalog keeps lower case values
+            literal = _literal(text, "VARCHAR")
+            filters.append(f"lower({quote_identifier(column)}) {operator} {literal}")
+        elif kind == "not":
+            negated = True
+            i += 1
+            continue
+        elif kind == "column":
+            loose.append((value, negated))
+        elif kind == "versus":
+            versus = True
+        elif kind == "plot":
+            is_plot = True
+            plot = value or plot
+        negated = False
+        i += 1
+
+    for column, column_negated in list(loose):
+        if column in table.flags and (len(loose) > 2 or not (versus or plot)):
+            # "who survived", a flag on its own is a filter
+            loose.remove((column, column_negated))
+            filters.append(
+                f"{quote_identifier(column)} = {'0' if column_negated else '1'}"
+            )
+    if versus or plot == PlotType.SCATTER:
+        plot = PlotType.SCATTER
+    elif is_plot and group is not None:
+        plot = PlotType.BAR
+    elif is_plot:
+        return None
+    return measures, filters, group, plot, versus, [c for c, _ in loose]
+
+
+def _alias(function: str, column: Optional[str]) -> str:
+    """name of the result column of a measure"""
+    return function if column is None else f"{function}_{column}".lower()
+
+
+def _answer(
+    db_name: str, table: TableCatalog, items: list[tuple[str, object]]
+) -> Optional[TemplateAnswer]:
+    """the SQL query and plot of a question, None if it matches no template"""
+    parsed = _parse(table, items)
+    if parsed is None:
+        return None
+    measures, filters, group, plot, versus, loose = parsed
+    source = f"{quote_identifier(db_name)}.{quote_identifier(table.table_name)}"
+    where = f" WHERE {' AND '.join(filters)}" if filters else ""
+
+    if plot == PlotType.SCATTER:
+        if measures or group is not None or len(loose) != 2:
+            return None
+        # "y vs x" puts the first column on the y axis
+        x, y = (loose[1], loose[0]) if versus else (loose[0], loose[1])
+        select = f"{quote_identifier(x)}, {quote_identifier(y)}"
+        return TemplateAnswer(
+            sql_query=f"SELECT {select} FROM {source}{where}",
+            meant_as_query=False,
+            plot_type=plot,
+            columns=[x, y],
+        )
+
+    if loose:
+        # a column the templates found no role for
+        return None
+    if not measures:
+        if plot != PlotType.BAR:
+            return None
+        measures = [("count", None)]
+    if plot == PlotType.BAR and len(measures) != 1:
+        return None
+    select = [
+        f"{function}({'*' if column is None else quote_identifier(column)}) "
+        f"AS {quote_identifier(_alias(function, column))}"
+        for function, column in measures
+    ]
+    if group is None:
+        sql_query = f"SELECT {', '.join(select)} FROM {source}{where}"
+    else:
+        key = quote_identifier(group)
+        sql_query = (
+            f"SELECT {key}, {', '.join(select)} FROM {source}{where} "
+            f"GROUP BY {key} ORDER BY {key}"
+        )
+    return TemplateAnswer(
+        sql_query=sql_query,
+        meant_as_query=plot is None,
+        plot_type=plot,
+        columns=[group, _alias(*measures[0])] if plot is not None else [],
+    )
+
+
+def match_template(insightly: "Insightly", question: str) -> Optional[TemplateAnswer]:
+    """
+    Answers a question with a template when every word of it is understood.
+
+    Parameters
+    ----------
+    insightly : Insightly
+        The database the question is about.
+    question : str
+        The natural language question.
+
+    Returns
+    -------
+    TemplateAnswer, optional
+        The SQL query and plot, None if the question matches no template or
+        could be about several tables.
+    """
+    answers = []
+    for lexer in insightly.catalog.lexers():
+        items = lexer.items(question)
+        if items is None:
+            continue
+        answer = _answer(insightly.db_name, lexer.table, items)
+        if answer is not None:
+            answers.append(answer)
+    if len(answers) != 1:
+        return None
+    return answers[0]
@@ -1,3 +1,202 @@
 """Utility functions for the Insightly API client."""
 
-MAX_NUM_ATTEMPTS: int = 3
\ No newline at end of file
+import re
+import uuid
+from types import ModuleType
+from typing import Optional
+
+MAX_NUM_ATTEMPTS: int = 3
+
+# seconds a generated SQL query may run before it is interrupted
+QUERY_TIMEOUT_SECONDS: float = 30.0
+
+# prefix of the tables that hold the results of generated queries, and how
+# long they are kept after the query ran
+RESULT_TABLE_PREFIX: str = "transformation_"
+RESULT_TTL_SECONDS: float = 3600.0
+
+# open workspace databases kept per process and how long an idle one stays open
+MAX_OPEN_WORKSPACES: int = 16
+WORKSPACE_IDLE_SECONDS: float = 600.0
+
+# scatter plots switch to WebGL above the first number of points and are
+# aggregated in DuckDB above the second
+SCATTER_WEBGL_THRESHOLD: int = 10_000
+SCATTER_AGGREGATE_THRESHOLD: int = 200_000
+# number of bins per axis of the density grid and points kept when sampling
+SCATTER_DENSITY_BINS: int = 200
+SCATTER_SAMPLE_POINTS: int = 100_000
+# seconds a plot worker process may take to render a figure
+PLOT_RENDER_TIMEOUT_SECONDS: float = 30.0
+
+
+# units DuckDB accepts in memory sizes
+SIZE_UNITS: dict[str, int] = {
+    "b": 1,
+    "kb": 1000,
+    "mb": 1000**2,
+    "gb": 1000**3,
+    "tb": 1000**4,
+    "kib": 1024,
+    "mib": 1024**2,
+    "gib": 1024**3,
+    "tib": 1024**4,
+}
+
+
+def parse_size(size: str) -> int:
+    """Parse a DuckDB memory size such as "2GB" or "512MiB".
+
+    Parameters
+    ----------
+    size : str
+        The size.
+
+    Returns
+    -------
+    int
+        The size in bytes.
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([A-Za-z]*)\s*$", size)
+    unit = match.group(2).lower() if match else ""
+    if match is None or (unit or "b") not in SIZE_UNITS:
+        raise ValueError(f"Invalid memory size {size!r}, use i.e. 512MB or 2GB.")
+    return int(float(match.group(1)) * SIZE_UNITS[unit or "b"])
+
+
+def result_table_name() -> str:
+    """Name a new query result table.
+
+    Returns
+    -------
+    str
+        The prefix and a random hex id, unique across questions and processes.
+    """
+    return f"{RESULT_TABLE_PREFIX}{uuid.uuid4().hex}"
+
+
+def quote_identifier(name: str) -> str:
+    """Quote a column or table name for use in DuckDB SQL.
+
+    Parameters
+    ----------
+    name : str
+        The name to quote.
+
+    Returns
+    -------
+    str
+        The name in double quotes, with embedded quotes escaped.
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+# categories shown in a bar plot, the rest are grouped into "other"
+BAR_TOP_N: int = 30
+
+# rows returned per page of a query result and kept in the state as a preview
+RESULT_PAGE_SIZE: int = 1_000
+RESULT_PREVIEW_ROWS: int = 20
+MAX_RESULT_PAGE_SIZE: int = 50_000
+
+# prefix of the bookkeeping tables, which are hidden from the agent like results
+INTERNAL_TABLE_PREFIX: str = "_insightly_"
+# DuckDB table recording the Delta table and version each mirrored table was
+# loaded from
+DELTA_MIRRORS_TABLE: str = "_insightly_delta_mirrors"
+
+# published snapshots kept per database, older ones are deleted once read-only
+# workers had time to move on, see insightly.snapshots
+SNAPSHOT_KEEP: int = 3
+
+# a query shape is pre-aggregated once it was asked this many times, and the
+# rollup is only kept if it has at most this fraction of the rows of its table
+ROLLUP_MIN_QUERIES: int = 3
+ROLLUP_MAX_FRACTION: float = 0.1
+
+# tables with at least this many rows are sampled for approximate answers,
+# samples hold about this many rows, and z of the error bounds (95%)
+APPROX_MIN_ROWS: int = 1_000_000
+APPROX_SAMPLE_ROWS: int = 100_000
+APPROX_Z: float = 1.96
+
+# columns with at most this many distinct values are categorical, their values
+# of at most this many characters are matched in questions by the templates
+TEMPLATE_MAX_CATEGORIES: int = 50
+TEMPLATE_MAX_VALUE_LENGTH: int = 40
+
+# models of the nodes writing SQL and of the nodes that classify or phrase
+# answers, and seconds an LLM call may take
+LARGE_MODEL: str = "gpt-4o"
+SMALL_MODEL: str = "gpt-4o-mini"
+LLM_TIMEOUT_SECONDS: float = 60.0
+
+# retries of an LLM call that was rate limited or failed on the provider side,
+# with exponential backoff from LLM_BACKOFF_SECONDS capped at
+# LLM_MAX_BACKOFF_SECONDS, and seconds all attempts of a call may take
+LLM_RETRIES: int = 3
+LLM_BACKOFF_SECONDS: float = 0.5
+LLM_MAX_BACKOFF_SECONDS: float = 8.0
+LLM_DEADLINE_SECONDS: float = 90.0
+
+# a hedged LLM call sends a second request once the first took longer than
+# this percentile of the recent calls, measured over at least
+# LLM_HEDGE_MIN_SAMPLES calls, and at most LLM_HEDGE_WORKERS requests run
+# at once for hedged calls
+LLM_HEDGE_PERCENTILE: float = 95.0
+LLM_HEDGE_MIN_SAMPLES: int = 20
+LLM_HEDGE_WORKERS: int = 16
+
+# questions answered at once, questions waiting for their turn and seconds
+# one may wait before it is turned away, see insightly.admission
+ADMISSION_MAX_CONCURRENT: int = 8
+ADMISSION_MAX_QUEUE: int = 32
+ADMISSION_MAX_WAIT_SECONDS: float = 10.0
+# DuckDB queries run at once across the databases of the process
+DUCKDB_SLOTS: int = 4
+
+# recent samples kept per observed metric, i.e. LLM call durations
+METRICS_WINDOW: int = 1_000
+
+# tokens of a prompt above which a node logs a warning, and the tiktoken
+# encoding prompts are counted with (about 4 characters per token without it)
+PROMPT_TOKEN_BUDGET: int = 8_000
+TOKEN_ENCODING: str = "o200k_base"
+
+# executed queries kept to tune the layout of the data, and how often they
+# are written to the history file
+QUERY_HISTORY_SIZE: int = 10_000
+QUERY_HISTORY_FLUSH_SECONDS: float = 1.0
+
+# error pattern -> fix rules kept from repaired queries, and the number of
+# them shown to the model as examples when a query is repaired
+REPAIR_RULES_SIZE: int = 256
+REPAIR_HINTS: int = 3
+
+# rows read from a CSV file at a time when loading it into a Delta table, and
+# the size and compression of the Parquet files written
+INGEST_BATCH_ROWS: int = 100_000
+DELTA_TARGET_FILE_SIZE: int = 128 * 1024 * 1024
+DELTA_COMPRESSION: str = "ZSTD"
+
+# columns a Delta table is z-ordered by when they are inferred from the query
+# history, and hours of removed files kept for readers of older versions
+DELTA_ZORDER_COLUMNS: int = 2
+DELTA_VACUUM_RETENTION_HOURS: int = 168
+
+
+def import_pyarrow() -> Optional[ModuleType]:
+    """Import pyarrow on first use.
+
+    pyarrow is optional and slow to import, so modules that offer Arrow
+    support call this when they need it instead of importing it at the top.
+
+    Returns
+    -------
+    ModuleType, optional
+        The pyarrow module, or None if it is not installed.
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        return None
+    return pyarrow
@@ -1,33 +1,95 @@
+import sqlite3
+from loguru import logger
+from typing import TYPE_CHECKING, Any, Iterator, Optional
 
-from langgraph.graph import StateGraph, END
+from langchain_core.runnables.config import RunnableConfig
+
+import insightly.admission as admission
+from insightly.insightly import Insightly
+from insightly.results import result_exists
 
 from insightly.nodes.check_relevance import CheckRelevanceNode, CheckRelevance
 from insightly.nodes.sql import SQLConverterNode, ConvertToSQL
 from insightly.nodes.sql_or_plot import SQLOrPlotNode, CheckIfSQLOrPlotReturn
 from insightly.nodes.sql import ExecuteSQL, HumanResponse, HumanResponseNode, GetColumnsNode, Columns
-from insightly.nodes.response import RegenerateQueryNode, RewrittenQuestion, FunnyResponse, FunnyResponseNode
+from insightly.nodes.response import FunnyResponse, FunnyResponseNode
+from insightly.nodes.repair import RepairSQLNode, RepairedSQL
+from insightly.nodes.template import DescribeResultNode, TemplateNode
 from insightly.classes import AgentState
 from insightly.nodes.state import State
 from insightly.nodes.conditionals import *
 
-def create_and_compile_workflow() -> None:
+if TYPE_CHECKING:
+    from langgraph.checkpoint.base import BaseCheckpointSaver
+
+
+class RunDatabaseError(LookupError):
+    """Raised when a run is resumed on another database than it was asked on."""
+
+
+class RunAccessError(PermissionError):
+    """Raised when a run is resumed by another tenant than the one who asked."""
+
+
+def sqlite_checkpointer(path: str) -> "BaseCheckpointSaver":
+    """
+    Creates a checkpointer that saves the state after every node to SQLite.
+
+    Runs with a thread id can then be resumed from the last completed node
+    instead of starting again from CHECK_RELEVANCE. The state only holds
+    handles to result tables, so the checkpoints stay small.
+
+    Parameters
+    ----------
+    path : str
+        The SQLite file to save the checkpoints in.
+
+    Returns
+    -------
+    BaseCheckpointSaver
+        The checkpointer, to pass to `create_and_compile_workflow`.
+    """
+    try:
+        from langgraph.checkpoint.sqlite import SqliteSaver
+    except ImportError as e:
+        raise RuntimeError(
+            "langgraph-checkpoint-sqlite is required to checkpoint runs."
+        ) from e
+
+    # shared by the server threads, the saver serialises access itself
+    conn = sqlite3.connect(path, check_same_thread=False)
+    checkpointer = SqliteSaver(conn)
+    checkpointer.setup()
+    return checkpointer
+
+
+def create_and_compile_workflow(
+    checkpointer: Optional["BaseCheckpointSaver"] = None,
+) -> None:
+    # LangGraph is only needed once the graph is built
+    from langgraph.graph import StateGraph, END
+
     workflow = StateGraph(AgentState)
     # initialize individual nodes
+    template_node = TemplateNode()
+    describe_result_node = DescribeResultNode()
     relevance_checker = CheckRelevanceNode(CheckRelevance)
     sql_converter = SQLConverterNode(ConvertToSQL)
     sql_or_plot_checker = SQLOrPlotNode(CheckIfSQLOrPlotReturn)
     execute_sql = ExecuteSQL()
-    regenerate_query_node = RegenerateQueryNode(RewrittenQuestion)
+    repair_sql_node = RepairSQLNode(RepairedSQL)
     funny_response_node = FunnyResponseNode(FunnyResponse)
     human_response_node = HumanResponseNode(HumanResponse)
     get_columns_node = GetColumnsNode(Columns)
 
     # initialize conditional nodes
+    template_router = TemplateConditionalNode()
     relevance_router = RelevanceConditionalNode()
     check_error_in_sql_router = CheckErrorInSQLConditionalNode()
-    check_number_of_attempts_router = CheckNumberOfAttemptsConditionalNode()
 
     # connecting all non-conditional nodes to workflow
+    workflow.add_node(State.MATCH_TEMPLATE, template_node.run)
+    workflow.add_node(State.DESCRIBE_RESULT, describe_result_node.run)
     workflow.add_node(State.CHECK_RELEVANCE, relevance_checker.run)
     workflow.add_node(State.CHECK_IF_SQL_OR_PLOT, sql_or_plot_checker.run)
     workflow.add_node(State.CONVERT_NL_TO_SQL, sql_converter.run)
@@ -35,10 +97,14 @@ def create_and_compile_workflow() -> None:
     workflow.add_node(State.GENERATE_SUCCESS_RESPONSE, human_response_node.run)
     workflow.add_node(State.GENERATE_FUNNY_RESPONSE, funny_response_node.run)
     workflow.add_node(State.GET_COLUMNS, get_columns_node.run)
-    workflow.add_node(State.REGENERATE_QUERY, regenerate_query_node.run)
+    workflow.add_node(State.REPAIR_SQL, repair_sql_node.run)
     workflow.add_node(State.CHECK_IF_ERROR, check_error_in_sql_router.run)
 
     # adding edges to the workflow
+    # questions matching a template skip the LLM and execute their SQL, the
+    # others go through the relevance check
+    workflow.add_conditional_edges(State.MATCH_TEMPLATE, template_router.run)
+
     # if the question is relevant, make a query. If not, generate a funny response
     workflow.add_conditional_edges(State.CHECK_RELEVANCE, relevance_router.run)
 
@@ -52,25 +118,54 @@ def create_and_compile_workflow() -> None:
     # once SQL has been executed, first check if there was an error
     workflow.add_conditional_edges(State.EXECUTE_SQL, check_error_in_sql_router.run)
 
-    # if there was no error, try again to regenerate the query and convert
-    # the new question to SQL
-    workflow.add_edge(State.REGENERATE_QUERY, State.CONVERT_NL_TO_SQL)
-
-    # regenerate attempt if you still have attempts left -- already errored by this point
-    workflow.add_conditional_edges(State.REGENERATE_QUERY, check_number_of_attempts_router.run)
+    # if there was an error and attempts are left, the query was repaired
+    # from the error, run it again
+    workflow.add_edge(State.REPAIR_SQL, State.EXECUTE_SQL)
 
     # workflow.add_edge(State.GET_COLUMNS, State.GENERATE_SCATTER_PLOT)
     workflow.add_edge(State.GET_COLUMNS, END)
     workflow.add_edge(State.GENERATE_FUNNY_RESPONSE, END)
+    workflow.add_edge(State.DESCRIBE_RESULT, END)
 
 
     # set the entry point
-    workflow.set_entry_point(State.CHECK_RELEVANCE)
+    workflow.set_entry_point(State.MATCH_TEMPLATE)
 
-    app = workflow.compile()
+    app = workflow.compile(checkpointer=checkpointer)
     return workflow, app
 
-def ask(app, question: str) -> AgentState:
+
+def _thread_config(
+    config: Optional[RunnableConfig], thread_id: Optional[str]
+) -> Optional[RunnableConfig]:
+    """Adds the thread id the checkpoints of a run are saved under."""
+    if thread_id is None:
+        return config
+    config = dict(config or {})
+    config["configurable"] = {
+        **config.get("configurable", {}),
+        "thread_id": thread_id,
+    }
+    return config
+
+
+def _initial_state(question: str, tenant: Optional[str]) -> AgentState:
+    """the input of a run, on the active database"""
+    return {
+        "question": question,
+        "attempts": 0,
+        "database": Insightly().db_name,
+        "tenant": tenant,
+    }
+
+
+def ask(
+    app,
+    question: str,
+    config: Optional[RunnableConfig] = None,
+    thread_id: Optional[str] = None,
+    tenant: Optional[str] = None,
+) -> AgentState:
     """
     Queries the DuckDB database with a natural language question.
 
@@ -78,6 +173,13 @@ def ask(app, question: str) -> AgentState:
     ----------
     question : str
         The natural language question to query.
+    config : RunnableConfig, optional
+        Passed to the nodes, i.e. {"configurable": {"query_timeout": 5}}.
+    thread_id : str, optional
+        Saves the progress of the run under this id when the app was
+        compiled with a checkpointer, see `resume`.
+    tenant : str, optional
+        Who asked the question, the only one who may resume the run.
 
     Returns
     -------
@@ -85,5 +187,118 @@ def ask(app, question: str) -> AgentState:
         The state of the agent after processing the query.
     """
     # run the workflow with the given question
-    result: AgentState = app.invoke({"question": question, "attempts": 0})
-    return result
\ No newline at end of file
+    result: AgentState = app.invoke(
+        _initial_state(question, tenant), _thread_config(config, thread_id)
+    )
+    return result
+
+
+def stream(
+    app,
+    question: str,
+    config: Optional[RunnableConfig] = None,
+    thread_id: Optional[str] = None,
+    tenant: Optional[str] = None,
+) -> Iterator[tuple[str, Any]]:
+    """
+    Queries the database like `ask`, yielding the previews written by the
+    nodes before the final state.
+
+    Parameters
+    ----------
+    question : str
+        The natural language question to query.
+    config : RunnableConfig, optional
+        Passed to the nodes, i.e. {"configurable": {"approximate": True}}.
+    thread_id, tenant : str, optional
+        See `ask`.
+
+    Returns
+    -------
+    Iterator[tuple[str, Any]]
+        ("preview", payload) for each preview, then ("result", AgentState).
+    """
+    result: Optional[AgentState] = None
+    for mode, chunk in app.stream(
+        _initial_state(question, tenant),
+        _thread_config(config, thread_id),
+        stream_mode=["custom", "values"],
+    ):
+        if mode == "custom":
+            yield "preview", chunk
+        else:
+            result = chunk
+    yield "result", result
+
+
+def resume(
+    app,
+    thread_id: str,
+    config: Optional[RunnableConfig] = None,
+    tenant: Optional[str] = None,
+) -> Optional[AgentState]:
+    """
+    Continues a checkpointed run from the last node that completed.
+
+    Nodes that already ran are not run again, so their LLM calls are not
+    repeated. A run that already finished returns its final state. When the
+    result table of the run is gone, i.e. it expired or was kept in the
+    memory of a process that restarted, its query is executed again.
+
+    Parameters
+    ----------
+    app
+        The workflow compiled with a checkpointer.
+    thread_id : str
+        The thread id the run was started with.
+    config : RunnableConfig, optional
+        Passed to the nodes, i.e. {"configurable": {"query_timeout": 5}}.
+    tenant : str, optional
+        Who resumes the run, it must be the tenant who asked the question.
+
+    Returns
+    -------
+    AgentState, optional
+        The state of the agent after the run, None if no run was saved
+        under the thread id.
+
+    Raises
+    ------
+    RunAccessError
+        If the run was asked by another tenant.
+    RunDatabaseError
+        If the run was asked about another database than the active one.
+    """
+    config = _thread_config(config, thread_id)
+    snapshot: Any = app.get_state(config)
+    if not snapshot.values:
+        return None
+    if snapshot.values.get("tenant") != tenant:
+        raise RunAccessError(f"Run {thread_id} was not asked by {tenant}.")
+    database = snapshot.values.get("database")
+    if database is not None and database != Insightly().db_name:
+        raise RunDatabaseError(
+            f"Run {thread_id} was not asked about {Insightly().db_name}."
+        )
+    _restore_result(snapshot.values)
+    if not snapshot.next:
+        logger.debug(f"Run {thread_id} already finished")
+        return snapshot.values
+    logger.info(f"Resuming run {thread_id} at {', '.join(snapshot.next)}")
+    # no input continues from the saved checkpoint
+    result: AgentState = app.invoke(None, config)
+    return result
+
+
+def _restore_result(state: AgentState) -> None:
+    """executes the query of a run again when its result table is gone"""
+    sql_query_info = state.get("sql_query_info") or {}
+    if not isinstance(sql_query_info.get("query_result"), dict):
+        # the query did not run yet, failed or returned no rows
+        return
+    table_name = sql_query_info["table_name"]
+    if result_exists(table_name):
+        return
+    logger.info(f"Result {table_name} is gone, executing its query again")
+    with admission.admission_controller.duckdb_slot():
+        Insightly().materialize_query(sql_query_info["sql_query"], table_name)
\ No newline at end of file
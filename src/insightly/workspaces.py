@@ -0,0 +1,293 @@
+"""Per-dataset workspaces, each backed by its own DuckDB database file."""
+
+from __future__ import annotations
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from loguru import logger
+from typing import Any, Dict, Iterator, Optional
+
+from insightly.insightly import Insightly
+from insightly.snapshots import SnapshotWatcher, current_snapshot
+from insightly.utils import MAX_OPEN_WORKSPACES, WORKSPACE_IDLE_SECONDS
+
+# workspace ids end up in file and catalog names, so keep them to identifiers
+WORKSPACE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,64}$")
+
+
+class WorkspaceManager:
+    """
+    A bounded LRU of open workspace databases.
+
+    Workspaces that have not been used for `idle_seconds` are closed, and the
+    least recently used ones are closed when more than `max_open` are open or
+    their combined DuckDB memory goes over `memory_budget`. Workspaces that
+    are being used by a request are never closed.
+
+    Attributes
+    ----------
+    root : str
+        Folder holding the workspace database files.
+    max_open : int
+        Maximum number of databases kept open.
+    idle_seconds : float
+        Seconds after which an unused database is closed.
+    memory_budget : int, optional
+        Bytes of DuckDB memory all open workspaces may hold together.
+    config : dict, optional
+        DuckDB configuration used to open every workspace.
+    snapshots : str, optional
+        Folder of the snapshots published by the writer process. When set,
+        workspaces are served read-only from their current snapshot, see
+        `insightly.snapshots`, instead of opening their database files.
+    results : str, optional
+        Folder the result tables of every workspace are written to, shared
+        by the worker processes so that any of them can read a result, see
+        `Insightly.has_result`. By default results stay in the process that
+        stored them.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_open: int = MAX_OPEN_WORKSPACES,
+        idle_seconds: float = WORKSPACE_IDLE_SECONDS,
+        memory_budget: Optional[int] = None,
+        config: Optional[Dict[str, Any]] = None,
+        snapshots: Optional[str] = None,
+        results: Optional[str] = None,
+    ) -> None:
+        self.root = root
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.memory_budget = memory_budget
+        self.config = config or {}
+        self.snapshots = snapshots
+        self.results = results
+        self._watcher = SnapshotWatcher(snapshots) if snapshots else None
+        # workspace id -> open database, least recently used first
+        self._open: OrderedDict[str, Insightly] = OrderedDict()
+        self._last_used: dict[str, float] = {}
+        self._in_use: dict[str, int] = {}
+        self._lock = threading.RLock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, workspace_id: str) -> str:
+        """
+        Path of the database file for a workspace.
+
+        Parameters
+        ----------
+        workspace_id : str
+            The id of the workspace.
+
+        Returns
+        -------
+        str
+            The path to the DuckDB file.
+        """
+        if not WORKSPACE_ID_PATTERN.match(workspace_id):
+            raise ValueError(
+                f"Invalid workspace id {workspace_id!r}, use letters, digits and underscores."
+            )
+        # prefixed so the catalog name DuckDB derives from it is a valid identifier
+        return os.path.join(self.root, f"ws_{workspace_id}.duckdb")
+
+    def get(self, workspace_id: str) -> Insightly:
+        """
+        Returns the database of a workspace, opening it if needed.
+
+        Parameters
+        ----------
+        workspace_id : str
+            The id of the workspace.
+
+        Returns
+        -------
+        Insightly
+            The database of the workspace.
+
+        Raises
+        ------
+        SnapshotNotFoundError
+            If workspaces are served from snapshots and none was published
+            for this one yet.
+        """
+        with self._lock:
+            insightly = self._open.get(workspace_id)
+            if insightly is None:
+                insightly = self._open_database(workspace_id)
+                self._open[workspace_id] = insightly
+            elif self._watcher is not None and self._watcher.changed(
+                insightly.db_name
+            ):
+                # the writer published new data
+                insightly.attach_snapshot(
+                    current_snapshot(self.snapshots, insightly.db_name)
+                )
+            self._open.move_to_end(workspace_id)
+            self._last_used[workspace_id] = time.monotonic()
+            self.evict()
+            return insightly
+
+    def _open_database(self, workspace_id: str) -> Insightly:
+        """open the database file of a workspace, or its current snapshot"""
+        path = self.path(workspace_id)
+        db_name = os.path.splitext(os.path.basename(path))[0]
+        results = None if self.results is None else os.path.join(self.results, db_name)
+        if self.snapshots is None:
+            logger.info(f"Opening workspace {workspace_id} at {path}")
+            return Insightly(
+                database=path, config=self.config, results_directory=results
+            )
+        # seen before reading CURRENT, a publish in between is caught next time
+        self._watcher.changed(db_name)
+        snapshot = current_snapshot(self.snapshots, db_name)
+        logger.info(f"Opening workspace {workspace_id} from {snapshot}")
+        return Insightly(
+            snapshot=snapshot, config=self.config, results_directory=results
+        )
+
+    @contextmanager
+    def use(self, workspace_id: str) -> Iterator[Insightly]:
+        """
+        Opens a workspace and makes it the one `Insightly()` returns.
+
+        The workspace cannot be evicted while the context is open.
+
+        Parameters
+        ----------
+        workspace_id : str
+            The id of the workspace.
+
+        Returns
+        -------
+        Iterator[Insightly]
+            The database of the workspace.
+        """
+        insightly = self.acquire(workspace_id)
+        try:
+            with insightly.activate():
+                yield insightly
+        finally:
+            self.release(workspace_id)
+
+    def acquire(self, workspace_id: str) -> Insightly:
+        """
+        Opens a workspace and keeps it from being evicted until `release`.
+
+        For work that outlives a request handler, i.e. a streamed export.
+
+        Parameters
+        ----------
+        workspace_id : str
+            The id of the workspace.
+
+        Returns
+        -------
+        Insightly
+            The database of the workspace.
+        """
+        with self._lock:
+            insightly = self.get(workspace_id)
+            self._in_use[workspace_id] = self._in_use.get(workspace_id, 0) + 1
+            return insightly
+
+    def release(self, workspace_id: str) -> None:
+        """
+        Lets a workspace returned by `acquire` be evicted again.
+
+        Parameters
+        ----------
+        workspace_id : str
+            The id of the workspace.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._in_use[workspace_id] -= 1
+            if self._in_use[workspace_id] == 0:
+                del self._in_use[workspace_id]
+            self._last_used[workspace_id] = time.monotonic()
+
+    def close(self, workspace_id: str) -> None:
+        """
+        Closes a workspace database if it is open and not in use.
+
+        Parameters
+        ----------
+        workspace_id : str
+            The id of the workspace.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            if workspace_id in self._in_use or workspace_id not in self._open:
+                return
+            logger.info(f"Closing workspace {workspace_id}")
+            self._open.pop(workspace_id).close()
+            self._last_used.pop(workspace_id, None)
+
+    def memory_usage(self) -> dict[str, int]:
+        """
+        DuckDB memory held by each open workspace.
+
+        Returns
+        -------
+        dict[str, int]
+            Bytes of memory used, keyed by workspace id.
+        """
+        with self._lock:
+            return {
+                workspace_id: insightly.memory_usage()
+                for workspace_id, insightly in self._open.items()
+            }
+
+    def memory_reports(self) -> dict[str, dict[str, Any]]:
+        """
+        Memory settings, buffers and spill files of each open workspace.
+
+        Returns
+        -------
+        dict[str, dict[str, Any]]
+            The `Insightly.memory_report` of each workspace, keyed by id.
+        """
+        with self._lock:
+            return {
+                workspace_id: insightly.memory_report()
+                for workspace_id, insightly in self._open.items()
+            }
+
+    def evict(self) -> None:
+        """
+        Closes idle workspaces and the least recently used ones over the limits.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            now = time.monotonic()
+            for workspace_id in list(self._open):
+                if now - self._last_used[workspace_id] > self.idle_seconds:
+                    self.close(workspace_id)
+
+            # the most recently used workspace is the one being asked for
+            evictable = [w for w in list(self._open)[:-1] if w not in self._in_use]
+            while len(self._open) > self.max_open and evictable:
+                self.close(evictable.pop(0))
+
+            if self.memory_budget is None:
+                return
+            usage = self.memory_usage()
+            while sum(usage.values()) > self.memory_budget and evictable:
+                workspace_id = evictable.pop(0)
+                self.close(workspace_id)
+                usage.pop(workspace_id, None)
@@ -0,0 +1,33 @@
+"""Fixtures shared by the tests."""
+
+from typing import Iterator
+
+import pytest
+
+from insightly.insightly import Insightly
+
+
+def create_passengers(insightly: Insightly) -> None:
+    """adds a passengers table of mixed case columns"""
+    insightly.conn.execute(
+        """
+        CREATE TABLE titanic AS
+        SELECT
+            range AS "PassengerId",
+            1 + range % 3 AS "Pclass",
+            CASE WHEN range % 2 = 0 THEN 'male' ELSE 'female' END AS "Sex",
+            (range % 80)::DOUBLE AS "Age",
+            (range % 50)::DOUBLE + 0.5 AS "Fare"
+        FROM range(1000)
+        """
+    )
+    insightly._refresh_tables()
+
+
+@pytest.fixture
+def database() -> Iterator[Insightly]:
+    """an in-memory database with a passengers table of mixed case columns"""
+    insightly = Insightly(database=":memory:")
+    create_passengers(insightly)
+    yield insightly
+    insightly.close()
@@ -0,0 +1,78 @@
+"""Admission of questions in turns per tenant, and turning them away."""
+
+import threading
+import time
+
+import pytest
+
+from insightly.admission import AdmissionController, AdmissionRejected
+
+
+def wait_for(condition, seconds: float = 2.0) -> None:
+    deadline = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def queue_question(
+    controller: AdmissionController, tenant: str, name: str, order: list[str]
+) -> threading.Thread:
+    """a question waiting in the queue of a tenant, it records its turn"""
+    queued = controller._queued
+
+    def answer() -> None:
+        with controller.admitted(tenant):
+            order.append(name)
+
+    thread = threading.Thread(target=answer)
+    thread.start()
+    wait_for(lambda: controller._queued == queued + 1)
+    return thread
+
+
+def test_tenants_take_turns() -> None:
+    controller = AdmissionController(max_concurrent=1, max_queue=10, max_wait=5)
+    order: list[str] = []
+    held = controller.acquire("busy")
+    # a burst from one tenant, then a question from another
+    threads = [queue_question(controller, "a", f"a{i}", order) for i in range(3)]
+    threads.append(queue_question(controller, "b", "b0", order))
+    controller.release(held)
+    for thread in threads:
+        thread.join(5)
+    assert order == ["a0", "b0", "a1", "a2"]
+
+
+def test_full_queue_turns_questions_away() -> None:
+    controller = AdmissionController(max_concurrent=1, max_queue=1, max_wait=5)
+    held = controller.acquire("busy")
+    thread = queue_question(controller, "a", "a0", [])
+    start = time.monotonic()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("b")
+    assert time.monotonic() - start < 0.5
+    assert rejected.value.retry_after >= 1
+    controller.release(held)
+    thread.join(5)
+
+
+def test_question_waits_at_most_max_wait() -> None:
+    controller = AdmissionController(max_concurrent=1, max_wait=0.2)
+    held = controller.acquire("busy")
+    start = time.monotonic()
+    with pytest.raises(AdmissionRejected, match="Timed out"):
+        controller.acquire("a")
+    assert 0.2 <= time.monotonic() - start < 1
+    # the question that gave up left the queue
+    assert controller._queued == 0
+    controller.release(held)
+    controller.release(controller.acquire("a"))
+
+
+def test_questions_wait_for_llm_tokens() -> None:
+    controller = AdmissionController(max_wait=0.2, tokens_per_minute=60)
+    controller.consume_tokens(120)
+    with pytest.raises(AdmissionRejected, match="token rate limit") as rejected:
+        controller.acquire("a")
+    assert rejected.value.retry_after > 60
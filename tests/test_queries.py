@@ -0,0 +1,99 @@
+"""Deadlines and cancellation of queries, which never hold up each other."""
+
+import threading
+import time
+
+import pytest
+
+from insightly.insightly import Insightly, QueryCancelledError, QueryTimeoutError
+
+# a query that keeps DuckDB busy for a few seconds
+SLOW = (
+    "SELECT count(*) FROM range(100000) a, range(100000) b "
+    "WHERE (a.range * b.range) % 7 = 3"
+)
+
+
+def run_in_background(call) -> tuple[threading.Thread, dict]:
+    outcome: dict = {}
+
+    def run() -> None:
+        try:
+            outcome["result"] = call()
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def test_query_past_its_deadline_is_interrupted(database: Insightly) -> None:
+    start = time.monotonic()
+    with pytest.raises(QueryTimeoutError):
+        database.execute_query(SLOW, timeout=0.2)
+    assert time.monotonic() - start < 2
+
+
+def test_query_is_cancelled_by_id(database: Insightly) -> None:
+    thread, outcome = run_in_background(
+        lambda: database.execute_query(SLOW, timeout=30, query_id="slow")
+    )
+    time.sleep(0.3)
+    assert database.cancel_query("slow")
+    thread.join(5)
+    assert isinstance(outcome.get("error"), QueryCancelledError)
+    assert not database.cancel_query("slow")
+
+
+def test_queries_do_not_wait_for_each_other(database: Insightly) -> None:
+    thread, _ = run_in_background(
+        lambda: database.execute_query(SLOW, timeout=30, query_id="slow")
+    )
+    time.sleep(0.2)
+    start = time.monotonic()
+    assert database.execute_query("SELECT 1 AS one")["one"].tolist() == [1]
+    assert time.monotonic() - start < 0.5
+    database.cancel_query("slow")
+    thread.join(5)
+
+
+def test_limits_are_not_set_per_query(database: Insightly) -> None:
+    with pytest.raises(TypeError):
+        database.execute_query("SELECT 1", memory_limit="100MB")
+
+
+def test_limits_are_set_when_the_database_is_opened() -> None:
+    insightly = Insightly(database=":memory:", memory_limit="256MB", threads=2)
+    try:
+        settings = dict(
+            insightly.conn.execute(
+                "SELECT name, value FROM duckdb_settings() "
+                "WHERE name IN ('memory_limit', 'threads')"
+            ).fetchall()
+        )
+        assert settings["threads"] == "2"
+        assert insightly.memory_ceiling == 256 * 1000**2
+    finally:
+        insightly.close()
+
+
+@pytest.mark.parametrize(
+    "query, rows",
+    [
+        ("SELECT range FROM range(100)", 10),
+        ("SELECT range FROM range(100);", 10),
+        ("SELECT range FROM range(100) -- every row", 10),
+        ("SELECT range FROM range(100)\n-- every row\n", 10),
+        ("WITH r AS (SELECT range FROM range(100)) SELECT * FROM r", 10),
+        ("SELECT range FROM range(100) LIMIT 20", 20),
+    ],
+)
+def test_auto_limit(database: Insightly, query: str, rows: int) -> None:
+    limited = Insightly.apply_auto_limit(query, 10)
+    assert len(database.conn.execute(limited).fetchall()) == rows
+
+
+def test_auto_limit_leaves_other_statements_alone() -> None:
+    for query in ("CREATE TABLE t (i INT)", "SELECT 1; SELECT 2"):
+        assert Insightly.apply_auto_limit(query, 10) == query
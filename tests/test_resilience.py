@@ -0,0 +1,183 @@
+"""Deadlines, retries and hedging of LLM calls against a local fake server.
+
+The server speaks the OpenAI chat completions API and answers each request
+with the step of its plan for the attempt the client numbered it with: a
+delay, then an error status or an answer. Numbering the attempts when they
+are made keeps a hedge from taking the step of the request it races.
+"""
+
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+
+import pytest
+
+from insightly.metrics import metrics
+from insightly.models import ModelConfig, ModelRouter
+from insightly.resilience import call_llm
+from insightly.utils import LLM_HEDGE_MIN_SAMPLES
+
+
+class FakeLLM(ThreadingHTTPServer):
+    """answers attempts with the steps of a plan, (delay, status) each"""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        self.plan: list[tuple[float, int]] = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def step(self, attempt: int) -> tuple[float, int]:
+        with self.lock:
+            self.requests += 1
+        return self.plan[attempt] if attempt < len(self.plan) else (0.0, 200)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    server: FakeLLM
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        delay, status = self.server.step(int(self.headers["X-Attempt"]))
+        time.sleep(delay)
+        if status == 200:
+            payload = {
+                "id": "fake",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "answer"},
+                    }
+                ],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+        else:
+            payload = {"error": {"message": "injected", "type": "server_error"}}
+        data = json.dumps(payload).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("retry-after-ms", "10")
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up on the request
+            pass
+
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch) -> Iterator[FakeLLM]:
+    monkeypatch.setenv("OPENAI_API_KEY", "fake")
+    server = FakeLLM()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def ask(server: FakeLLM, node: str, **settings) -> tuple[str, float]:
+    """makes a call through the router, returns the answer and its seconds"""
+    config = ModelConfig("fake-model", base_url=server.url, **settings)
+    router = ModelRouter(config, config)
+    attempts = itertools.count()
+
+    def request(timeout: Optional[float]) -> str:
+        headers = {"X-Attempt": str(next(attempts))}
+        client = router.client(config, timeout)
+        return client.invoke("question", extra_headers=headers).content
+
+    start = time.monotonic()
+    answer = call_llm(request, node, config)
+    return answer, time.monotonic() - start
+
+
+def warm_up(node: str, seconds: float) -> None:
+    """recent calls of a node, so that its calls are hedged after `seconds`"""
+    for _ in range(LLM_HEDGE_MIN_SAMPLES):
+        metrics.observe("llm_call_seconds", seconds, node=node, model="fake-model")
+
+
+def counter(name: str, node: str) -> float:
+    for entry in metrics.snapshot().get(name, []):
+        if entry["labels"].get("node") == node:
+            return entry["value"]
+    return 0.0
+
+
+def test_retries_server_errors(server: FakeLLM) -> None:
+    server.plan = [(0.0, 429), (0.0, 503)]
+    answer, _ = ask(server, "retried", retries=2)
+    assert answer == "answer"
+    assert server.requests == 3
+    assert counter("llm_retries", "retried") == 2
+
+
+def test_client_errors_are_not_retried(server: FakeLLM) -> None:
+    server.plan = [(0.0, 400)]
+    with pytest.raises(Exception):
+        ask(server, "rejected", retries=2)
+    assert server.requests == 1
+
+
+def test_unhedged_request_is_cut_to_the_deadline(server: FakeLLM) -> None:
+    # the request timeout alone would let the request run for 3 seconds
+    server.plan = [(3.0, 200)]
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        ask(server, "unhedged", timeout=30.0, deadline=0.5, retries=3)
+    assert time.monotonic() - start < 1.5
+
+
+def test_retry_is_cut_to_the_deadline(server: FakeLLM) -> None:
+    server.plan = [(0.3, 503), (3.0, 200)]
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        ask(server, "retry-deadline", timeout=30.0, deadline=0.8, retries=3)
+    assert time.monotonic() - start < 1.8
+
+
+def test_hedge_answers_a_slow_request(server: FakeLLM) -> None:
+    warm_up("hedged", 0.05)
+    server.plan = [(2.0, 200), (0.0, 200)]
+    answer, seconds = ask(server, "hedged", hedge=True)
+    assert answer == "answer"
+    assert seconds < 1.5
+    assert counter("llm_hedges", "hedged") == 1
+    assert counter("llm_hedge_wins", "hedged") == 1
+
+
+def test_first_request_fails_after_the_hedge_fired(server: FakeLLM) -> None:
+    warm_up("hedge-fails", 0.05)
+    # the first attempt fails while the hedge is running, the hedge answers
+    server.plan = [(0.3, 500), (0.6, 200)]
+    answer, seconds = ask(server, "hedge-fails", hedge=True, retries=0)
+    assert answer == "answer"
+    assert server.requests == 2
+    assert seconds < 1.5
+    assert counter("llm_hedge_wins", "hedge-fails") == 1
+    assert counter("llm_errors", "hedge-fails") == 0
+
+
+def test_hedged_call_keeps_its_deadline(server: FakeLLM) -> None:
+    warm_up("hedge-deadline", 0.05)
+    server.plan = [(3.0, 200), (3.0, 200)]
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        ask(server, "hedge-deadline", hedge=True, deadline=0.5, retries=3)
+    assert time.monotonic() - start < 1.5
@@ -0,0 +1,153 @@
+"""Exporting and paging the stored results of queries."""
+
+import csv
+import io
+import json
+import os
+from typing import Any, Iterator
+
+import pytest
+
+from insightly.insightly import Insightly
+from insightly.results import (
+    ExportFormat,
+    InvalidCursorError,
+    ResultAccessError,
+    check_result_token,
+    encode_cursor,
+    export_result,
+    result_page,
+    sign_result,
+)
+from insightly.utils import import_pyarrow
+
+TABLE = "transformation_0123abcd"
+
+
+class RecordingConnection:
+    """a connection recording the queries run on its cursors"""
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.queries: list[str] = []
+
+    def cursor(self) -> "RecordingCursor":
+        return RecordingCursor(self.conn.cursor(), self.queries)
+
+
+class RecordingCursor:
+    def __init__(self, cursor, queries: list[str]) -> None:
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, query: str, *args: Any) -> Any:
+        self.queries.append(query)
+        return self.cursor.execute(query, *args)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.cursor, name)
+
+
+@pytest.fixture
+def result(database: Insightly) -> Iterator[Insightly]:
+    """the database with a stored result of the passengers, active"""
+    database.materialize_query(
+        'SELECT "PassengerId", "Fare" FROM titanic ORDER BY "PassengerId"', TABLE
+    )
+    with database.activate():
+        yield database
+
+
+def test_export_is_cleaned_up_when_it_is_never_read(result: Insightly) -> None:
+    export = export_result(TABLE, ExportFormat.CSV)
+    assert os.path.isdir(export.folder)
+    export.close()
+    assert not os.path.exists(export.folder)
+    # closing again, i.e. after the response failed, is harmless
+    export.close()
+
+
+def test_export_is_cleaned_up_after_it_was_read(result: Insightly) -> None:
+    export = export_result(TABLE, ExportFormat.CSV)
+    rows = list(csv.reader(io.StringIO(b"".join(export).decode())))
+    export.close()
+    assert rows[0] == ["PassengerId", "Fare"]
+    assert len(rows) == 1001
+    assert not os.path.exists(export.folder)
+
+
+def test_export_is_cleaned_up_when_reading_stops(result: Insightly) -> None:
+    export = export_result(TABLE, ExportFormat.PARQUET)
+    next(iter(export))
+    export.close()
+    assert not os.path.exists(export.folder)
+
+
+@pytest.mark.skipif(import_pyarrow() is None, reason="pyarrow is not installed")
+def test_unread_arrow_export_releases_its_cursor(result: Insightly) -> None:
+    export = export_result(TABLE, ExportFormat.ARROW)
+    export.close()
+    with pytest.raises(Exception):
+        export.conn.execute("SELECT 1")
+
+
+def read_all_pages(page_size: int) -> list[dict]:
+    pages = [result_page(TABLE, page_size=page_size)]
+    while pages[-1]["next_cursor"] is not None:
+        pages.append(result_page(TABLE, pages[-1]["next_cursor"], page_size))
+    return pages
+
+
+def test_pages_hold_every_row_once(result: Insightly) -> None:
+    pages = read_all_pages(300)
+    assert [len(page["data"]["PassengerId"]) for page in pages] == [300, 300, 300, 100]
+    ids = [i for page in pages for i in page["data"]["PassengerId"]]
+    assert ids == list(range(1000))
+    assert {page["row_count"] for page in pages} == {1000}
+
+
+def test_rows_are_counted_when_the_result_is_stored(
+    result: Insightly, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    assert result._result_rows[TABLE] == 1000
+    monkeypatch.setattr(result, "conn", RecordingConnection(result.conn))
+    read_all_pages(300)
+    assert result.conn.queries
+    assert not any("count(" in query for query in result.conn.queries)
+
+
+def test_cursor_of_another_table_is_rejected(result: Insightly) -> None:
+    with pytest.raises(InvalidCursorError):
+        result_page(TABLE, encode_cursor("transformation_ffff", 10))
+    with pytest.raises(InvalidCursorError):
+        result_page(TABLE, "not a cursor")
+
+
+def test_non_finite_floats_are_null(database: Insightly) -> None:
+    database.materialize_query(
+        "SELECT * FROM (VALUES (1.5), ('nan'::DOUBLE), ('inf'::DOUBLE), "
+        "('-inf'::DOUBLE), (NULL)) AS v(x)",
+        TABLE,
+    )
+    with database.activate():
+        page = result_page(TABLE)
+    assert page["data"]["x"] == [1.5, None, None, None, None]
+    json.dumps(page, allow_nan=False)
+
+
+def test_result_token_is_bound_to_table_database_and_tenant() -> None:
+    token = sign_result(TABLE, "memory", "alice")
+    check_result_token(token, TABLE, "memory", "alice")
+    for table_name, db_name, tenant in [
+        ("transformation_ffff", "memory", "alice"),
+        (TABLE, "other", "alice"),
+        (TABLE, "memory", "bob"),
+    ]:
+        with pytest.raises(ResultAccessError):
+            check_result_token(token, table_name, db_name, tenant)
+
+
+@pytest.mark.parametrize("token", [None, "", "forged", "é"])
+def test_invalid_result_tokens_are_rejected(token) -> None:
+    with pytest.raises(ResultAccessError):
+        check_result_token(token, TABLE, "memory", "alice")
@@ -0,0 +1,85 @@
+"""Answering aggregate queries from rollups, and leaving the others alone."""
+
+import pytest
+
+from insightly.history import serialise_sql
+from insightly.insightly import Insightly
+from insightly.rollups import query_shape
+
+BY_CLASS = 'SELECT "Pclass", count(*) AS n, sum("Fare") AS fare FROM titanic GROUP BY "Pclass"'
+
+
+@pytest.fixture
+def rolled_up(database: Insightly) -> Insightly:
+    """the database with a rollup of the passengers by class"""
+    for _ in range(database.rollups.min_queries):
+        database.rollups.observe(BY_CLASS)
+    assert database.rollups.rewrite(BY_CLASS) is not None
+    return database
+
+
+def shape(database: Insightly, query: str):
+    cursor = database.conn.cursor()
+    try:
+        return query_shape(serialise_sql(query), database.rollups._table_columns(cursor))
+    finally:
+        cursor.close()
+
+
+def exact(database: Insightly, query: str) -> list[tuple]:
+    return database.conn.execute(query).fetchall()
+
+
+def test_columns_resolve_case_insensitively(database: Insightly) -> None:
+    found = shape(database, "SELECT pclass, avg(fare) FROM titanic GROUP BY pclass")
+    assert found.dimensions == {"Pclass"}
+    assert found.measures == {"sum:Fare", "count:Fare"}
+
+
+def test_select_list_aliases_are_not_dimensions(database: Insightly) -> None:
+    found = shape(
+        database,
+        'SELECT "Pclass" AS class, count(*) AS n FROM titanic GROUP BY class ORDER BY n',
+    )
+    assert found.dimensions == {"Pclass"}
+
+
+def test_unknown_references_have_no_shape(database: Insightly) -> None:
+    assert shape(database, "SELECT count(*) FROM titanic WHERE nope > 1") is None
+
+
+def test_matching_query_is_answered_from_the_rollup(rolled_up: Insightly) -> None:
+    query = 'SELECT "Pclass", sum("Fare") AS fare FROM titanic GROUP BY "Pclass" ORDER BY 1'
+    rewritten = rolled_up.rollups.rewrite(query)
+    assert "_insightly_rollup_titanic_" in rewritten
+    assert exact(rolled_up, rewritten) == exact(rolled_up, query)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        # a filter on a column the rollup does not hold
+        "SELECT count(*) FROM titanic WHERE age > 30",
+        'SELECT count(*) FROM titanic WHERE "Age" > 30',
+        # a group by column the rollup does not hold
+        "SELECT sex, count(*) AS n FROM titanic GROUP BY sex ORDER BY sex",
+    ],
+)
+def test_queries_outside_the_rollup_run_on_the_table(
+    rolled_up: Insightly, query: str
+) -> None:
+    assert rolled_up.rollups.rewrite(query) is None
+    answer = rolled_up.execute_query(query)
+    assert [tuple(row) for row in answer.itertuples(index=False)] == exact(
+        rolled_up, query
+    )
+
+
+def test_rewrite_that_does_not_bind_falls_back(
+    rolled_up: Insightly, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    query = "SELECT count(*) AS n FROM titanic"
+    monkeypatch.setattr(
+        rolled_up.rollups, "rewrite", lambda _: "SELECT count(nope) AS n FROM titanic"
+    )
+    assert rolled_up.execute_query(query)["n"].tolist() == [1000]
@@ -0,0 +1,69 @@
+"""Resuming checkpointed runs, only by the tenant and on the database they asked."""
+
+from pathlib import Path
+
+import pytest
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END, START, StateGraph
+
+from insightly.classes import AgentState
+from insightly.insightly import Insightly
+from insightly.workflow import RunAccessError, RunDatabaseError, ask, resume
+
+
+@pytest.fixture
+def app():
+    """a two node workflow whose second node fails on its first call"""
+    calls = {"first": 0, "second": 0}
+
+    def first(state: AgentState) -> dict:
+        calls["first"] += 1
+        return {"attempts": state["attempts"] + 1}
+
+    def second(state: AgentState) -> dict:
+        calls["second"] += 1
+        if calls["second"] == 1:
+            raise RuntimeError("injected")
+        return {"fast_path": True}
+
+    workflow = StateGraph(AgentState)
+    workflow.add_node("first", first)
+    workflow.add_node("second", second)
+    workflow.add_edge(START, "first")
+    workflow.add_edge("first", "second")
+    workflow.add_edge("second", END)
+    app = workflow.compile(checkpointer=MemorySaver())
+    app.calls = calls
+    with pytest.raises(RuntimeError):
+        ask(app, "how many?", thread_id="run", tenant="alice")
+    return app
+
+
+def test_run_continues_from_the_failed_node(app) -> None:
+    result = resume(app, "run", tenant="alice")
+    assert result["fast_path"] and result["attempts"] == 1
+    assert app.calls == {"first": 1, "second": 2}
+    # a finished run returns its final state
+    assert resume(app, "run", tenant="alice") == result
+    assert app.calls["second"] == 2
+
+
+@pytest.mark.parametrize("tenant", ["bob", None])
+def test_other_tenants_cannot_resume_the_run(app, tenant) -> None:
+    with pytest.raises(RunAccessError):
+        resume(app, "run", tenant=tenant)
+    assert app.calls["second"] == 1
+
+
+def test_unknown_run_is_not_resumed(app) -> None:
+    assert resume(app, "other", tenant="alice") is None
+
+
+def test_run_is_not_resumed_on_another_database(app, tmp_path: Path) -> None:
+    other = Insightly(database=str(tmp_path / "other.duckdb"))
+    try:
+        with other.activate(), pytest.raises(RunDatabaseError):
+            resume(app, "run", tenant="alice")
+    finally:
+        other.close()
+    assert app.calls["second"] == 1
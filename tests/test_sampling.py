@@ -0,0 +1,50 @@
+"""Approximate answers over the samples of large tables."""
+
+import pytest
+
+from insightly.insightly import Insightly
+from insightly.sampling import SampleStore, approximate_query
+
+
+@pytest.fixture
+def sampled(database: Insightly) -> Insightly:
+    """the database with a sample of about half of the passengers"""
+    database._samples = SampleStore(database, min_rows=100, sample_rows=500)
+    database.samples._build("titanic")
+    sample_name, fraction = database.samples.sample("titanic")
+    assert sample_name is not None and fraction == 0.5
+    return database
+
+
+def names(answer: dict) -> list[str]:
+    return [column["name"] for column in answer["columns"]]
+
+
+def test_scaled_columns_keep_the_names_of_the_exact_query(sampled: Insightly) -> None:
+    query = (
+        'SELECT "Pclass", count(*), sum("Fare") + 1, avg("Age") '
+        'FROM titanic GROUP BY "Pclass"'
+    )
+    answer = approximate_query(sampled, query)
+    assert names(answer) == sampled.conn.sql(query).columns
+
+
+def test_aliases_are_kept(sampled: Insightly) -> None:
+    query = 'SELECT count(*) AS n, sum("Fare") FROM titanic'
+    answer = approximate_query(sampled, query)
+    assert names(answer) == sampled.conn.sql(query).columns == ["n", "sum(Fare)"]
+    assert set(answer["error_bounds"]) == {"n", "sum(Fare)"}
+
+
+def test_counts_and_sums_are_scaled_up(sampled: Insightly) -> None:
+    answer = approximate_query(sampled, "SELECT count(*) AS n FROM titanic")
+    (n,) = answer["data"]["n"]
+    (bound,) = answer["error_bounds"]["n"]
+    assert answer["sample_fraction"] == 0.5
+    assert abs(n - 1000) <= 3 * bound
+
+
+def test_small_tables_are_not_sampled(database: Insightly) -> None:
+    database._samples = SampleStore(database, min_rows=10_000)
+    database.samples._build("titanic")
+    assert approximate_query(database, "SELECT count(*) FROM titanic") is None
@@ -0,0 +1,145 @@
+"""Serving read-only snapshots and swapping them under running queries."""
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pandas as pd
+import pytest
+
+from conftest import create_passengers
+from insightly.insightly import Insightly, QueryCancelledError, ReadOnlyDatabaseError
+from insightly.snapshots import (
+    SnapshotWatcher,
+    current_snapshot,
+    publish_snapshot,
+    snapshot_path,
+)
+
+# keeps a reader busy for a few seconds
+SLOW = (
+    "SELECT count(*) FROM titanic a, titanic b, titanic c, range(100) d "
+    'WHERE (a."PassengerId" * b."PassengerId" + c."PassengerId" + d.range) % 7 = 3'
+)
+PASSENGERS = "SELECT count(*) FROM titanic"
+
+
+@pytest.fixture
+def writer(tmp_path: Path) -> Iterator[Insightly]:
+    """the process loading the data of a workspace"""
+    insightly = Insightly(database=str(tmp_path / "ws_sales.duckdb"))
+    create_passengers(insightly)
+    yield insightly
+    insightly.close()
+
+
+@pytest.fixture
+def root(tmp_path: Path) -> str:
+    return str(tmp_path / "snapshots")
+
+
+@pytest.fixture
+def reader(writer: Insightly, root: str) -> Iterator[Insightly]:
+    """a process serving the first snapshot of the workspace"""
+    publish_snapshot(writer, root)
+    insightly = Insightly(snapshot=current_snapshot(root, writer.db_name))
+    yield insightly
+    insightly.close()
+
+
+def add_passenger(database: Insightly) -> None:
+    database.conn.execute("INSERT INTO titanic VALUES (1000, 1, 'female', 30.0, 80.0)")
+
+
+def attached(insightly: Insightly) -> set[str]:
+    return {
+        name
+        for (name,) in insightly.conn.execute(
+            "SELECT database_name FROM duckdb_databases() WHERE NOT internal"
+        ).fetchall()
+    } - {"memory"}
+
+
+def count(insightly: Insightly, query: str = PASSENGERS) -> int:
+    return int(insightly.execute_query(query).iloc[0, 0])
+
+
+def test_reader_serves_the_tables_with_and_without_database_name(
+    reader: Insightly,
+) -> None:
+    assert count(reader) == 1000
+    assert count(reader, "SELECT count(*) FROM ws_sales.titanic") == 1000
+    with pytest.raises(ReadOnlyDatabaseError):
+        reader.add_df_to_duckdb(pd.DataFrame({"x": [1]}), "other")
+
+
+def test_swap_serves_the_new_snapshot(
+    writer: Insightly, reader: Insightly, root: str
+) -> None:
+    add_passenger(writer)
+    publish_snapshot(writer, root)
+    before = attached(reader)
+    reader.attach_snapshot(current_snapshot(root, writer.db_name))
+    assert count(reader) == 1001
+    # no query was running, the previous snapshot is detached at once
+    assert len(attached(reader)) == 1 and attached(reader) != before
+
+
+def test_running_query_keeps_its_snapshot(
+    writer: Insightly, reader: Insightly, root: str
+) -> None:
+    outcome: dict = {}
+
+    def run() -> None:
+        try:
+            reader.execute_query(SLOW, timeout=30, query_id="slow")
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    while not reader._snapshot_readers:
+        time.sleep(0.01)
+    add_passenger(writer)
+    publish_snapshot(writer, root)
+    reader.attach_snapshot(current_snapshot(root, writer.db_name))
+    # new queries see the new snapshot while the old one is still read
+    assert count(reader) == 1001
+    assert len(attached(reader)) == 2
+    reader.cancel_query("slow")
+    thread.join(5)
+    assert isinstance(outcome.get("error"), QueryCancelledError)
+    assert len(attached(reader)) == 1
+
+
+def test_results_are_kept_across_swaps(
+    writer: Insightly, reader: Insightly, root: str
+) -> None:
+    reader.materialize_query(PASSENGERS, "transformation_0123abcd")
+    publish_snapshot(writer, root)
+    reader.attach_snapshot(current_snapshot(root, writer.db_name))
+    assert reader.has_result("transformation_0123abcd")
+
+
+def test_old_snapshots_are_pruned(writer: Insightly, root: str) -> None:
+    for _ in range(3):
+        publish_snapshot(writer, root, keep=2)
+    assert not os.path.exists(snapshot_path(root, writer.db_name, 1))
+    assert os.path.exists(snapshot_path(root, writer.db_name, 2))
+    assert current_snapshot(root, writer.db_name) == snapshot_path(
+        root, writer.db_name, 3
+    )
+
+
+def test_watcher_notices_new_snapshots(writer: Insightly, root: str) -> None:
+    watcher = SnapshotWatcher(root)
+    assert not watcher.changed(writer.db_name)
+    publish_snapshot(writer, root)
+    # the first check only records the snapshot
+    assert not watcher.changed(writer.db_name)
+    time.sleep(0.01)
+    publish_snapshot(writer, root)
+    assert watcher.changed(writer.db_name)
+    assert not watcher.changed(writer.db_name)